@@ -2,13 +2,31 @@ import streamlit as st
 import re
 import pandas as pd
 import plotly.express as px
-import json
 import sqlite3
 from cryptography.fernet import Fernet
 from datetime import datetime
 import os
+import time
 import openai
 from dotenv import load_dotenv
+from ocr_preprocessing import open_image, preprocess_for_ocr, render_page_for_ocr
+from ocr_engine import ocr_image
+from report_codec import decode_report, encode_report, encode_text
+from fuzzy_names import FuzzyNameIndex
+from analytics import merge_rollup_series, query_rollups, rebuild_rollups, setup_rollup_tables, update_rollups
+from pdf_tables import iter_table_rows
+from near_duplicates import find_near_duplicates, same_results, setup_signature_tables, store_signature
+from export import iter_arrow_stream
+from search_index import (MAX_OFFSET, index_report, load_hits, parse_query, rebuild_index, search, search_hits,
+                          search_key, setup_search_tables)
+from alerts import evaluate_alerts, load_rules, previous_values, queue_alerts, setup_alert_tables
+from units import UnitRegistry, printed_unit
+from sharding import fan_out, misplaced_patients, next_report_id, place_patients, shard_files, shard_for_key
+from group_commit import submit_write, wait_for_writes
+from report_store import get_report_store
+from prescription_alarm import ReportDetails, schedule_alarms
+from patient_ids import (blind_index, find_patient, get_or_create_patient, index_key, migrate_patient_names,
+                         setup_patient_tables)
 
 # Optional imports with fallback handling
 try:
@@ -42,7 +60,54 @@ if not ENCRYPTION_KEY_STR:
 else:
     ENCRYPTION_KEY = ENCRYPTION_KEY_STR.encode()
     cipher_suite = Fernet(ENCRYPTION_KEY)
-DB_FILE = "patient_reports.db"
+
+def parse_retired_keys(value):
+    """Parses RETIRED_ENCRYPTION_KEYS ("1:<key>,2:<key>") into {version: key bytes}."""
+    keys = {}
+    for entry in (value or "").split(","):
+        if entry.strip():
+            version, key = entry.strip().split(":", 1)
+            keys[int(version)] = key.strip().encode()
+    return keys
+
+# Every row records the version of the key it was encrypted with. Old keys
+# stay readable through RETIRED_ENCRYPTION_KEYS until key_rotation.py has
+# re-encrypted their rows with the current ENCRYPTION_KEY_VERSION.
+ENCRYPTION_KEY_VERSION = int(os.getenv("ENCRYPTION_KEY_VERSION", "1"))
+RETIRED_KEYS = parse_retired_keys(os.getenv("RETIRED_ENCRYPTION_KEYS"))
+# {version: raw Fernet key}, current key first
+KEY_BYTES = {ENCRYPTION_KEY_VERSION: ENCRYPTION_KEY}
+KEY_BYTES.update((v, k) for v, k in RETIRED_KEYS.items() if v != ENCRYPTION_KEY_VERSION)
+# Keys the full-text index hashes words with. Set SEARCH_TOKEN_KEY so the
+# index survives key rotation; otherwise run `python search_index.py rebuild` after rotating.
+SEARCH_KEY = search_key(os.getenv("SEARCH_TOKEN_KEY") or ENCRYPTION_KEY)
+# Key of the patient-name blind index. Set PATIENT_INDEX_KEY so it survives
+# key rotation; otherwise run `python patient_ids.py reindex` after rotating.
+PATIENT_INDEX_KEY = index_key(os.getenv("PATIENT_INDEX_KEY") or ENCRYPTION_KEY)
+
+def decrypt_report(encrypted_data, key_version=None):
+    """
+    Decrypts and decodes a stored report (legacy Fernet JSON or the compact
+    v2 format), going straight to the row's key when its version is known.
+    """
+    keys = [KEY_BYTES[key_version]] if key_version in KEY_BYTES else list(KEY_BYTES.values())
+    return decode_report(encrypted_data, keys, EXPLANATION_CATALOGUE, default_explanation)
+
+DB_FILE = os.getenv("DB_FILE", "patient_reports.db")
+# DB_SHARDS > 1 spreads patients over that many database files (see sharding.py)
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+SHARD_FILES = shard_files(DB_FILE, DB_SHARDS)
+
+def patient_index(patient_name):
+    """Blind index of a patient's name: how patients are looked up without storing names."""
+    return blind_index(PATIENT_INDEX_KEY, patient_name)
+
+def patient_db_file(patient_name):
+    """The database file holding a patient's reports."""
+    return SHARD_FILES[shard_for_key(patient_index(patient_name), DB_SHARDS)]
+
+def encrypt_patient_name(patient_name):
+    return encode_text(patient_name, ENCRYPTION_KEY), ENCRYPTION_KEY_VERSION
 
 # --- 1️⃣ & 2️⃣: Input and Data Extraction Layer (Corrected & Improved) ---
 
@@ -75,14 +140,10 @@ def extract_text_from_source(uploaded_file):
                     return None
                 
                 st.warning("Scanned PDF detected. Using OCR, which may take longer...")
-                for page in doc:
-                    # Render page to an image at higher DPI for better OCR
-                    pix = page.get_pixmap(dpi=300)
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    raw_text += pytesseract.image_to_string(img)
+                # Render each page at a DPI chosen from its text size, then clean up for OCR
+                raw_text = "".join(ocr_image(render_page_for_ocr(page)) for page in doc)
             else:
-                for page in doc:
-                    raw_text += page.get_text()
+                raw_text = "".join(page.get_text() for page in doc)
 
         elif file_extension in [".jpg", ".jpeg", ".png"]:
             if not OCR_AVAILABLE or pytesseract is None or Image is None:
@@ -91,8 +152,8 @@ def extract_text_from_source(uploaded_file):
                 st.info("Then install: pip install pytesseract pillow")
                 return None
             
-            img = Image.open(uploaded_file)
-            raw_text = pytesseract.image_to_string(img)
+            img = preprocess_for_ocr(open_image(uploaded_file))
+            raw_text = ocr_image(img)
 
         elif file_extension == ".txt":
             raw_text = uploaded_file.read().decode("utf-8")
@@ -103,154 +164,330 @@ def extract_text_from_source(uploaded_file):
 
     return {"raw_text": raw_text}
 
-def clean_and_normalize_text(raw_text_data):
-    """Cleans and standardizes the extracted text."""
-    if not raw_text_data or not raw_text_data.get("raw_text"):
-        return {"clean_text": ""}
-
-    text = raw_text_data["raw_text"]
-    
-    # Define normalization rules
-    normalization_map = {
+# Normalization rules and header/footer filter, compiled once
+NORMALIZATION_RULES = [
+    (re.compile(pattern, re.IGNORECASE), replacement) for pattern, replacement in {
         r'\bHb\b|\bHGB\b': 'Hemoglobin',
         r'\bGLU\b|Blood Sugar': 'Glucose',
         r'Total Cholesterol': 'Cholesterol',
         r'WBC Count': 'White Blood Cell Count'
-    }
-    
-    for pattern, replacement in normalization_map.items():
-        text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
+    }.items()
+]
+# "Date:" lines are kept: the report date is read from the cleaned text
+HEADER_FOOTER_RE = re.compile(r'^\s*Page \d+|\bReport Generated On\b', re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_page_text(text):
+    """Cleans one page (or any run of whole lines) of raw text."""
+    for pattern, replacement in NORMALIZATION_RULES:
+        text = pattern.sub(replacement, text)
 
     # Remove extra spaces, headers, footers
-    lines = text.split('\n')
     cleaned_lines = [
-        line.strip() for line in lines
-        if not re.match(r'^\s*Page \d+|\bDate\b:|\bReport Generated On\b', line, re.IGNORECASE) and line.strip()
+        line.strip() for line in text.split('\n')
+        if not HEADER_FOOTER_RE.match(line) and line.strip()
     ]
-    
-    clean_text = ' '.join(cleaned_lines)
-    clean_text = re.sub(r'\s+', ' ', clean_text)
-    
-    return {"clean_text": clean_text}
+    text = WHITESPACE_RE.sub(' ', ' '.join(cleaned_lines))
+
+    # Map OCR-garbled test names ("Hemog1obin", "S G O T") to catalogue names
+    return FUZZY_NAME_INDEX.correct_test_names(text)
+
+def clean_and_normalize_text(raw_text_data):
+    """Cleans and standardizes the extracted text."""
+    if not raw_text_data or not raw_text_data.get("raw_text"):
+        return {"clean_text": ""}
+
+    return {"clean_text": normalize_page_text(raw_text_data["raw_text"])}
 
 # --- 3️⃣: NLP Information Extraction Layer ---
 
-def extract_parameters_with_ner(clean_text_data):
-    """Uses Regex to extract test parameters. A true NLP model would be an enhancement."""
-    text = clean_text_data.get("clean_text", "")
-    
-    # Define common medical test patterns and their normal ranges
-    medical_tests = {
-        "Hemoglobin": {"unit": "g/dl", "normal_range": (12, 16)},
-        "HGB": {"unit": "g/dl", "normal_range": (12, 16)},
-        "P.C.V": {"unit": "%", "normal_range": (36, 46)},
-        "R.B.C": {"unit": "million/cu mm", "normal_range": (4.5, 5.5)},
-        "W.B.C": {"unit": "cells/cu mm", "normal_range": (4000, 11000)},
-        "Platelet Count": {"unit": "lacs/cu mm", "normal_range": (1.5, 4.5)},
-        "Polymorphs": {"unit": "%", "normal_range": (40, 75)},
-        "Lymphocytes": {"unit": "%", "normal_range": (20, 45)},
-        "Eosinophils": {"unit": "%", "normal_range": (1, 6)},
-        "Monocytes": {"unit": "%", "normal_range": (2, 10)},
-        "SR": {"unit": "mm/Hr", "normal_range": (0, 20)},
-        "ESR": {"unit": "mm/Hr", "normal_range": (0, 20)},
-        "Blood Sugar": {"unit": "mg/dl", "normal_range": (70, 140)},
-        "Random Blood Sugar": {"unit": "mg/dl", "normal_range": (70, 140)},
-        "Serum Creatinine": {"unit": "mg/dl", "normal_range": (0.6, 1.2)},
-        "Blood Urea": {"unit": "mg/dl", "normal_range": (7, 20)},
-        "Serum Sodium": {"unit": "mmol/L", "normal_range": (135, 145)},
-        "Serum Potassium": {"unit": "mmol/L", "normal_range": (3.5, 5.0)},
-        "Serum Chlorides": {"unit": "mmol/L", "normal_range": (98, 107)},
-        "Total Bilirubin": {"unit": "mg/dl", "normal_range": (0.3, 1.2)},
-        "Conjugated Bilirubin": {"unit": "mg/dl", "normal_range": (0.1, 0.3)},
-        "Alkaline Phosphatase": {"unit": "U/L", "normal_range": (44, 147)},
-        "SGOT": {"unit": "U/L", "normal_range": (10, 40)},
-        "SGPT": {"unit": "U/L", "normal_range": (10, 40)},
-        "Total Serum Proteins": {"unit": "g/dl", "normal_range": (6.0, 8.3)},
-        "Albumin": {"unit": "g/dl", "normal_range": (3.5, 5.0)},
-        "PT": {"unit": "sec", "normal_range": (11, 13)},
-        "INR": {"unit": "", "normal_range": (0.8, 1.2)},
-        "APTT": {"unit": "sec", "normal_range": (25, 35)},
-        "BT": {"unit": "min", "normal_range": (2, 7)},
-        "CT": {"unit": "min", "normal_range": (2, 7)}
-    }
-    
-    extracted_data = []
-    
-    # Look for patterns like "Test Name: Value unit" or "Test Name Value unit"
-    for test_name, test_info in medical_tests.items():
+# Define common medical test patterns and their normal ranges
+MEDICAL_TESTS = {
+    "Hemoglobin": {"unit": "g/dl", "normal_range": (12, 16)},
+    "HGB": {"unit": "g/dl", "normal_range": (12, 16)},
+    "P.C.V": {"unit": "%", "normal_range": (36, 46)},
+    "R.B.C": {"unit": "million/cu mm", "normal_range": (4.5, 5.5)},
+    "W.B.C": {"unit": "cells/cu mm", "normal_range": (4000, 11000)},
+    "Platelet Count": {"unit": "lacs/cu mm", "normal_range": (1.5, 4.5)},
+    "Polymorphs": {"unit": "%", "normal_range": (40, 75)},
+    "Lymphocytes": {"unit": "%", "normal_range": (20, 45)},
+    "Eosinophils": {"unit": "%", "normal_range": (1, 6)},
+    "Monocytes": {"unit": "%", "normal_range": (2, 10)},
+    "SR": {"unit": "mm/Hr", "normal_range": (0, 20)},
+    "ESR": {"unit": "mm/Hr", "normal_range": (0, 20)},
+    "Blood Sugar": {"unit": "mg/dl", "normal_range": (70, 140)},
+    "Random Blood Sugar": {"unit": "mg/dl", "normal_range": (70, 140)},
+    "Serum Creatinine": {"unit": "mg/dl", "normal_range": (0.6, 1.2)},
+    "Blood Urea": {"unit": "mg/dl", "normal_range": (7, 20)},
+    "Serum Sodium": {"unit": "mmol/L", "normal_range": (135, 145)},
+    "Serum Potassium": {"unit": "mmol/L", "normal_range": (3.5, 5.0)},
+    "Serum Chlorides": {"unit": "mmol/L", "normal_range": (98, 107)},
+    "Total Bilirubin": {"unit": "mg/dl", "normal_range": (0.3, 1.2)},
+    "Conjugated Bilirubin": {"unit": "mg/dl", "normal_range": (0.1, 0.3)},
+    "Alkaline Phosphatase": {"unit": "U/L", "normal_range": (44, 147)},
+    "SGOT": {"unit": "U/L", "normal_range": (10, 40)},
+    "SGPT": {"unit": "U/L", "normal_range": (10, 40)},
+    "Total Serum Proteins": {"unit": "g/dl", "normal_range": (6.0, 8.3)},
+    "Albumin": {"unit": "g/dl", "normal_range": (3.5, 5.0)},
+    "PT": {"unit": "sec", "normal_range": (11, 13)},
+    "INR": {"unit": "", "normal_range": (0.8, 1.2)},
+    "APTT": {"unit": "sec", "normal_range": (25, 35)},
+    "BT": {"unit": "min", "normal_range": (2, 7)},
+    "CT": {"unit": "min", "normal_range": (2, 7)}
+}
+
+# Alternative spellings that should be read as a catalogue test
+TEST_NAME_ALIASES = {
+    "Haemoglobin": "Hemoglobin",
+    "Platelets": "Platelet Count",
+    "Neutrophils": "Polymorphs",
+    "Creatinine": "Serum Creatinine",
+    "Sodium": "Serum Sodium",
+    "Potassium": "Serum Potassium",
+    "Chloride": "Serum Chlorides",
+    "Serum Chloride": "Serum Chlorides",
+    "AST": "SGOT",
+    "ALT": "SGPT",
+}
+
+# Canonical unit of every catalogue test, and conversions into it (see units.py)
+UNIT_REGISTRY = UnitRegistry(MEDICAL_TESTS)
+
+# Maximum edit distance for fuzzy test-name matching (0 = exact names and aliases only)
+FUZZY_MATCH_DISTANCE = int(os.getenv("FUZZY_MATCH_DISTANCE", "2"))
+
+FUZZY_NAME_INDEX = FuzzyNameIndex(
+    {**{name: name for name in MEDICAL_TESTS}, **TEST_NAME_ALIASES},
+    max_distance=FUZZY_MATCH_DISTANCE,
+)
+
+# Also look for specific patterns from your report
+SPECIFIC_PATTERNS = [
+    (r"P\.C\.V\s+([\d\.]+)", "P.C.V", "%", (36, 46)),
+    (r"R\.B\.C\s+([\d\.]+)", "R.B.C", "million/cu mm", (4.5, 5.5)),
+    (r"W\.B\.C\s+([\d\.]+)", "W.B.C", "cells/cu mm", (4000, 11000)),
+    (r"Platelet Count\s+([\d\.]+)", "Platelet Count", "lacs/cu mm", (1.5, 4.5)),
+    (r"Polymorphs\s+([\d\.]+)%", "Polymorphs", "%", (40, 75)),
+    (r"Lymphocytes\s+([\d\.]+)%", "Lymphocytes", "%", (20, 45)),
+    (r"Eosinophils\s+([\d\.]+)%", "Eosinophils", "%", (1, 6)),
+    (r"Monocytes\s+([\d\.]+)%", "Monocytes", "%", (2, 10)),
+    (r"SR\s+([\d\.]+)mm", "ESR", "mm/Hr", (0, 20)),
+    (r"Blood Sugar\s+([\d\.]+)", "Blood Sugar", "mg/dl", (70, 140)),
+    (r"Serum Creatinine\s+([\d\.]+)", "Serum Creatinine", "mg/dl", (0.6, 1.2)),
+    (r"Blood Urea\s+([\d\.]+)", "Blood Urea", "mg/dl", (7, 20)),
+    (r"Serum Sodium\s+([\d\.]+)", "Serum Sodium", "mmol/L", (135, 145)),
+    (r"Serum Potassium\s+([\d\.]+)", "Serum Potassium", "mmol/L", (3.5, 5.0)),
+    (r"Serum Chlorides\s+([\d\.]+)", "Serum Chlorides", "mmol/L", (98, 107)),
+    (r"Total Bilirubin\s+([\d\.]+)", "Total Bilirubin", "mg/dl", (0.3, 1.2)),
+    (r"Conjugated Bilirubin\s+([\d\.]+)", "Conjugated Bilirubin", "mg/dl", (0.1, 0.3)),
+    (r"Alkaline Phosphatase\s+([\d\.]+)", "Alkaline Phosphatase", "U/L", (44, 147)),
+    (r"SGOT\s+([\d\.]+)", "SGOT", "U/L", (10, 40)),
+    (r"SGPT\s+([\d\.]+)", "SGPT", "U/L", (10, 40)),
+    (r"Total Serum Proteins\s+([\d\.]+)", "Total Serum Proteins", "g/dl", (6.0, 8.3)),
+    (r"Albumin\s+([\d\.]+)", "Albumin", "g/dl", (3.5, 5.0)),
+    (r"PT\s+([\d\.]+)", "PT", "sec", (11, 13)),
+    (r"INR\s+([\d\.]+)", "INR", "", (0.8, 1.2)),
+    (r"APTT\s+([\d\.]+)", "APTT", "sec", (25, 35)),
+    (r"BT\s+([\d\.]+)", "BT", "min", (2, 7)),
+    (r"CT\s+([\d\.]+)", "CT", "min", (2, 7))
+]
+
+def _compile_test_patterns():
+    """Compiles the MEDICAL_TESTS and SPECIFIC_PATTERNS regexes once at import."""
+    main_patterns = []
+    for test_name, test_info in MEDICAL_TESTS.items():
+        name, unit = re.escape(test_name), re.escape(test_info['unit'])
         # Multiple patterns to catch different formats
         patterns = [
-            rf"{re.escape(test_name)}\s*[:\s]\s*([\d\.]+)\s*{re.escape(test_info['unit'])}",
-            rf"{re.escape(test_name)}\s+([\d\.]+)\s*{re.escape(test_info['unit'])}",
-            rf"{re.escape(test_name)}\s*[:\s]\s*([\d\.]+)",
-            rf"{re.escape(test_name)}\s+([\d\.]+)"
+            rf"{name}\s*[:\s]\s*([\d\.]+)\s*{unit}",
+            rf"{name}\s+([\d\.]+)\s*{unit}",
+            rf"{name}\s*[:\s]\s*([\d\.]+)",
+            rf"{name}\s+([\d\.]+)"
         ]
-        
-        for pattern in patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE)
-            for match in matches:
-                try:
-                    value = float(match.group(1))
-                    extracted_data.append({
-                        "test_name": test_name,
-                        "value": value,
-                        "unit": test_info["unit"],
-                        "range_low": test_info["normal_range"][0],
-                        "range_high": test_info["normal_range"][1]
-                    })
-                    break  # Found the test, move to next test
-                except (ValueError, IndexError):
-                    continue
-    
-    # Also look for specific patterns from your report
+        main_patterns.append((test_name, test_info, [re.compile(p, re.IGNORECASE) for p in patterns]))
+
     specific_patterns = [
-        (r"P\.C\.V\s+([\d\.]+)", "P.C.V", "%", (36, 46)),
-        (r"R\.B\.C\s+([\d\.]+)", "R.B.C", "million/cu mm", (4.5, 5.5)),
-        (r"W\.B\.C\s+([\d\.]+)", "W.B.C", "cells/cu mm", (4000, 11000)),
-        (r"Platelet Count\s+([\d\.]+)", "Platelet Count", "lacs/cu mm", (1.5, 4.5)),
-        (r"Polymorphs\s+([\d\.]+)%", "Polymorphs", "%", (40, 75)),
-        (r"Lymphocytes\s+([\d\.]+)%", "Lymphocytes", "%", (20, 45)),
-        (r"Eosinophils\s+([\d\.]+)%", "Eosinophils", "%", (1, 6)),
-        (r"Monocytes\s+([\d\.]+)%", "Monocytes", "%", (2, 10)),
-        (r"SR\s+([\d\.]+)mm", "ESR", "mm/Hr", (0, 20)),
-        (r"Blood Sugar\s+([\d\.]+)", "Blood Sugar", "mg/dl", (70, 140)),
-        (r"Serum Creatinine\s+([\d\.]+)", "Serum Creatinine", "mg/dl", (0.6, 1.2)),
-        (r"Blood Urea\s+([\d\.]+)", "Blood Urea", "mg/dl", (7, 20)),
-        (r"Serum Sodium\s+([\d\.]+)", "Serum Sodium", "mmol/L", (135, 145)),
-        (r"Serum Potassium\s+([\d\.]+)", "Serum Potassium", "mmol/L", (3.5, 5.0)),
-        (r"Serum Chlorides\s+([\d\.]+)", "Serum Chlorides", "mmol/L", (98, 107)),
-        (r"Total Bilirubin\s+([\d\.]+)", "Total Bilirubin", "mg/dl", (0.3, 1.2)),
-        (r"Conjugated Bilirubin\s+([\d\.]+)", "Conjugated Bilirubin", "mg/dl", (0.1, 0.3)),
-        (r"Alkaline Phosphatase\s+([\d\.]+)", "Alkaline Phosphatase", "U/L", (44, 147)),
-        (r"SGOT\s+([\d\.]+)", "SGOT", "U/L", (10, 40)),
-        (r"SGPT\s+([\d\.]+)", "SGPT", "U/L", (10, 40)),
-        (r"Total Serum Proteins\s+([\d\.]+)", "Total Serum Proteins", "g/dl", (6.0, 8.3)),
-        (r"Albumin\s+([\d\.]+)", "Albumin", "g/dl", (3.5, 5.0)),
-        (r"PT\s+([\d\.]+)", "PT", "sec", (11, 13)),
-        (r"INR\s+([\d\.]+)", "INR", "", (0.8, 1.2)),
-        (r"APTT\s+([\d\.]+)", "APTT", "sec", (25, 35)),
-        (r"BT\s+([\d\.]+)", "BT", "min", (2, 7)),
-        (r"CT\s+([\d\.]+)", "CT", "min", (2, 7))
+        (re.compile(pattern, re.IGNORECASE), test_name, unit, normal_range)
+        for pattern, test_name, unit, normal_range in SPECIFIC_PATTERNS
     ]
-    
-    for pattern, test_name, unit, normal_range in specific_patterns:
-        matches = re.finditer(pattern, text, re.IGNORECASE)
-        for match in matches:
+    return main_patterns, specific_patterns
+
+COMPILED_TEST_PATTERNS, COMPILED_SPECIFIC_PATTERNS = _compile_test_patterns()
+
+# A single test match ("Name: value unit") is far shorter than this, so any
+# match ending within MATCH_WINDOW of a chunk's end is deferred to the next
+# chunk, which starts CARRY_WINDOW characters back.
+MATCH_WINDOW = 200
+CARRY_WINDOW = 2 * MATCH_WINDOW
+
+class ParameterStream:
+    """
+    Runs the test patterns over cleaned text fed in chunks (one page at a
+    time), keeping only the first match per pattern and a short tail of
+    text, so memory does not grow with the document. Tests that straddle a
+    chunk boundary are picked up from the carried-over tail. results()
+    gives the same list extract_parameters_with_ner returns for the whole
+    text, and can be called after any chunk for early results.
+
+    The same buffers are scanned for the report date and prescriptions
+    (prescription_alarm.DETAILS_RE), returned by details(). With
+    tests=False only those are looked for.
+    """
+
+    def __init__(self, tests=True):
+        self._main = {}       # (test index, pattern index) -> first (value, printed unit)
+        self._specific = {}   # specific pattern index -> first (value, printed unit)
+        self._carry = ""
+        self._tests = tests
+        self._details = ReportDetails()
+        self._resume = 0      # where the details scan continues in the next buffer
+
+    def feed(self, clean_text, final=False):
+        if self._carry and clean_text:
+            buffer = self._carry + " " + clean_text
+        else:
+            buffer = self._carry or clean_text
+        limit = len(buffer) if final else len(buffer) - MATCH_WINDOW
+        resume = self._details.scan(buffer, self._resume, limit)
+
+        for test_index, (_, _, patterns) in enumerate(COMPILED_TEST_PATTERNS if self._tests else ()):
+            for pattern_index, pattern in enumerate(patterns):
+                if (test_index, pattern_index) not in self._main:
+                    value = self._first_value(pattern, buffer, limit)
+                    if value is not None:
+                        self._main[(test_index, pattern_index)] = value
+
+        for index, (pattern, _, _, _) in enumerate(COMPILED_SPECIFIC_PATTERNS if self._tests else ()):
+            if index not in self._specific:
+                value = self._first_value(pattern, buffer, limit)
+                if value is not None:
+                    self._specific[index] = value
+
+        if final:
+            self._carry, self._resume = "", 0
+            return
+        carry_start = max(len(buffer) - CARRY_WINDOW, 0)
+        self._carry = buffer[carry_start:]
+        if resume < carry_start and carry_start and not buffer[carry_start - 1].isspace():
+            # Details matches are all kept, not just the first, so the next
+            # scan must not start inside a word the carry cut in half
+            resume = buffer.find(" ", carry_start) + 1 or len(buffer)
+        self._resume = max(resume - carry_start, 0)
+
+    @staticmethod
+    def _first_value(pattern, text, limit):
+        """(value, unit printed after it or None) of the first complete match."""
+        for match in pattern.finditer(text):
+            if match.end() > limit:
+                break
             try:
-                value = float(match.group(1))
-                # Check if we already have this test
-                if not any(item["test_name"] == test_name for item in extracted_data):
-                    extracted_data.append({
-                        "test_name": test_name,
-                        "value": value,
-                        "unit": unit,
-                        "range_low": normal_range[0],
-                        "range_high": normal_range[1]
-                    })
+                return float(match.group(1)), printed_unit(text, match.end(1))
             except (ValueError, IndexError):
                 continue
-            
-    return extracted_data
+        return None
+
+    @staticmethod
+    def _param(test_name, found, unit, normal_range):
+        value, unit_printed = found
+        # A printed unit other than the assumed one makes the assumed range
+        # meaningless; canonicalize fills in the catalogue range instead
+        low, high = (None, None) if unit_printed else normal_range
+        return {"test_name": test_name, "value": value, "unit": unit_printed or unit,
+                "range_low": low, "range_high": high}
+
+    def results(self):
+        extracted_data = []
+        for test_index, (test_name, test_info, patterns) in enumerate(COMPILED_TEST_PATTERNS):
+            for pattern_index in range(len(patterns)):
+                if (test_index, pattern_index) in self._main:
+                    extracted_data.append(self._param(test_name, self._main[(test_index, pattern_index)],
+                                                      test_info["unit"], test_info["normal_range"]))
+
+        found = {item["test_name"] for item in extracted_data}
+        for index, (_, test_name, unit, normal_range) in enumerate(COMPILED_SPECIFIC_PATTERNS):
+            # Check if we already have this test
+            if index in self._specific and test_name not in found:
+                found.add(test_name)
+                extracted_data.append(self._param(test_name, self._specific[index], unit, normal_range))
+        UNIT_REGISTRY.canonicalize(extracted_data)
+        return extracted_data
+
+    def details(self):
+        """{"report_date": "YYYY-MM-DD" or None, "prescriptions": [...]} found so far."""
+        return self._details.results()
+
+def extract_parameters_with_ner(clean_text_data):
+    """Uses Regex to extract test parameters. A true NLP model would be an enhancement."""
+    stream = ParameterStream()
+    stream.feed(clean_text_data.get("clean_text", ""), final=True)
+    return stream.results()
+
+def extract_report_fields(clean_text_data):
+    """Tests, report date and prescriptions from one scan of the cleaned text."""
+    stream = ParameterStream()
+    stream.feed(clean_text_data.get("clean_text", ""), final=True)
+    return {"tests": stream.results(), **stream.details()}
+
+def iter_page_parameters(raw_pages):
+    """
+    Normalizes raw page texts one at a time and feeds them to a
+    ParameterStream. Yields {"page", "clean_text", "tests", "report_date",
+    "prescriptions", "final"} after every page (found so far) and once more
+    with final=True after the last page, when they are complete.
+    """
+    stream = ParameterStream()
+    page_number = 0
+    for raw_page in raw_pages:
+        page_number += 1
+        clean_page = normalize_page_text(raw_page)
+        stream.feed(clean_page)
+        yield {"page": page_number, "clean_text": clean_page, "tests": stream.results(), **stream.details(),
+               "final": False}
+    stream.feed("", final=True)
+    yield {"page": page_number, "clean_text": "", "tests": stream.results(), **stream.details(), "final": True}
+
+PARENTHESES_RE = re.compile(r"\(.*?\)")
+
+def table_row_to_param(row):
+    """
+    Maps a parsed table row to an extracted parameter. Catalogue tests get
+    their canonical name; the report's printed unit and reference range are
+    preferred over the catalogue's (see UnitRegistry.canonicalize). Other
+    tests are kept only when the report prints a reference range for them.
+    """
+    for name in (PARENTHESES_RE.sub("", row["name"]), row["name"]):
+        match = FUZZY_NAME_INDEX.lookup(normalize_page_text(name))
+        if match and match[0] in MEDICAL_TESTS:
+            info = MEDICAL_TESTS[match[0]]
+            low, high = row["range"] or (None, None)
+            return {"test_name": match[0], "value": row["value"], "unit": row["unit"] or info["unit"],
+                    "range_low": low, "range_high": high}
+    if row["range"]:
+        low, high = row["range"]
+        return {"test_name": row["name"], "value": row["value"], "unit": row["unit"],
+                "range_low": low, "range_high": high}
+    return None
+
+def iter_table_parameters(pdf_source):
+    """
+    Like iter_page_parameters, for born-digital PDFs: test rows are read from
+    word coordinates (see pdf_tables.py) instead of regexes over flattened
+    text. The report date and prescriptions still come from the page text.
+    Yields nothing for scanned PDFs.
+    """
+    tests, page_number = [], 0
+    details = ParameterStream(tests=False)
+    for page_number, page_text, rows in iter_table_rows(pdf_source):
+        page_tests = [param for param in map(table_row_to_param, rows) if param]
+        UNIT_REGISTRY.canonicalize(page_tests)
+        tests.extend(page_tests)
+        clean_page = normalize_page_text(page_text)
+        details.feed(clean_page)
+        yield {"page": page_number, "clean_text": clean_page, "tests": list(tests), **details.details(),
+               "final": False}
+    if page_number:
+        details.feed("", final=True)
+        yield {"page": page_number, "clean_text": "", "tests": tests, **details.details(), "final": True}
 
 def classify_tests(extracted_params):
     """Classifies tests into 'regular' or 'periodic'."""
@@ -351,8 +588,26 @@ KNOWLEDGE_DICTIONARY = {
     }
 }
 
-def generate_explanations(analyzed_params, use_llm=False, api_key=None):
-    """Generates simple explanations for each test result, with an updated OpenAI call."""
+def default_explanation(param):
+    """Generic explanation for tests without a dictionary entry."""
+    return f"Your {param['test_name']} level is {param['status']}. Please consult your doctor."
+
+# Catalogue IDs ("Test/status") for the dictionary explanations, so stored
+# reports can reference an explanation instead of repeating its text
+EXPLANATION_CATALOGUE = {
+    f"{test_name}/{status}": text
+    for test_name, statuses in KNOWLEDGE_DICTIONARY.items()
+    for status, text in statuses.items()
+}
+EXPLANATION_REFS = {}
+for ref, text in EXPLANATION_CATALOGUE.items():
+    EXPLANATION_REFS.setdefault(text, ref)
+
+def generate_explanations(analyzed_params, use_llm=False, api_key=None, llm_deadline=None):
+    """
+    Generates simple explanations for each test result, with an updated OpenAI call.
+    After llm_deadline (a time.monotonic() value) the remaining tests get default explanations.
+    """
     client = openai.OpenAI(api_key=api_key) if use_llm and api_key else None
 
     for param in analyzed_params:
@@ -361,7 +616,7 @@ def generate_explanations(analyzed_params, use_llm=False, api_key=None):
         
         if test_name_key and status_key in KNOWLEDGE_DICTIONARY[test_name_key]:
             param["explanation"] = KNOWLEDGE_DICTIONARY[test_name_key][status_key]
-        elif client:
+        elif client and (llm_deadline is None or time.monotonic() < llm_deadline):
             try:
                 prompt = (
                     f"Explain this medical test result to a patient in simple, reassuring terms (under 50 words).\n"
@@ -380,7 +635,7 @@ def generate_explanations(analyzed_params, use_llm=False, api_key=None):
                 param["explanation"] = "Could not generate AI explanation. Using default message."
                 st.warning(f"OpenAI API call failed: {e}")
         else:
-            param["explanation"] = f"Your {param['test_name']} level is {param['status']}. Please consult your doctor."
+            param["explanation"] = default_explanation(param)
             
     return analyzed_params
 
@@ -400,41 +655,318 @@ def calculate_health_score(analyzed_params):
     
     return int(score), emoji
 
+def refresh_report_scores(report):
+    """Recomputes a stored report's statuses, score and summary after its values changed."""
+    tests = compute_health_status(report.get("tests", []))
+    score, emoji = calculate_health_score(tests)
+    if isinstance(report.get("health_score"), dict):
+        report["health_score"].update(score=score, emoji=emoji,
+                                      status="Excellent" if score >= 90 else "Average" if score >= 70 else "Needs Attention")
+    else:
+        report["health_score"] = (score, emoji)
+    if "summary" in report:
+        report["summary"]["normal_tests"] = sum(1 for t in tests if t["status"] == "Normal")
+        report["summary"]["abnormal_tests"] = sum(1 for t in tests if t["status"] != "Normal")
+    return report
+
 # --- 1️⃣0️⃣: Storage and Security (Corrected & Improved) ---
 
 def setup_database():
-    """Initializes the SQLite database connection and table."""
-    conn = sqlite3.connect(DB_FILE)
+    """Initializes the SQLite database (every shard of it), and the report store when it is not SQLite."""
+    for db_file in SHARD_FILES:
+        setup_shard(db_file)
+    if DB_SHARDS > 1:
+        # Shards from before patients were placed by blind index hold patients elsewhere
+        moved = place_patients(SHARD_FILES, rebuild_shard)
+        if moved:
+            print(f"Moved {moved} patients to their shards")
+        misplaced = sum(misplaced_patients(db_file, index, DB_SHARDS) for index, db_file in enumerate(SHARD_FILES))
+        if misplaced:
+            raise RuntimeError(f"{misplaced} patients are still on the wrong shard: run  python sharding.py check")
+    store = get_report_store()
+    if store is not None:
+        store.setup()
+
+def rebuild_shard(db_file):
+    """Recomputes the rollups and search index of one database file from its reports."""
+    rebuild_rollups(db_file, decrypt_report)
+    rebuild_index(db_file, SEARCH_KEY, KEY_BYTES)
+
+def setup_shard(db_file):
+    """Creates or upgrades the tables of one database file."""
+    conn = sqlite3.connect(db_file)
     conn.execute('''
         CREATE TABLE IF NOT EXISTS patient_reports (
-            id INTEGER PRIMARY KEY, patient_name TEXT,
+            id INTEGER PRIMARY KEY, patient_id TEXT,
             report_date DATE, report_data BLOB
         )
     ''')
-    conn.close()
-
-def save_report_to_db(patient_name, report_date, report_data):
-    """Encrypts and saves a report to the SQLite database."""
-    conn = sqlite3.connect(DB_FILE)
-    encrypted_data = cipher_suite.encrypt(json.dumps(report_data).encode())
-    conn.execute("INSERT INTO patient_reports (patient_name, report_date, report_data) VALUES (?, ?, ?)",
-                 (patient_name, report_date, encrypted_data))
+    # Record which key encrypted each row (NULL for rows saved before key versioning)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(patient_reports)")]
+    if "key_version" not in columns:
+        conn.execute("ALTER TABLE patient_reports ADD COLUMN key_version INTEGER")
+    # Optional cohort label (clinic, programme, ...) used by the analytics rollups
+    if "cohort" not in columns:
+        conn.execute("ALTER TABLE patient_reports ADD COLUMN cohort TEXT")
+    # Encrypted clean text (same key as report_data) for full-text search snippets
+    if "text_data" not in columns:
+        conn.execute("ALTER TABLE patient_reports ADD COLUMN text_data BLOB")
+    # WAL lets readers carry on while background jobs (key rotation) write
+    conn.execute("PRAGMA journal_mode=WAL")
+    setup_patient_tables(conn)
+    setup_rollup_tables(conn)
+    setup_signature_tables(conn)
+    setup_search_tables(conn)
+    # Databases from before the patients table still name patients in the clear
+    if "patient_name" in columns:
+        names, patients = migrate_patient_names(conn, PATIENT_INDEX_KEY, encrypt_patient_name)
+        print(f"Moved {names} patient names in {db_file} to the encrypted patients table")
+        if patients < names:
+            print(f"{names - patients} names were spellings of other patients: run  python analytics.py rebuild")
+    setup_alert_tables(conn)
+    # History and previous-result lookups go straight to one patient's rows
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_reports_patient ON patient_reports (patient_id, report_date)")
     conn.commit()
     conn.close()
 
+# In-process cache of patient_versions: name index -> (version, updated_at, fetched_at).
+# Saves in this process update it immediately; entries expire after
+# VERSION_CACHE_TTL seconds so saves made by other server workers become visible.
+_patient_versions = {}
+VERSION_CACHE_TTL = 2.0
+
+# Critical-value rules checked on every saved report (see alerts.py)
+ALERT_RULES = load_rules(os.getenv("ALERT_RULES_FILE"), TEST_NAME_ALIASES)
+
+def submit_report(patient_name, report_date, report_data, cohort=None, signature=None, clean_text=None):
+    """
+    Encrypts a report and queues its save (see group_commit.py): the report,
+    analytics rollups, queued alerts, near-duplicate signature (given the
+    MinHash signature of its text) and full-text index entry (given its
+    clean text) are written in one transaction. Critical-value alerts are
+    added to report_data as "alerts" before this returns. Returns a Future
+    of the new report id, set once the save is committed.
+    """
+    store = get_report_store()
+    if store is not None:
+        return submit_to_store(store, patient_name, report_date, report_data)
+    name_index = patient_index(patient_name)
+    shard = shard_for_key(name_index, DB_SHARDS)
+    db_file = SHARD_FILES[shard]
+    # Alerts compare against earlier results, including saves still queued
+    wait_for_writes(db_file, name_index)
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        known_id = find_patient(conn, name_index)
+        alerts = evaluate_alerts(ALERT_RULES, patient_name, report_date, report_data.get("tests", []),
+                                 lambda tests: previous_values(conn, known_id, report_date, tests, decrypt_report)
+                                 if known_id else {})
+    finally:
+        conn.close()
+    if alerts:
+        report_data["alerts"] = alerts
+    encrypted_data = encode_report(report_data, ENCRYPTION_KEY, EXPLANATION_REFS)
+    encrypted_text = encode_text(clean_text, ENCRYPTION_KEY) if clean_text else None
+    updated_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    saved = {}
+
+    def write(conn):
+        # Runs inside the shard's write transaction, so the id stays ours until commit
+        patient_id = get_or_create_patient(conn, name_index, patient_name, encrypt_patient_name)
+        report_id = next_report_id(conn, DB_SHARDS, shard)
+        conn.execute("INSERT INTO patient_reports (id, patient_id, report_date, report_data, key_version, cohort, text_data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (report_id, patient_id, report_date, encrypted_data, ENCRYPTION_KEY_VERSION, cohort, encrypted_text))
+        update_rollups(conn, patient_id, report_date, report_data.get("tests", []), cohort)
+        queue_alerts(conn, report_id, patient_id, alerts)
+        if signature is not None:
+            store_signature(conn, report_id, patient_id, signature)
+        if clean_text:
+            index_report(conn, report_id, patient_name, clean_text, SEARCH_KEY)
+        conn.execute("""
+            INSERT INTO patient_versions (patient_id, version, updated_at) VALUES (?, 1, ?)
+            ON CONFLICT(patient_id) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at
+        """, (patient_id, updated_at))
+        saved["version"] = conn.execute("SELECT version FROM patient_versions WHERE patient_id = ?",
+                                        (patient_id,)).fetchone()[0]
+        return report_id
+
+    def remember_version(future):
+        if future.exception() is None:
+            _patient_versions[name_index] = (saved["version"], updated_at, time.monotonic())
+
+    future = submit_write(db_file, write, name_index)
+    future.add_done_callback(remember_version)
+    return future
+
+def submit_to_store(store, patient_name, report_date, report_data):
+    """submit_report for a report store other than SQLite (see report_store.py)."""
+    name_index = patient_index(patient_name)
+    store.wait_pending(patient_name)
+    alerts = evaluate_alerts(ALERT_RULES, patient_name, report_date, report_data.get("tests", []),
+                             lambda tests: store.previous_values(patient_name, report_date, tests))
+    if alerts:
+        report_data["alerts"] = alerts
+    encrypted_data = encode_report(report_data, ENCRYPTION_KEY, EXPLANATION_REFS)
+    future = store.submit(patient_name, report_date, report_data, encrypted_data, ENCRYPTION_KEY_VERSION)
+    future.add_done_callback(lambda _: _patient_versions.pop(name_index, None))
+    return future
+
+def save_report_to_db(patient_name, report_date, report_data, cohort=None, signature=None, clean_text=None):
+    """Saves a report (see submit_report) and waits for the commit. Returns the new report id."""
+    return submit_report(patient_name, report_date, report_data, cohort, signature, clean_text).result()
+
+def find_duplicate_report(patient_name, signature, extracted_params):
+    """
+    A stored report of this patient whose text is near-identical (MinHash)
+    and whose extracted results agree with extracted_params.
+    Returns (report_id, similarity, report) or None.
+    """
+    db_file, name_index = patient_db_file(patient_name), patient_index(patient_name)
+    wait_for_writes(db_file, name_index)
+    conn = sqlite3.connect(db_file)
+    try:
+        patient_id = find_patient(conn, name_index)
+        if patient_id is None:
+            return None
+        for report_id, score in find_near_duplicates(conn, patient_id, signature):
+            row = conn.execute("SELECT report_data, key_version FROM patient_reports WHERE id = ?",
+                               (report_id,)).fetchone()
+            if not row:
+                continue
+            try:
+                report = decrypt_report(row[0], row[1])
+            except Exception:
+                continue
+            if same_results(extracted_params, report.get("tests", [])):
+                return report_id, score, report
+    finally:
+        conn.close()
+    return None
+
+def get_patient_version(patient_name):
+    """Returns (version, updated_at) of a patient's history; (0, None) if never saved."""
+    name_index = patient_index(patient_name)
+    store = get_report_store()
+    db_file = patient_db_file(patient_name)
+    if store is None:
+        wait_for_writes(db_file, name_index)
+    else:
+        store.wait_pending(patient_name)
+    cached = _patient_versions.get(name_index)
+    now = time.monotonic()
+    if cached and now - cached[2] < VERSION_CACHE_TTL:
+        return cached[0], cached[1]
+
+    if store is not None:
+        version, updated_at = store.version(patient_name)
+    else:
+        conn = sqlite3.connect(db_file)
+        row = conn.execute("SELECT v.version, v.updated_at FROM patient_versions v "
+                           "JOIN patients p ON p.patient_id = v.patient_id WHERE p.name_index = ?",
+                           (name_index,)).fetchone()
+        conn.close()
+        version, updated_at = row if row else (0, None)
+    _patient_versions[name_index] = (version, updated_at, now)
+    return version, updated_at
+
+def load_abnormal_rates(test_name, status="High", period="month", start=None, end=None, cohort="all"):
+    """Per-period share of patients with a given test status, read from the rollup tables of every shard."""
+    def query_shard(db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            return query_rollups(conn, test_name, status, period, start, end, cohort)
+        finally:
+            conn.close()
+    return merge_rollup_series(fan_out(query_shard, SHARD_FILES))
+
+def search_reports(query, patient_name=None, limit=20, offset=0):
+    """
+    Full-text search over saved reports' text; see search_index.search.
+    Raises ValueError for empty queries and offsets past MAX_OFFSET.
+    """
+    terms = parse_query(query)
+    if offset > MAX_OFFSET:
+        raise ValueError(f"offset must not be more than {MAX_OFFSET}")
+    shards = [patient_db_file(patient_name)] if patient_name else SHARD_FILES
+    if len(shards) == 1:
+        conn = sqlite3.connect(shards[0])
+        try:
+            return search(conn, SEARCH_KEY, KEY_BYTES, query, patient_name, limit, offset)
+        finally:
+            conn.close()
+
+    def rank_shard(db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            # Every shard's best offset + limit hits, so the merged page is exact
+            return search_hits(conn, SEARCH_KEY, terms, patient_name, offset + limit, 0)
+        finally:
+            conn.close()
+
+    # Only the ids and ranks are merged; just the returned page is decrypted
+    ranked = fan_out(rank_shard, shards)
+    page = sorted(((rank, db_file, report_id) for db_file, (_, hits) in zip(shards, ranked) for report_id, rank in hits),
+                  key=lambda hit: hit[0])[offset:offset + limit]
+    page_hits = {}
+    for rank, db_file, report_id in page:
+        page_hits.setdefault(db_file, []).append((report_id, rank))
+
+    def load_shard(db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            return load_hits(conn, KEY_BYTES, terms, page_hits[db_file])
+        finally:
+            conn.close()
+
+    loaded = {}
+    if page_hits:
+        for db_file, results in zip(page_hits, fan_out(load_shard, list(page_hits))):
+            loaded.update(((db_file, result["report_id"]), result) for result in results)
+    return {"total": sum(total for total, _ in ranked),
+            "results": [loaded[(db_file, report_id)] for _, db_file, report_id in page if (db_file, report_id) in loaded]}
+
+def export_results_stream(since_id="0", pseudonymize=False):
+    """
+    (watermark, Arrow IPC stream chunks) with one row per test result of the
+    reports saved after since_id, up to and including the watermark. With
+    several shards both are comma-separated report ids, one per shard.
+    Raises ValueError for a malformed since_id.
+    """
+    since = [int(part) for part in str(since_id).split(",")]
+    if since == [0]:
+        since = [0] * len(SHARD_FILES)
+    if len(since) != len(SHARD_FILES):
+        raise ValueError(f"since_id must list {len(SHARD_FILES)} report ids, one per shard")
+
+    def last_id(db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM patient_reports").fetchone()[0]
+        finally:
+            conn.close()
+
+    watermarks = fan_out(last_id, SHARD_FILES)
+    ranges = list(zip(SHARD_FILES, since, watermarks))
+    return ",".join(map(str, watermarks)), iter_arrow_stream(ranges, KEY_BYTES, pseudonymize=pseudonymize)
+
 def load_reports_from_db(patient_name):
-    """Loads and decrypts the last 5 reports for a specific patient."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.execute("SELECT report_date, report_data FROM patient_reports WHERE patient_name = ? ORDER BY report_date DESC LIMIT 5", (patient_name,))
+    """Loads and decrypts the last 5 reports for a specific patient, including its saves still being committed."""
+    store = get_report_store()
+    if store is not None:
+        rows = store.load_reports(patient_name)
+    else:
+        db_file, name_index = patient_db_file(patient_name), patient_index(patient_name)
+        wait_for_writes(db_file, name_index)
+        conn = sqlite3.connect(db_file)
+        rows = conn.execute("SELECT r.report_date, r.report_data, r.key_version FROM patient_reports r JOIN patients p ON p.patient_id = r.patient_id WHERE p.name_index = ? ORDER BY r.report_date DESC LIMIT 5", (name_index,)).fetchall()
+        conn.close()
     reports = []
-    for row in cursor.fetchall():
+    for row in rows:
         try:
-            decrypted_data = cipher_suite.decrypt(row[1])
-            reports.append({"date": row[0], "data": json.loads(decrypted_data.decode())})
+            reports.append({"date": row[0], "data": decrypt_report(row[1], row[2])})
         except Exception as e:
             st.warning(f"Could not decrypt an old report. The encryption key may have changed. {e}")
             continue
-    conn.close()
     return reports
 
 # --- 6️⃣ & 7️⃣: Comparison and Visualization Layer (Corrected & Optimized) ---
@@ -447,6 +979,9 @@ def display_dashboard(final_output, historical_data):
     score, emoji = final_output["health_score"]
     st.metric(label="Overall Health Score", value=f"{score}%", delta=f"{emoji} {'Excellent' if score >= 90 else 'Average' if score >= 70 else 'Needs Attention'}")
 
+    for alert in final_output.get("alerts", []):
+        st.error(f"🚨 **{alert['title']}** ({alert['priority']}): {alert['message']}")
+
     regular_tests = [t for t in final_output["tests"] if t['category'] == 'regular']
     periodic_tests = [t for t in final_output["tests"] if t['category'] == 'periodic']
 
@@ -511,6 +1046,13 @@ def display_dashboard(final_output, historical_data):
             with st.expander(f"Explanation for {test['test_name']}"):
                 st.write(test['explanation'])
 
+    if final_output.get("alarms"):
+        st.markdown("---")
+        st.subheader("💊 Prescriptions")
+        st.table(pd.DataFrame([[a["medicine"], a["dosage"], f"every {a['interval_hours']:g} h", a["next_dose"]]
+                               for a in final_output["alarms"]],
+                              columns=["Medicine", "Dosage", "Schedule", "Next Dose"]))
+
 # --- 1️⃣1️⃣: System Flow (Main App Logic) ---
 
 def main():
@@ -549,7 +1091,8 @@ def main():
                 return
 
             clean_text_data = clean_and_normalize_text(raw_text_data)
-            extracted_params = extract_parameters_with_ner(clean_text_data)
+            fields = extract_report_fields(clean_text_data)
+            extracted_params = fields["tests"]
             
             if not extracted_params:
                 st.error("No valid medical parameters were found. The report format might be unsupported.")
@@ -563,15 +1106,18 @@ def main():
             final_params = generate_explanations(analyzed_params, use_llm, api_key)
             score, emoji = calculate_health_score(final_params)
             
-            report_date = datetime.now().strftime("%Y-%m-%d")
+            report_date = fields["report_date"] or datetime.now().strftime("%Y-%m-%d")
             final_output = {
                 "patient_name": patient_name,
                 "report_date": report_date,
                 "health_score": (score, emoji),
-                "tests": final_params
+                "tests": final_params,
+                "prescriptions": fields["prescriptions"],
+                "alarms": schedule_alarms(fields["prescriptions"], report_date)
             }
             
-            save_report_to_db(patient_name, report_date, final_output)
+            save_report_to_db(patient_name, report_date, final_output,
+                              clean_text=clean_text_data.get("clean_text"))
             historical_reports = load_reports_from_db(patient_name)
             
         display_dashboard(final_output, historical_reports)
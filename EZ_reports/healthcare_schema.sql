@@ -193,6 +193,34 @@ CREATE TABLE IF NOT EXISTS staff (
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- =====================================================
+-- 11. REPORT RESULTS TABLE (Written by the analysis server)
+-- =====================================================
+CREATE TABLE IF NOT EXISTS report_results (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    report_id UUID NOT NULL REFERENCES medical_reports(id) ON DELETE CASCADE,
+    test_name TEXT NOT NULL,
+    value DOUBLE PRECISION, -- In the test's canonical unit
+    unit TEXT,
+    status TEXT, -- 'Normal', 'High', 'Low'
+    range_low DOUBLE PRECISION,
+    range_high DOUBLE PRECISION,
+    original_value DOUBLE PRECISION, -- As printed on the report
+    original_unit TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- =====================================================
+-- 12. REPORT ANALYSES TABLE (Full analysis, encrypted by the analysis server)
+-- =====================================================
+CREATE TABLE IF NOT EXISTS report_analyses (
+    report_id UUID PRIMARY KEY REFERENCES medical_reports(id) ON DELETE CASCADE,
+    report_data BYTEA NOT NULL,
+    key_version INTEGER,
+    health_score INTEGER,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
 -- =====================================================
 -- INDEXES FOR PERFORMANCE
 -- =====================================================
@@ -235,6 +263,10 @@ CREATE INDEX IF NOT EXISTS idx_notifications_patient_id ON notifications(patient
 CREATE INDEX IF NOT EXISTS idx_notifications_read ON notifications(is_read);
 CREATE INDEX IF NOT EXISTS idx_notifications_scheduled ON notifications(scheduled_at);
 
+-- Report results indexes
+CREATE INDEX IF NOT EXISTS idx_report_results_report_id ON report_results(report_id);
+CREATE INDEX IF NOT EXISTS idx_report_results_test ON report_results(test_name);
+
 -- =====================================================
 -- ROW LEVEL SECURITY (RLS) POLICIES
 -- =====================================================
@@ -250,6 +282,8 @@ ALTER TABLE health_tips ENABLE ROW LEVEL SECURITY;
 ALTER TABLE patient_health_tips ENABLE ROW LEVEL SECURITY;
 ALTER TABLE notifications ENABLE ROW LEVEL SECURITY;
 ALTER TABLE staff ENABLE ROW LEVEL SECURITY;
+ALTER TABLE report_results ENABLE ROW LEVEL SECURITY;
+ALTER TABLE report_analyses ENABLE ROW LEVEL SECURITY;
 
 -- Create policies for anonymous access (adjust based on your security requirements)
 CREATE POLICY "Allow all operations on patients" ON patients FOR ALL USING (true);
@@ -262,6 +296,7 @@ CREATE POLICY "Allow all operations on health_tips" ON health_tips FOR ALL USING
 CREATE POLICY "Allow all operations on patient_health_tips" ON patient_health_tips FOR ALL USING (true);
 CREATE POLICY "Allow all operations on notifications" ON notifications FOR ALL USING (true);
 CREATE POLICY "Allow all operations on staff" ON staff FOR ALL USING (true);
+CREATE POLICY "Allow all operations on report_results" ON report_results FOR ALL USING (true);
 
 -- =====================================================
 -- FUNCTIONS AND TRIGGERS
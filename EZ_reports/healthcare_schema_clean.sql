@@ -171,6 +171,30 @@ CREATE TABLE IF NOT EXISTS staff (
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- REPORT RESULTS TABLE
+CREATE TABLE IF NOT EXISTS report_results (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    report_id UUID NOT NULL REFERENCES medical_reports(id) ON DELETE CASCADE,
+    test_name TEXT NOT NULL,
+    value DOUBLE PRECISION,
+    unit TEXT,
+    status TEXT,
+    range_low DOUBLE PRECISION,
+    range_high DOUBLE PRECISION,
+    original_value DOUBLE PRECISION,
+    original_unit TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- REPORT ANALYSES TABLE
+CREATE TABLE IF NOT EXISTS report_analyses (
+    report_id UUID PRIMARY KEY REFERENCES medical_reports(id) ON DELETE CASCADE,
+    report_data BYTEA NOT NULL,
+    key_version INTEGER,
+    health_score INTEGER,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
 -- INDEXES FOR PERFORMANCE
 CREATE INDEX IF NOT EXISTS idx_patients_patient_id ON patients(patient_id);
 CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(first_name, last_name);
@@ -203,6 +227,9 @@ CREATE INDEX IF NOT EXISTS idx_notifications_patient_id ON notifications(patient
 CREATE INDEX IF NOT EXISTS idx_notifications_read ON notifications(is_read);
 CREATE INDEX IF NOT EXISTS idx_notifications_scheduled ON notifications(scheduled_at);
 
+CREATE INDEX IF NOT EXISTS idx_report_results_report_id ON report_results(report_id);
+CREATE INDEX IF NOT EXISTS idx_report_results_test ON report_results(test_name);
+
 -- ROW LEVEL SECURITY POLICIES
 ALTER TABLE patients ENABLE ROW LEVEL SECURITY;
 ALTER TABLE vitals ENABLE ROW LEVEL SECURITY;
@@ -214,6 +241,8 @@ ALTER TABLE health_tips ENABLE ROW LEVEL SECURITY;
 ALTER TABLE patient_health_tips ENABLE ROW LEVEL SECURITY;
 ALTER TABLE notifications ENABLE ROW LEVEL SECURITY;
 ALTER TABLE staff ENABLE ROW LEVEL SECURITY;
+ALTER TABLE report_results ENABLE ROW LEVEL SECURITY;
+ALTER TABLE report_analyses ENABLE ROW LEVEL SECURITY;
 
 -- CREATE POLICIES FOR ANONYMOUS ACCESS
 CREATE POLICY "Allow all operations on patients" ON patients FOR ALL USING (true);
@@ -226,6 +255,7 @@ CREATE POLICY "Allow all operations on health_tips" ON health_tips FOR ALL USING
 CREATE POLICY "Allow all operations on patient_health_tips" ON patient_health_tips FOR ALL USING (true);
 CREATE POLICY "Allow all operations on notifications" ON notifications FOR ALL USING (true);
 CREATE POLICY "Allow all operations on staff" ON staff FOR ALL USING (true);
+CREATE POLICY "Allow all operations on report_results" ON report_results FOR ALL USING (true);
 
 -- FUNCTIONS AND TRIGGERS
 CREATE OR REPLACE FUNCTION update_updated_at_column()
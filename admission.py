@@ -0,0 +1,220 @@
+"""
+Admission control and load shedding for the analysis API.
+
+Every request (except / and /health) is admitted into one of two lanes
+before its body is read:
+
+    ocr     file uploads to /analyze-report(/stream) and /export: OCR, table
+            extraction and bulk streaming, seconds of CPU each
+    cheap   text input, history, analytics, search, vitals: milliseconds
+
+Each lane runs at most N requests at once and queues at most Q more, in
+arrival order. A request arriving to a full queue is turned away at once
+with 429, and one that waits longer than ADMISSION_QUEUE_TIMEOUT seconds
+gets 503, so clients back off instead of timing out. Both carry a
+Retry-After estimated from the lane's recent service times. OCR requests
+are also refused with 503 while the machine is short of memory
+(ADMISSION_MIN_AVAILABLE_MB) or the worker has grown past
+ADMISSION_MAX_RSS_MB. Since the lanes are separate, a saturated OCR lane
+never delays the cheap one.
+
+    ADMISSION_OCR_CONCURRENCY    default: number of CPUs
+    ADMISSION_OCR_QUEUE          default: 2 per CPU
+    ADMISSION_CHEAP_CONCURRENCY  default 32
+    ADMISSION_CHEAP_QUEUE        default 128
+    ADMISSION_CONTROL=0          admit everything, as before
+
+Limits are per worker process.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+from starlette.responses import JSONResponse
+
+# Optional imports with fallback handling
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") != "0"
+CPUS = os.cpu_count() or 1
+OCR_CONCURRENCY = int(os.getenv("ADMISSION_OCR_CONCURRENCY", str(CPUS)))
+OCR_QUEUE = int(os.getenv("ADMISSION_OCR_QUEUE", str(2 * CPUS)))
+CHEAP_CONCURRENCY = int(os.getenv("ADMISSION_CHEAP_CONCURRENCY", "32"))
+CHEAP_QUEUE = int(os.getenv("ADMISSION_CHEAP_QUEUE", "128"))
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+MIN_AVAILABLE_MB = float(os.getenv("ADMISSION_MIN_AVAILABLE_MB", "256"))
+MAX_RSS_MB = float(os.getenv("ADMISSION_MAX_RSS_MB", "0"))
+
+EXEMPT_PATHS = ("/", "/health")
+MAX_RETRY_AFTER = 60
+
+
+def lane_capacity():
+    """Requests one worker holds, running or queued, before it starts answering 429 itself."""
+    return OCR_CONCURRENCY + OCR_QUEUE + CHEAP_CONCURRENCY + CHEAP_QUEUE
+
+
+class Overloaded(Exception):
+    """A request turned away: HTTP status, reason and Retry-After seconds."""
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def request_lane(scope):
+    """'ocr', 'cheap', or None for requests that are never limited."""
+    path = scope["path"]
+    if path in EXEMPT_PATHS:
+        return None
+    if path.startswith("/export/"):
+        return "ocr"
+    if path.startswith("/analyze-report"):
+        content_type = dict(scope["headers"]).get(b"content-type", b"")
+        return "ocr" if content_type.startswith(b"multipart/form-data") else "cheap"
+    return "cheap"
+
+
+def memory_pressure():
+    """Why the worker should not start more OCR right now, or None."""
+    if psutil is not None:
+        available_mb = psutil.virtual_memory().available / 2**20
+        rss_mb = psutil.Process().memory_info().rss / 2**20
+    else:
+        try:
+            with open("/proc/meminfo") as f:
+                meminfo = dict(line.split(":", 1) for line in f)
+            with open("/proc/self/statm") as f:
+                rss_pages = int(f.read().split()[1])
+        except (OSError, KeyError, ValueError):
+            return None
+        available_mb = int(meminfo["MemAvailable"].split()[0]) / 1024
+        rss_mb = rss_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    if MIN_AVAILABLE_MB and available_mb < MIN_AVAILABLE_MB:
+        return f"only {available_mb:.0f} MB of memory available"
+    if MAX_RSS_MB and rss_mb > MAX_RSS_MB:
+        return f"worker is using {rss_mb:.0f} MB"
+    return None
+
+
+class Lane:
+    """At most concurrency requests at once, with a bounded FIFO queue behind them."""
+
+    def __init__(self, name, concurrency, queue_limit, queue_timeout=QUEUE_TIMEOUT, seed_seconds=1.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()
+        # Moving average of how long an admitted request holds its slot
+        self.service_seconds = seed_seconds
+        self.admitted = self.rejected = self.timed_out = 0
+
+    def retry_after(self):
+        backlog = (self.active + len(self.waiters)) / max(self.concurrency, 1)
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(backlog * self.service_seconds)))
+
+    async def acquire(self):
+        """Waits for a slot. Raises Overloaded when the queue is full or the wait times out."""
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self.waiters) >= self.queue_limit:
+            self.rejected += 1
+            raise Overloaded(429, f"Too many {self.name} requests queued", self.retry_after())
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+
+        def expire():
+            if not waiter.done():
+                self.timed_out += 1
+                waiter.set_exception(Overloaded(503, f"Timed out in the {self.name} queue",
+                                                self.retry_after()))
+
+        timer = loop.call_later(self.queue_timeout, expire)
+        try:
+            await waiter
+        except BaseException:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # The slot was handed over just as the client went away
+                self.release()
+            raise
+        finally:
+            timer.cancel()
+        self.admitted += 1
+
+    def release(self, held_seconds=None):
+        if held_seconds is not None:
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * held_seconds
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the next request in line
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {"active": self.active, "queued": len(self.waiters), "concurrency": self.concurrency,
+                "queue_limit": self.queue_limit, "admitted": self.admitted, "rejected": self.rejected,
+                "timed_out": self.timed_out, "service_ms": round(self.service_seconds * 1000)}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware admitting requests through the lanes; a slot is held until the response is sent."""
+
+    def __init__(self, app, lanes=None):
+        self.app = app
+        self.lanes = lanes or {
+            "ocr": Lane("ocr", OCR_CONCURRENCY, OCR_QUEUE, seed_seconds=2.0),
+            "cheap": Lane("cheap", CHEAP_CONCURRENCY, CHEAP_QUEUE, seed_seconds=0.05),
+        }
+        ADMISSION_LANES.update(self.lanes)
+
+    async def __call__(self, scope, receive, send):
+        lane_name = request_lane(scope) if scope["type"] == "http" and ADMISSION_CONTROL else None
+        if lane_name is None:
+            await self.app(scope, receive, send)
+            return
+
+        lane = self.lanes[lane_name]
+        try:
+            if lane_name == "ocr":
+                pressure = memory_pressure()
+                if pressure:
+                    lane.rejected += 1
+                    raise Overloaded(503, f"Server is low on memory ({pressure})", lane.retry_after())
+            await lane.acquire()
+        except Overloaded as e:
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code,
+                                    headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lane.release(time.monotonic() - started)
+
+
+# Lanes of this worker, for /health
+ADMISSION_LANES = {}
+
+
+def admission_stats():
+    return {name: lane.stats() for name, lane in ADMISSION_LANES.items()}
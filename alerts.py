@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Critical-value alerts, evaluated when a report is saved.
+
+compute_health_status only says Low/High/Normal against the reference
+range. A critical value (Potassium above 6.0, INR above 4) needs someone to
+act on it now, so save_report_to_db runs every new report through the rules
+below, in the same transaction as the insert, and queues each alert in
+notification_outbox. The outbox is shaped like the notifications table of
+EZ_reports/healthcare_schema.sql; a delivery job sends pending rows and
+sets sent_at.
+
+Rules are indexed by test name (and by patient, for patient-specific
+rules), so a report costs one lookup per test plus the rules of that test,
+however many rules are active. Kinds:
+
+    above, below   the value is beyond threshold
+    delta          the value moved at least threshold since the patient's previous result
+    rate           the value moved at least threshold per day since the previous result
+
+delta and rate rules take "direction" (rise, fall or any; default rise) and
+"window_days" (previous results older than this are ignored). The previous
+result is looked up, by decrypting the patient's latest earlier reports,
+only when one of those rules matches a test in the report.
+
+Rules come from the JSON list in ALERT_RULES_FILE, or DEFAULT_RULES:
+
+    {"id": "potassium-high", "test": "Serum Potassium", "kind": "above",
+     "threshold": 6.0, "priority": "Urgent", "patient": "<optional name>"}
+
+    python alerts.py pending [--limit 50]    # queued notifications not yet sent
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+from datetime import date, datetime
+
+from analytics import patient_key
+
+KINDS = ("above", "below", "delta", "rate")
+DIRECTIONS = ("rise", "fall", "any")
+PRIORITIES = ("Low", "Medium", "High", "Urgent")
+NOTIFICATION_TYPE = "Lab Result"
+# Earlier reports searched for a test's previous result
+HISTORY_REPORTS = 5
+
+# Conservative starting points; sites should tune them through ALERT_RULES_FILE
+DEFAULT_RULES = [
+    {"id": "potassium-critical-high", "test": "Serum Potassium", "kind": "above", "threshold": 6.0, "priority": "Urgent"},
+    {"id": "potassium-critical-low", "test": "Serum Potassium", "kind": "below", "threshold": 2.8, "priority": "Urgent"},
+    {"id": "sodium-critical-high", "test": "Serum Sodium", "kind": "above", "threshold": 160, "priority": "Urgent"},
+    {"id": "sodium-critical-low", "test": "Serum Sodium", "kind": "below", "threshold": 120, "priority": "Urgent"},
+    {"id": "inr-critical-high", "test": "INR", "kind": "above", "threshold": 4.0, "priority": "Urgent"},
+    {"id": "hemoglobin-critical-low", "test": "Hemoglobin", "kind": "below", "threshold": 7.0, "priority": "Urgent"},
+    {"id": "platelets-critical-low", "test": "Platelet Count", "kind": "below", "threshold": 0.5, "priority": "Urgent"},
+    {"id": "hemoglobin-drop", "test": "Hemoglobin", "kind": "delta", "threshold": 2.0, "direction": "fall",
+     "window_days": 30, "priority": "High"},
+    # Acute kidney injury: creatinine up 0.3 mg/dl within 48 hours
+    {"id": "creatinine-acute-rise", "test": "Serum Creatinine", "kind": "delta", "threshold": 0.3, "direction": "rise",
+     "window_days": 2, "priority": "High"},
+    {"id": "creatinine-rising", "test": "Serum Creatinine", "kind": "rate", "threshold": 0.1, "direction": "rise",
+     "window_days": 7, "priority": "Medium"},
+]
+
+
+def validate_rule(rule, aliases=None):
+    """A normalized copy of rule, with its test name resolved through aliases. Raises ValueError."""
+    rule = dict(rule)
+    for field in ("id", "test", "kind", "threshold"):
+        if rule.get(field) in (None, ""):
+            raise ValueError(f"alert rule {rule.get('id', '?')} has no {field}")
+    if rule["kind"] not in KINDS:
+        raise ValueError(f"alert rule {rule['id']}: kind must be one of {', '.join(KINDS)}")
+    rule.setdefault("priority", "High")
+    if rule["priority"] not in PRIORITIES:
+        raise ValueError(f"alert rule {rule['id']}: priority must be one of {', '.join(PRIORITIES)}")
+    rule.setdefault("direction", "rise")
+    if rule["direction"] not in DIRECTIONS:
+        raise ValueError(f"alert rule {rule['id']}: direction must be one of {', '.join(DIRECTIONS)}")
+    rule["threshold"] = float(rule["threshold"])
+    rule["test"] = (aliases or {}).get(rule["test"], rule["test"])
+    return rule
+
+
+class AlertRules:
+    """Active rules indexed by (test name, patient key or None for everyone)."""
+
+    def __init__(self, rules, aliases=None):
+        self.by_test = {}
+        self.count = 0
+        for rule in rules:
+            rule = validate_rule(rule, aliases)
+            scope = patient_key(rule["patient"]) if rule.get("patient") else None
+            self.by_test.setdefault((rule["test"], scope), []).append(rule)
+            self.count += 1
+
+    def matching(self, test_name, patient):
+        """Rules for one test: those for everyone, then those for this patient (a patient_key)."""
+        general = self.by_test.get((test_name, None))
+        own = self.by_test.get((test_name, patient))
+        if general and own:
+            return general + own
+        return general or own or ()
+
+
+def load_rules(path=None, aliases=None):
+    """AlertRules from a JSON list of rules at path, or DEFAULT_RULES."""
+    if not path:
+        return AlertRules(DEFAULT_RULES, aliases)
+    with open(path, "r", encoding="utf-8") as f:
+        return AlertRules(json.load(f), aliases)
+
+
+def setup_alert_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY,
+            patient_id TEXT NOT NULL, report_id INTEGER, rule_id TEXT NOT NULL, test_name TEXT,
+            title TEXT NOT NULL, message TEXT NOT NULL, type TEXT NOT NULL,
+            priority TEXT NOT NULL DEFAULT 'Medium' CHECK (priority IN ('Low', 'Medium', 'High', 'Urgent')),
+            is_read INTEGER NOT NULL DEFAULT 0,
+            scheduled_at TEXT, sent_at TEXT, created_at TEXT NOT NULL
+        )
+    ''')
+    # Only unsent rows are indexed, so the delivery job's scan stays small
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending ON notification_outbox (id) "
+                 "WHERE sent_at IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_patient ON notification_outbox (patient_id)")
+
+
+def previous_values(conn, patient_id, report_date, test_names, decrypt_report):
+    """{test_name: (value, report_date)}: each test's latest result in the patient's earlier reports."""
+    found = {}
+    rows = conn.execute("SELECT report_date, report_data, key_version FROM patient_reports "
+                        "WHERE patient_id = ? AND report_date <= ? ORDER BY report_date DESC, id DESC LIMIT ?",
+                        (patient_id, report_date, HISTORY_REPORTS))
+    for previous_date, blob, key_version in rows:
+        try:
+            report = decrypt_report(blob, key_version)
+        except Exception:
+            continue
+        for test in report.get("tests", []):
+            name = test.get("test_name")
+            if name in test_names and name not in found and isinstance(test.get("value"), (int, float)):
+                found[name] = (float(test["value"]), previous_date)
+        if len(found) == len(test_names):
+            break
+    return found
+
+
+def parse_day(value):
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def format_value(value):
+    return f"{value:g}"
+
+
+def check_rule(rule, test, value, report_date, previous):
+    """(title, message) if the rule fires for this result, else None."""
+    name, unit = test["test_name"], test.get("unit") or ""
+    shown = f"{format_value(value)} {unit}".strip()
+    if rule["kind"] == "above":
+        if value > rule["threshold"]:
+            return f"Critical {name}", f"{name} is {shown}, above the critical limit of {format_value(rule['threshold'])}"
+        return None
+    if rule["kind"] == "below":
+        if value < rule["threshold"]:
+            return f"Critical {name}", f"{name} is {shown}, below the critical limit of {format_value(rule['threshold'])}"
+        return None
+
+    if previous is None:
+        return None
+    previous_value, previous_date = previous
+    today, then = parse_day(report_date), parse_day(previous_date)
+    if today is None or then is None or then > today:
+        return None
+    days = (today - then).days
+    if rule.get("window_days") is not None and days > rule["window_days"]:
+        return None
+    change = value - previous_value
+    amount = {"rise": change, "fall": -change, "any": abs(change)}[rule["direction"]]
+    moved = f"{'rose' if change > 0 else 'fell'} from {format_value(previous_value)} to {shown} since {then.isoformat()}"
+    if rule["kind"] == "delta":
+        if amount >= rule["threshold"]:
+            return f"{name} changed", f"{name} {moved}"
+        return None
+    # Results are dated by day, so two reports on the same day count as one day apart
+    per_day = amount / max(days, 1)
+    if per_day >= rule["threshold"]:
+        return f"{name} changing fast", f"{name} {moved} ({format_value(round(per_day, 3))} per day)"
+    return None
+
+
+def evaluate_alerts(rules, patient_name, report_date, tests, load_previous=None):
+    """
+    Alerts raised by one report's tests, at most one per rule:
+    [{rule_id, test_name, value, unit, priority, title, message}].
+    load_previous(test_names) -> {test_name: (value, report_date)} is only
+    called if a delta or rate rule matches.
+    """
+    patient = patient_key(patient_name)
+    matched, history_tests = [], set()
+    for test in tests:
+        value = test.get("value")
+        if not isinstance(value, (int, float)):
+            continue
+        for rule in rules.matching(test.get("test_name"), patient):
+            matched.append((rule, test, float(value)))
+            if rule["kind"] in ("delta", "rate"):
+                history_tests.add(test["test_name"])
+    if not matched:
+        return []
+
+    previous = load_previous(history_tests) if history_tests and load_previous else {}
+    alerts, fired = [], set()
+    for rule, test, value in matched:
+        if rule["id"] in fired:
+            continue
+        result = check_rule(rule, test, value, report_date, previous.get(test["test_name"]))
+        if result:
+            fired.add(rule["id"])
+            alerts.append({"rule_id": rule["id"], "test_name": test["test_name"], "value": value,
+                           "unit": test.get("unit"), "priority": rule["priority"],
+                           "title": result[0], "message": result[1]})
+    return alerts
+
+
+def queue_alerts(conn, report_id, patient_id, alerts):
+    """Writes alerts to the outbox. Runs inside the caller's transaction."""
+    created_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    conn.executemany('''
+        INSERT INTO notification_outbox (patient_id, report_id, rule_id, test_name, title, message, type,
+                                         priority, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(patient_id, report_id, alert["rule_id"], alert["test_name"], alert["title"], alert["message"],
+           NOTIFICATION_TYPE, alert["priority"], created_at) for alert in alerts])
+
+
+def pending_notifications(conn, limit=100):
+    """Unsent outbox rows, oldest first."""
+    rows = conn.execute('''
+        SELECT id, patient_id, report_id, rule_id, test_name, title, message, type, priority, created_at
+        FROM notification_outbox WHERE sent_at IS NULL ORDER BY id LIMIT ?
+    ''', (limit,))
+    columns = ("id", "patient_id", "report_id", "rule_id", "test_name", "title", "message", "type",
+               "priority", "created_at")
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def mark_sent(conn, notification_ids):
+    sent_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    with conn:
+        conn.executemany("UPDATE notification_outbox SET sent_at = ? WHERE id = ?",
+                         [(sent_at, notification_id) for notification_id in notification_ids])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("pending", help="list queued notifications that have not been sent")
+    p.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    from Aimodal import SHARD_FILES, setup_database
+    from sharding import fan_out
+
+    def shard_pending(db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            return pending_notifications(conn, args.limit)
+        finally:
+            conn.close()
+
+    setup_database()
+    # Outbox ids are per shard, so interleave the shards by creation time
+    notifications = sorted((item for shard in fan_out(shard_pending, SHARD_FILES) for item in shard),
+                           key=lambda item: item["created_at"])[:args.limit]
+    for item in notifications:
+        print(f"#{item['id']} [{item['priority']}] {item['patient_id']}: {item['message']} "
+              f"(report {item['report_id']}, {item['created_at']})")
+    print(f"{len(notifications)} pending")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
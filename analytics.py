@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Population rollups for abnormal-rate analytics.
+
+save_report_to_db calls update_rollups in the same transaction as the
+report insert, so the counters below never disagree with patient_reports
+and questions like "share of patients with high SGPT this month" are a
+primary-key range scan instead of decrypting every stored report.
+
+    test_rollups         (test, status, period, period_start, cohort) -> reports, patients
+    test_rollup_members  which patients are already counted in each bucket
+
+status "Any" counts every report/patient that had the test at all, which is
+the denominator for abnormal rates. Patients are identified by a hash of
+their patient_id.
+
+    python analytics.py rebuild      # recompute everything from patient_reports
+"""
+
+import hashlib
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+
+PERIODS = ("day", "week", "month")
+ALL_COHORTS = "all"
+ANY_STATUS = "Any"
+
+
+def setup_rollup_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS test_rollups (
+            test_name TEXT NOT NULL, status TEXT NOT NULL, period TEXT NOT NULL,
+            period_start TEXT NOT NULL, cohort TEXT NOT NULL,
+            reports INTEGER NOT NULL, patients INTEGER NOT NULL,
+            PRIMARY KEY (test_name, status, period, cohort, period_start)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS test_rollup_members (
+            test_name TEXT NOT NULL, status TEXT NOT NULL, period TEXT NOT NULL,
+            period_start TEXT NOT NULL, cohort TEXT NOT NULL, patient_key TEXT NOT NULL,
+            PRIMARY KEY (test_name, status, period, cohort, period_start, patient_key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS test_rollup_new_patient AFTER INSERT ON test_rollup_members
+        BEGIN
+            UPDATE test_rollups SET patients = patients + 1
+            WHERE test_name = NEW.test_name AND status = NEW.status AND period = NEW.period
+              AND cohort = NEW.cohort AND period_start = NEW.period_start;
+        END
+    ''')
+
+
+def patient_key(patient_name):
+    return hashlib.sha256(patient_name.strip().lower().encode("utf-8")).hexdigest()[:16]
+
+
+def period_starts(report_date):
+    """{"day": "2024-01-17", "week": "2024-01-15" (Monday), "month": "2024-01-01"}"""
+    day = date.fromisoformat(str(report_date)[:10])
+    return {
+        "day": day.isoformat(),
+        "week": (day - timedelta(days=day.weekday())).isoformat(),
+        "month": day.replace(day=1).isoformat(),
+    }
+
+
+def update_rollups(conn, patient_id, report_date, tests, cohort=None):
+    """
+    Adds one report to the rollups. Runs inside the caller's transaction.
+    A test listed several times in one report is counted once per status.
+    """
+    statuses = {(t["test_name"], t.get("status")) for t in tests if t.get("status")}
+    statuses |= {(test_name, ANY_STATUS) for test_name, _ in statuses}
+    cohorts = [ALL_COHORTS] + ([cohort] if cohort and cohort != ALL_COHORTS else [])
+    key = patient_key(patient_id)
+    buckets = [
+        (test_name, status, period, period_start, cohort_name)
+        for period, period_start in period_starts(report_date).items()
+        for test_name, status in statuses
+        for cohort_name in cohorts
+    ]
+    conn.executemany('''
+        INSERT INTO test_rollups (test_name, status, period, period_start, cohort, reports, patients)
+        VALUES (?, ?, ?, ?, ?, 1, 0)
+        ON CONFLICT(test_name, status, period, cohort, period_start) DO UPDATE SET reports = reports + 1
+    ''', buckets)
+    # The members trigger bumps `patients` only for patients new to a bucket
+    conn.executemany("INSERT OR IGNORE INTO test_rollup_members "
+                     "(test_name, status, period, period_start, cohort, patient_key) VALUES (?, ?, ?, ?, ?, ?)",
+                     [bucket + (key,) for bucket in buckets])
+
+
+def query_rollups(conn, test_name, status="High", period="month", start=None, end=None, cohort=ALL_COHORTS):
+    """
+    Per period between start and end (inclusive ISO dates): patients and
+    reports with the given status, out of all patients/reports with the test.
+    """
+    params = {"status": status, "any": ANY_STATUS, "test": test_name, "period": period, "cohort": cohort}
+    date_filter = ""
+    if start:
+        date_filter += " AND period_start >= :start"
+        params["start"] = period_starts(start)[period]
+    if end:
+        date_filter += " AND period_start <= :end"
+        params["end"] = period_starts(end)[period]
+
+    rows = conn.execute(f'''
+        SELECT period_start,
+               SUM(CASE WHEN status = :status THEN patients ELSE 0 END),
+               SUM(CASE WHEN status = :any THEN patients ELSE 0 END),
+               SUM(CASE WHEN status = :status THEN reports ELSE 0 END),
+               SUM(CASE WHEN status = :any THEN reports ELSE 0 END)
+        FROM test_rollups
+        WHERE test_name = :test AND period = :period AND cohort = :cohort
+              AND status IN (:status, :any){date_filter}
+        GROUP BY period_start ORDER BY period_start
+    ''', params).fetchall()
+
+    return [{
+        "period_start": period_start,
+        "patients": patients,
+        "patients_tested": patients_tested,
+        "patient_rate": round(100.0 * patients / patients_tested, 1) if patients_tested else 0.0,
+        "reports": reports,
+        "reports_tested": reports_tested,
+    } for period_start, patients, patients_tested, reports, reports_tested in rows]
+
+
+def merge_rollup_series(series):
+    """Adds up query_rollups results from several shards (whose patients never overlap) period by period."""
+    if len(series) == 1:
+        return series[0]
+    merged = {}
+    for rows in series:
+        for row in rows:
+            total = merged.setdefault(row["period_start"], dict.fromkeys(row, 0))
+            for field in ("patients", "patients_tested", "reports", "reports_tested"):
+                total[field] += row[field]
+            total["period_start"] = row["period_start"]
+    for total in merged.values():
+        total["patient_rate"] = (round(100.0 * total["patients"] / total["patients_tested"], 1)
+                                 if total["patients_tested"] else 0.0)
+    return [merged[period_start] for period_start in sorted(merged)]
+
+
+def rebuild_rollups(db_file, decrypt_report, batch_size=500):
+    """
+    Recomputes all rollups from patient_reports (decrypting every row) in one
+    transaction, so readers see either the old or the new counters.
+    Returns (reports_counted, reports_skipped).
+    """
+    conn = sqlite3.connect(db_file, timeout=30)
+    setup_rollup_tables(conn)
+    counted = skipped = 0
+    with conn:
+        conn.execute("DELETE FROM test_rollups")
+        conn.execute("DELETE FROM test_rollup_members")
+        cursor = conn.execute("SELECT patient_id, report_date, report_data, key_version, cohort "
+                              "FROM patient_reports ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for patient_id, report_date, blob, key_version, cohort in rows:
+                try:
+                    report = decrypt_report(blob, key_version)
+                    update_rollups(conn, patient_id, report_date, report.get("tests", []), cohort)
+                    counted += 1
+                except Exception:
+                    skipped += 1
+    conn.close()
+    return counted, skipped
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] != "rebuild":
+        print(__doc__)
+        return 1
+
+    from Aimodal import SHARD_FILES, decrypt_report, setup_database
+
+    setup_database()
+    started = time.perf_counter()
+    counted, skipped = (sum(totals) for totals in zip(*(rebuild_rollups(db_file, decrypt_report)
+                                                        for db_file in SHARD_FILES)))
+    print(f"Rebuilt rollups from {counted} reports in {time.perf_counter() - started:.1f}s"
+          f"{f' ({skipped} could not be decrypted)' if skipped else ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
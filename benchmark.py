@@ -0,0 +1,1086 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Medical Report AI backend.
+
+Usage:
+    python benchmark.py encoding
+    python benchmark.py ocr [CORPUS_DIR]
+    python benchmark.py ocr-backends [CORPUS_DIR]
+    python benchmark.py streaming [--pages 300] [--scanned]
+    python benchmark.py rotation [--rows 100000] [--workers N]
+    python benchmark.py storage [--reports 2000]
+    python benchmark.py fuzzy [CORPUS_DIR] [--reports 200] [--rate 0.3]
+    python benchmark.py analytics [--reports 100000]
+    python benchmark.py vitals [--samples 1000000] [--batch 250] [--patients 200]
+    python benchmark.py tables [CORPUS_DIR] [--pages 50]
+    python benchmark.py neardup [--reports 100000]
+    python benchmark.py export [--reports 30000] [--workers N] [--format parquet]
+    python benchmark.py search [--reports 100000]
+    python benchmark.py alerts [--rules 100000]
+    python benchmark.py units [--results 1000000]
+    python benchmark.py shards [--reports 2000] [--writers 8] [--shards 1,2,4]
+    python benchmark.py patients [--patients 100000]
+    python benchmark.py groupcommit [--reports 1000] [--concurrency 1,4,16,64]
+    python benchmark.py backends --dsn postgresql://localhost/ez [--reports 1000] [--patients 200] [--concurrency 1,8,32]
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+
+def timed(fn, repeat=200):
+    """Runs fn repeat times and returns (mean milliseconds, last result)."""
+    result = None
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / repeat, result
+
+
+def sample_report(history_size=5):
+    """Builds an analyze-report style payload from test_medical_report.txt."""
+    from Aimodal import (
+        clean_and_normalize_text,
+        extract_parameters_with_ner,
+        classify_tests,
+        compute_health_status,
+        generate_explanations,
+        calculate_health_score,
+    )
+
+    with open("test_medical_report.txt", "r", encoding="utf-8") as f:
+        raw_text = f.read()
+
+    params = extract_parameters_with_ner(clean_and_normalize_text({"raw_text": raw_text}))
+    params = generate_explanations(compute_health_status(classify_tests(params)))
+    score, emoji = calculate_health_score(params)
+    report = {
+        "patient_name": "Benchmark Patient",
+        "report_date": "2024-01-15",
+        "health_score": {"score": score, "emoji": emoji, "status": "Excellent"},
+        "tests": params,
+    }
+    report["historical_data"] = [
+        {"date": "2024-01-%02d" % (i + 1), "data": json.loads(json.dumps(report))}
+        for i in range(history_size)
+    ]
+    return report
+
+
+def bench_encoding(args):
+    """Serialization time and payload size of /analyze-report responses."""
+    import gzip
+    import response_encoding as enc
+
+    report = sample_report(args.history)
+    baseline = json.dumps(report).encode("utf-8")
+    compact = enc.dedupe_explanations(report)
+
+    candidates = [("json (current)", lambda: json.dumps(report).encode("utf-8"))]
+    if enc.orjson is not None:
+        candidates.append(("orjson", lambda: enc.orjson.dumps(report)))
+        candidates.append(("orjson + dedupe", lambda: enc.orjson.dumps(enc.dedupe_explanations(report))))
+    if enc.msgpack is not None:
+        candidates.append(("msgpack + dedupe", lambda: enc.msgpack.packb(compact, use_bin_type=True)))
+    if enc.cbor2 is not None:
+        candidates.append(("cbor + dedupe", lambda: enc.cbor2.dumps(compact)))
+
+    print(f"{'encoder':<22}{'ms/op':>10}{'bytes':>10}{'gzip':>10}{'br':>10}")
+    for name, fn in candidates:
+        ms, body = timed(fn, args.repeat)
+        gz = len(gzip.compress(body, compresslevel=enc.GZIP_LEVEL))
+        br = len(enc.brotli.compress(body, quality=enc.BROTLI_QUALITY)) if enc.brotli is not None else "-"
+        print(f"{name:<22}{ms:>10.3f}{len(body):>10}{gz:>10}{br:>10}")
+    print(f"baseline size: {len(baseline)} bytes")
+
+
+def corpus_files(corpus_dir, extensions=(".pdf", ".jpg", ".jpeg", ".png")):
+    """Lists report files under corpus_dir with one of the given extensions."""
+    paths = sorted(glob.glob(os.path.join(corpus_dir, "**", "*"), recursive=True))
+    return [p for p in paths if os.path.splitext(p)[1].lower() in extensions]
+
+
+def page_images(path):
+    """Renders every page of a report file to a preprocessed PIL image."""
+    import fitz  # PyMuPDF
+    from ocr_preprocessing import open_image, preprocess_for_ocr, render_page_for_ocr
+
+    if path.lower().endswith(".pdf"):
+        doc = fitz.open(path)
+        images = [render_page_for_ocr(page) for page in doc]
+        doc.close()
+        return images
+    return [preprocess_for_ocr(open_image(path))]
+
+
+def ocr_file(path, backend=None):
+    """OCRs every page of a report file, returning (text, pages)."""
+    from ocr_engine import ocr_image
+
+    images = page_images(path)
+    return "".join(ocr_image(img, backend) for img in images), len(images)
+
+
+def found_tests(text):
+    """Set of (test_name, value) pairs the regex extractor finds in text."""
+    from Aimodal import clean_and_normalize_text, extract_parameters_with_ner
+    params = extract_parameters_with_ner(clean_and_normalize_text({"raw_text": text}))
+    return {(p["test_name"], p["value"]) for p in params}
+
+
+def bench_ocr(args):
+    """OCR time per page and extraction recall with and without preprocessing."""
+    import ocr_preprocessing
+
+    files = corpus_files(args.corpus)
+    if not files:
+        print(f"No PDF/image files found under {args.corpus}")
+        return
+
+    print(f"{'file':<36}{'raw s/page':>12}{'prep s/page':>13}{'recall':>9}")
+    total_raw = total_prep = total_pages = 0.0
+    hits = expected = 0
+    for path in files:
+        ocr_preprocessing.PREPROCESS_ENABLED = False
+        start = time.perf_counter()
+        raw_text, pages = ocr_file(path)
+        raw_time = time.perf_counter() - start
+
+        ocr_preprocessing.PREPROCESS_ENABLED = True
+        start = time.perf_counter()
+        prep_text, _ = ocr_file(path)
+        prep_time = time.perf_counter() - start
+
+        baseline, candidate = found_tests(raw_text), found_tests(prep_text)
+        recall = len(baseline & candidate) / len(baseline) if baseline else 1.0
+        hits += len(baseline & candidate)
+        expected += len(baseline)
+        total_raw, total_prep, total_pages = total_raw + raw_time, total_prep + prep_time, total_pages + pages
+        print(f"{os.path.basename(path)[:35]:<36}{raw_time / pages:>12.2f}{prep_time / pages:>13.2f}{recall:>9.0%}")
+
+    overall = hits / expected if expected else 1.0
+    print(f"{'TOTAL':<36}{total_raw / total_pages:>12.2f}{total_prep / total_pages:>13.2f}{overall:>9.0%}")
+
+
+def bench_ocr_backends(args):
+    """Per-page OCR latency of each installed backend, single- and multi-page."""
+    from ocr_engine import available_backends, get_ocr_engine
+
+    files = corpus_files(args.corpus)
+    if not files:
+        print(f"No PDF/image files found under {args.corpus}")
+        return
+    documents = [page_images(path) for path in files]
+    pages = [img for images in documents for img in images]
+
+    print(f"{'backend':<14}{'first call ms':>15}{'1-page ms':>12}{'multi-page ms/page':>20}")
+    for backend in available_backends():
+        engine = get_ocr_engine(backend)
+        start = time.perf_counter()
+        engine.image_to_string(pages[0])
+        first = (time.perf_counter() - start) * 1000
+
+        single, _ = timed(lambda: [engine.image_to_string(images[0]) for images in documents], args.repeat)
+        multi, _ = timed(lambda: [engine.image_to_string(img) for img in pages], args.repeat)
+        print(f"{backend:<14}{first:>15.1f}{single / len(documents):>12.1f}{multi / len(pages):>20.1f}")
+
+
+def synthetic_pdf(pages, scanned=False):
+    """Builds an in-memory multi-page lab report PDF, optionally image-only."""
+    import fitz  # PyMuPDF
+
+    with open("test_medical_report.txt", "r", encoding="utf-8") as f:
+        body = f.read()
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_text((50, 60), f"Page {number + 1}\n{body}", fontsize=9)
+        if scanned:
+            pix = page.get_pixmap(dpi=150)
+            doc.delete_page(-1)
+            doc.new_page().insert_image(fitz.Rect(0, 0, 595, 842), pixmap=pix)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _streaming_worker(mode, pdf_bytes, queue):
+    import resource
+    from page_stream import iter_page_text
+    from Aimodal import clean_and_normalize_text, extract_parameters_with_ner, iter_page_parameters
+
+    start = time.perf_counter()
+    first_result = None
+    if mode == "whole":
+        raw_text = ""
+        for page_text in iter_page_text(pdf_bytes, "report.pdf"):
+            raw_text += page_text
+        params = extract_parameters_with_ner(clean_and_normalize_text({"raw_text": raw_text}))
+        first_result = time.perf_counter() - start
+    else:
+        for progress in iter_page_parameters(iter_page_text(pdf_bytes, "report.pdf")):
+            if first_result is None and progress["tests"]:
+                first_result = time.perf_counter() - start
+            params = progress["tests"]
+    total = time.perf_counter() - start
+    queue.put((first_result, total, len(params), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def bench_streaming(args):
+    """Peak RSS and time to first result: whole-document vs page-streaming extraction."""
+    import multiprocessing
+
+    pdf_bytes = synthetic_pdf(args.pages, args.scanned)
+    print(f"{args.pages}-page {'scanned' if args.scanned else 'text'} PDF, {len(pdf_bytes) / 1e6:.1f} MB")
+    print(f"{'mode':<12}{'first result s':>16}{'total s':>10}{'tests':>8}{'peak RSS MB':>14}")
+    ctx = multiprocessing.get_context("spawn")
+    for mode in ("whole", "streaming"):
+        queue = ctx.Queue()
+        worker = ctx.Process(target=_streaming_worker, args=(mode, pdf_bytes, queue))
+        worker.start()
+        first_result, total, tests, max_rss_kb = queue.get()
+        worker.join()
+        print(f"{mode:<12}{first_result or 0:>16.2f}{total:>10.2f}{tests:>8}{max_rss_kb / 1024:>14.1f}")
+
+
+def bench_rotation(args):
+    """Key-rotation throughput on a synthetic patient_reports table."""
+    import sqlite3
+    import tempfile
+    from cryptography.fernet import Fernet
+    from key_rotation import rotate_keys
+
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    old_cipher = Fernet(old_key)
+    blob = json.dumps(sample_report(history_size=0)).encode()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "rotation.db")
+        conn = sqlite3.connect(db_file)
+        conn.execute("CREATE TABLE patient_reports (id INTEGER PRIMARY KEY, patient_id TEXT, "
+                     "report_date DATE, report_data BLOB, key_version INTEGER, text_data BLOB)")
+        conn.executemany("INSERT INTO patient_reports (patient_id, report_date, report_data, key_version) "
+                         "VALUES (?, ?, ?, 1)",
+                         ((f"P-2024-{i % 1000:010d}", "2024-01-15", old_cipher.encrypt(blob)) for i in range(args.rows)))
+        conn.commit()
+        conn.close()
+
+        start = time.perf_counter()
+        rotated, _ = rotate_keys(db_file, {2: new_key, 1: old_key}, 2, args.chunk, args.workers, args.rate)
+        elapsed = time.perf_counter() - start
+        print(f"{rotated} rows in {elapsed:.1f}s = {rotated / elapsed:.0f} rows/s")
+
+
+def bench_storage(args):
+    """DB size and save/load latency: legacy Fernet JSON vs the compact v2 format."""
+    import sqlite3
+    import tempfile
+    from cryptography.fernet import Fernet
+    import report_codec
+    from Aimodal import EXPLANATION_CATALOGUE, EXPLANATION_REFS, default_explanation
+
+    key = Fernet.generate_key()
+    report = sample_report(history_size=0)
+
+    print(f"{'format':<10}{'bytes/report':>14}{'db MB':>10}{'save ms':>10}{'load ms':>10}")
+    for storage_format in ("fernet", "v2"):
+        report_codec.REPORT_STORAGE_FORMAT = storage_format
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, "storage.db")
+            conn = sqlite3.connect(db_file)
+            conn.execute("CREATE TABLE patient_reports (id INTEGER PRIMARY KEY, patient_id TEXT, "
+                         "report_date DATE, report_data BLOB, key_version INTEGER)")
+
+            start = time.perf_counter()
+            for i in range(args.reports):
+                blob = report_codec.encode_report(report, key, EXPLANATION_REFS)
+                conn.execute("INSERT INTO patient_reports (patient_id, report_date, report_data, key_version) "
+                             "VALUES (?, ?, ?, 1)", (f"patient {i % 100}", "2024-01-15", blob))
+            conn.commit()
+            save_ms = (time.perf_counter() - start) * 1000 / args.reports
+
+            start = time.perf_counter()
+            rows = conn.execute("SELECT report_data FROM patient_reports").fetchall()
+            for (blob,) in rows:
+                report_codec.decode_report(blob, [key], EXPLANATION_CATALOGUE, default_explanation)
+            load_ms = (time.perf_counter() - start) * 1000 / args.reports
+            conn.execute("VACUUM")
+            conn.close()
+
+            print(f"{storage_format:<10}{len(blob):>14}{os.path.getsize(db_file) / 1e6:>10.2f}"
+                  f"{save_ms:>10.3f}{load_ms:>10.3f}")
+
+
+OCR_CONFUSIONS = [("l", "1"), ("i", "l"), ("o", "0"), ("in", "m"), ("rn", "m"), ("e", "c"), ("t", "f")]
+
+
+def garble_word(word, rng):
+    """Applies one OCR-style error (confusion, dropped or doubled letter) to word."""
+    confusions = [(a, b) for a, b in OCR_CONFUSIONS if a in word]
+    choice = rng.random()
+    if confusions and choice < 0.5:
+        a, b = rng.choice(confusions)
+        return word.replace(a, b, 1)
+    i = rng.randrange(1, len(word) - 1)
+    if choice < 0.75:
+        return word[:i] + word[i + 1:]
+    return word[:i] + word[i] + word[i:]
+
+
+def garble_text(text, rate, rng):
+    """Garbles roughly rate of the alphabetic words (4+ letters) in text."""
+    import re
+    return re.sub(r"[A-Za-z]{4,}", lambda m: garble_word(m.group(0), rng) if rng.random() < rate else m.group(0), text)
+
+
+def bench_fuzzy(args):
+    """Extraction recall on garbled reports with/without fuzzy names, and lookup throughput."""
+    import random
+    import Aimodal
+    from fuzzy_names import FuzzyNameIndex, edit_distance, normalize_name
+
+    fuzzy_index = Aimodal.FUZZY_NAME_INDEX
+    exact_index = FuzzyNameIndex({name: name for name in Aimodal.MEDICAL_TESTS}, max_distance=0)
+
+    def recall_with(index, texts, truth):
+        Aimodal.FUZZY_NAME_INDEX = index
+        hits = sum(len(truth & found_tests(text)) for text in texts)
+        Aimodal.FUZZY_NAME_INDEX = fuzzy_index
+        return hits
+
+    files = corpus_files(args.corpus, (".txt",)) if args.corpus else []
+    if files:
+        # Real OCR output has no ground truth: report tests found per mode
+        texts = []
+        for path in files:
+            with open(path, "r", encoding="utf-8") as f:
+                texts.append(f.read())
+        for label, index in (("exact", exact_index), ("fuzzy", fuzzy_index)):
+            Aimodal.FUZZY_NAME_INDEX = index
+            found = sum(len(found_tests(text)) for text in texts)
+            print(f"{label:<8}{found:>8} tests found in {len(texts)} reports")
+        Aimodal.FUZZY_NAME_INDEX = fuzzy_index
+    else:
+        rng = random.Random(42)
+        with open("test_medical_report.txt", "r", encoding="utf-8") as f:
+            clean = f.read()
+        truth = found_tests(clean)
+        texts = [garble_text(clean, args.rate, rng) for _ in range(args.reports)]
+        expected = len(truth) * len(texts)
+        print(f"{args.reports} synthetic reports, {args.rate:.0%} of words garbled, {len(truth)} tests each")
+        for label, index in (("exact", exact_index), ("fuzzy", fuzzy_index)):
+            print(f"{label:<8}recall {recall_with(index, texts, truth) / expected:>6.1%}")
+
+    # Lookup throughput: deletion index vs scanning the whole catalogue
+    rng = random.Random(7)
+    names = list(fuzzy_index.canonical)
+    queries = [garble_word(name, rng) if len(name) > 3 else name for name in names * 20]
+
+    def brute_force(query):
+        query = normalize_name(query)
+        return min(names, key=lambda name: edit_distance(query, name, 2))
+
+    for label, fn in (("index", fuzzy_index.lookup), ("scan", brute_force)):
+        start = time.perf_counter()
+        for query in queries:
+            fn(query)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<8}{len(queries) / elapsed:>10.0f} lookups/s ({len(names)} catalogue names)")
+
+
+def bench_analytics(args):
+    """Rollup update cost per saved report and query latency as the archive grows."""
+    import random
+    import sqlite3
+    import tempfile
+    from datetime import date, timedelta
+    from analytics import query_rollups, setup_rollup_tables, update_rollups
+
+    tests = sample_report(history_size=0)["tests"]
+    rng = random.Random(3)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "analytics.db"))
+        setup_rollup_tables(conn)
+        print(f"{'reports':>10}{'update ms':>11}{'query ms':>10}")
+        done, checkpoint = 0, 1000
+        while done < args.reports:
+            start = time.perf_counter()
+            with conn:
+                for i in range(done, checkpoint):
+                    for test in tests:
+                        test["status"] = rng.choice(("Low", "Normal", "Normal", "High"))
+                    report_date = date(2023, 1, 1) + timedelta(days=rng.randrange(730))
+                    update_rollups(conn, f"patient {rng.randrange(args.reports // 5 + 1)}", report_date.isoformat(),
+                                   tests, rng.choice((None, "clinicA", "clinicB")))
+            update_ms = (time.perf_counter() - start) * 1000 / (checkpoint - done)
+            done = checkpoint
+
+            query_ms, rows = timed(lambda: query_rollups(conn, "SGPT", "High", "month", "2024-01-01", "2024-12-31"), 50)
+            print(f"{done:>10}{update_ms:>11.3f}{query_ms:>10.3f}")
+            checkpoint = min(args.reports, checkpoint * 10)
+        conn.close()
+
+
+def bench_vitals(args):
+    """Vitals ingestion rate (samples/s) through the write-behind queue, batched inserts and rollups."""
+    import random
+    import tempfile
+    from vitals import VitalsStore
+
+    rng = random.Random(5)
+    metrics = ("heart_rate", "oxygen_saturation", "glucose_level")
+    start_ts = time.time() - args.samples // args.patients
+    with tempfile.TemporaryDirectory() as tmp:
+        store = VitalsStore(os.path.join(tmp, "vitals.db"), flush_interval=0)
+        batches = []
+        for i in range(0, args.samples, args.batch):
+            patient = f"patient-{rng.randrange(args.patients)}"
+            ts = start_ts + i / args.patients
+            batches.append((patient, [{"metric": metrics[j % 3], "value": 60 + rng.random() * 40, "ts": ts + j * 0.01}
+                                      for j in range(args.batch)]))
+
+        start = time.perf_counter()
+        for patient, samples in batches:
+            store.ingest(patient, samples)
+        store.flush()
+        elapsed = time.perf_counter() - start
+        total = len(batches) * args.batch
+        print(f"{total} samples in {len(batches)} batches: {total / elapsed:,.0f} samples/s")
+
+        rollups = store.conn.execute("SELECT COUNT(*) FROM vital_rollups").fetchone()[0]
+        query_ms, series = timed(lambda: store.series("patient-0", "heart_rate", "hour"), 50)
+        print(f"{rollups} rollup rows; hourly series for one patient: {len(series)} buckets in {query_ms:.2f} ms")
+        store.close()
+
+
+LAB_TABLE_ROWS = [
+    ("Haemoglobin (Hb)", "11.2", "L", "g/dL", "12.0 - 15.0"),
+    ("Total WBC Count", "7800", "", "cells/cu mm", "4000 - 10000"),
+    ("Platelet Count", "2.1", "", "lacs/cu mm", "1.5 - 4.1"),
+    ("Lymphocytes", "38", "", "%", "20 - 40"),
+    ("Monocytes", "6", "", "%", "2 - 10"),
+    ("Serum Creatinine", "1.4", "H", "mg/dL", "0.5 - 1.1"),
+    ("Blood Urea", "18", "", "mg/dL", "15 - 40"),
+    ("Serum Sodium", "139", "", "mmol/L", "136 - 145"),
+    ("SGOT (AST)", "45", "H", "U/L", "< 35"),
+    ("SGPT (ALT)", "30", "", "U/L", "< 35"),
+    ("Vitamin D, 25-Hydroxy", "18.4", "L", "ng/mL", "30 - 100"),
+    ("Albumin", "4.1", "", "g/dL", "3.5 - 5.2"),
+]
+LAB_TABLE_TRUTH = {"Hemoglobin": 11.2, "Platelet Count": 2.1, "Lymphocytes": 38.0, "Monocytes": 6.0,
+                   "Serum Creatinine": 1.4, "Blood Urea": 18.0, "Serum Sodium": 139.0, "SGOT": 45.0,
+                   "SGPT": 30.0, "Albumin": 4.1}
+
+
+def lab_table_pdf(pages):
+    """Builds a born-digital PDF with a Test / Result / Unit / Reference Range table per page."""
+    import fitz  # PyMuPDF
+
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_text((40, 50), f"DEPARTMENT OF BIOCHEMISTRY    Page {number + 1} of {pages}", fontsize=10)
+        y = 90
+        for x, title in ((40, "Test Name"), (230, "Result"), (300, "Flag"), (340, "Unit"), (430, "Biological Ref. Interval")):
+            page.insert_text((x, y), title, fontsize=9)
+        for name, value, flag, unit, ref in LAB_TABLE_ROWS:
+            y += 18
+            for x, text in ((40, name), (230, value), (300, flag), (340, unit), (430, ref)):
+                if text:
+                    page.insert_text((x, y), text, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def bench_tables(args):
+    """Layout-aware table extraction vs regex over flattened text: speed, precision, recall."""
+    from Aimodal import MEDICAL_TESTS, iter_page_parameters, iter_table_parameters
+    from page_stream import iter_page_text
+
+    def final_tests(events):
+        tests = []
+        for progress in events:
+            tests = progress["tests"]
+        return tests
+
+    def score(tests):
+        # Catalogue results only (the table pass also keeps other rows that print a
+        # range); each true result counts once per page, so duplicates are misses
+        found = Counter((t["test_name"], t["value"]) for t in tests if t["test_name"] in MEDICAL_TESTS)
+        hits = sum(min(count, args.pages) for (name, value), count in found.items()
+                   if LAB_TABLE_TRUTH.get(name) == value)
+        total = sum(found.values())
+        return (hits / total if total else 0.0), hits / (len(LAB_TABLE_TRUTH) * args.pages)
+
+    if args.corpus:
+        # Real lab PDFs: no ground truth, so compare the two modes' output
+        for path in corpus_files(args.corpus, (".pdf",)):
+            with open(path, "rb") as f:
+                data = f.read()
+            table_ms, table = timed(lambda: final_tests(iter_table_parameters(data)), 3)
+            regex_ms, regex = timed(lambda: final_tests(iter_page_parameters(iter_page_text(data, "r.pdf"))), 3)
+            print(f"{os.path.basename(path)[:35]:<36}table {len(table):>3} tests {table_ms:>7.1f} ms   "
+                  f"regex {len(regex):>3} tests {regex_ms:>7.1f} ms")
+        return
+
+    data = lab_table_pdf(args.pages)
+    print(f"{args.pages}-page lab table PDF, {len(LAB_TABLE_TRUTH)} catalogue results per page")
+    print(f"{'mode':<8}{'ms':>9}{'tests':>8}{'precision':>11}{'recall':>8}{'printed ranges':>16}")
+    for mode, run in (("table", lambda: final_tests(iter_table_parameters(data))),
+                      ("regex", lambda: final_tests(iter_page_parameters(iter_page_text(data, "report.pdf"))))):
+        elapsed_ms, tests = timed(run, 3)
+        precision, recall = score(tests)
+        # Serum Creatinine prints 0.5 - 1.1; the catalogue says 0.6 - 1.2
+        with_printed = sum(1 for t in tests if t["test_name"] == "Serum Creatinine" and t["range_high"] == 1.1)
+        print(f"{mode:<8}{elapsed_ms:>9.1f}{len(tests):>8}{precision:>11.0%}{recall:>8.0%}"
+              f"{with_printed / args.pages:>16.0%}")
+
+
+def bench_neardup(args):
+    """MinHash signature cost and near-duplicate lookup latency as the archive grows, vs a linear scan."""
+    import random
+    import re
+    import sqlite3
+    import tempfile
+    import numpy as np
+    from near_duplicates import (NUM_PERM, find_near_duplicates, minhash, patient_key, setup_signature_tables,
+                                 similarity, store_signature)
+
+    with open("test_medical_report.txt", "r", encoding="utf-8") as f:
+        text = f.read()
+    rng = random.Random(11)
+
+    def new_report():
+        # Same lab template, different results: what a patient's real history looks like
+        return re.sub(r"\d+(\.\d+)?", lambda m: f"{float(m.group(0)) * rng.uniform(0.8, 1.2):.{1 if m.group(1) else 0}f}", text)
+
+    signature_ms, _ = timed(lambda: minhash(text), 50)
+    print(f"Signature: {signature_ms:.2f} ms for a {len(text)}-character report")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "neardup.db"))
+        setup_signature_tables(conn)
+        key = patient_key("Query Patient")
+        history, report_id, checkpoint = [], 0, 1000
+        print(f"{'archive':>10}{'history':>9}{'lookup ms':>11}{'scan ms':>9}{'candidates':>12}{'found':>7}")
+        while report_id < args.reports:
+            with conn:
+                while report_id < checkpoint:
+                    report_id += 1
+                    if report_id % 100 == 1:
+                        # 1% of the archive belongs to the query patient
+                        history.append((report_id, new_report()))
+                        store_signature(conn, report_id, "Query Patient", minhash(history[-1][1]))
+                    else:
+                        random_signature = np.frombuffer(rng.randbytes(NUM_PERM * 4), dtype=np.uint32)
+                        store_signature(conn, report_id, f"patient {rng.randrange(args.reports // 10)}", random_signature)
+
+            target_id, target_text = rng.choice(history)
+            query = minhash(garble_text(target_text, 0.1, rng))
+
+            def scan():
+                rows = conn.execute("SELECT report_id, signature FROM report_signatures WHERE patient_key = ?", (key,))
+                return [(rid, similarity(query, np.frombuffer(blob, dtype=np.uint32))) for rid, blob in rows]
+
+            lookup_ms, matches = timed(lambda: find_near_duplicates(conn, "Query Patient", query, threshold=0.0), 20)
+            scan_ms, _ = timed(scan, 5)
+            found = bool(matches) and max(matches, key=lambda m: m[1])[0] == target_id
+            print(f"{report_id:>10}{len(history):>9}{lookup_ms:>11.2f}{scan_ms:>9.2f}{len(matches):>12}{'yes' if found else 'no':>7}")
+            checkpoint = min(args.reports, checkpoint * 10)
+        conn.close()
+
+
+def bench_export(args):
+    """Full and incremental columnar export throughput (results/s) and peak memory."""
+    import random
+    import resource
+    import sqlite3
+    import tempfile
+    from datetime import date, timedelta
+    from cryptography.fernet import Fernet
+    from report_codec import encode_report, encode_text
+    from Aimodal import EXPLANATION_REFS
+    from export import export_results
+    from patient_ids import blind_index, get_or_create_patient, index_key, setup_patient_tables
+
+    key = Fernet.generate_key()
+    name_key = index_key(key)
+    report = sample_report(history_size=0)
+    rng = random.Random(7)
+
+    def add_reports(conn, count):
+        rows = []
+        with conn:
+            for _ in range(count):
+                for test in report["tests"]:
+                    test["value"] = round(test["value"] * rng.uniform(0.9, 1.1), 2)
+                report_date = (date(2023, 1, 1) + timedelta(days=rng.randrange(730))).isoformat()
+                name = f"patient {rng.randrange(count // 5 + 1)}"
+                patient_id = get_or_create_patient(conn, blind_index(name_key, name), name,
+                                                   lambda name: (encode_text(name, key), 1))
+                rows.append((patient_id, report_date, encode_report(report, key, EXPLANATION_REFS)))
+            conn.executemany("INSERT INTO patient_reports (patient_id, report_date, report_data, key_version) "
+                             "VALUES (?, ?, ?, 1)", rows)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "export.db")
+        conn = sqlite3.connect(db_file)
+        conn.execute("CREATE TABLE patient_reports (id INTEGER PRIMARY KEY, patient_id TEXT, "
+                     "report_date DATE, report_data BLOB, key_version INTEGER, cohort TEXT)")
+        setup_patient_tables(conn)
+        add_reports(conn, args.reports)
+        out_dir = os.path.join(tmp, "out")
+
+        print(f"{'run':<13}{'reports':>9}{'results':>10}{'files':>7}{'seconds':>9}{'results/s':>11}")
+        for run, new_reports in (("full", 0), ("incremental", args.reports // 100), ("no change", 0)):
+            if new_reports:
+                add_reports(conn, new_reports)
+            start = time.perf_counter()
+            summary = export_results(db_file, {1: key}, out_dir, args.format, chunk_size=args.chunk,
+                                     workers=args.workers)
+            elapsed = time.perf_counter() - start
+            print(f"{run:<13}{summary['reports']:>9}{summary['results']:>10}{len(summary['files']):>7}"
+                  f"{elapsed:>9.2f}{summary['results'] / max(elapsed, 1e-9):>11.0f}")
+        conn.close()
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"Peak RSS of the exporting process: {peak_mb:.0f} MB")
+
+
+def bench_search(args):
+    """Indexing rate and full-text query latency (global, per-patient, phrase) as the archive grows."""
+    import random
+    import re
+    import sqlite3
+    import tempfile
+    from cryptography.fernet import Fernet
+    from report_codec import encode_text
+    from patient_ids import blind_index, get_or_create_patient, index_key, setup_patient_tables
+    from search_index import index_report, search, search_key, setup_search_tables
+
+    with open("test_medical_report.txt", "r", encoding="utf-8") as f:
+        text = f.read()
+    fernet_key = Fernet.generate_key()
+    key, name_key = search_key(fernet_key), index_key(fernet_key)
+    rng = random.Random(5)
+    findings = ["no abnormality detected", "fatty liver grade I", "mild hepatomegaly", "renal calculus noted",
+                "normal study", "borderline cardiomegaly", "early fatty liver changes"]
+    doctors = ["Dr. Mehta", "Dr. Iyer", "Dr. Khan", "Dr. Das", "Dr. Fernandes", "Dr. Rao"]
+
+    def new_report():
+        body = re.sub(r"\d+(\.\d+)?", lambda m: f"{float(m.group(0)) * rng.uniform(0.8, 1.2):.1f}", text)
+        return f"{body}\nImpression: {rng.choice(findings)}. Reported by {rng.choice(doctors)}"
+
+    queries = [("common word", "hemoglobin", None), ("phrase", '"fatty liver"', None),
+               ("two words", "hepatomegaly mehta", None), ("per patient", '"fatty liver"', "patient 7")]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "search.db"))
+        conn.execute("CREATE TABLE patient_reports (id INTEGER PRIMARY KEY, patient_id TEXT, "
+                     "report_date DATE, text_data BLOB, key_version INTEGER)")
+        setup_patient_tables(conn)
+        setup_search_tables(conn)
+        print(f"{'archive':>10}{'index/s':>9}" + "".join(f"{label + ' ms':>16}" for label, _, _ in queries)
+              + f"{'phrase hits':>12}")
+        report_id, checkpoint = 0, 1000
+        while report_id < args.reports:
+            start = time.perf_counter()
+            added = checkpoint - report_id
+            with conn:
+                while report_id < checkpoint:
+                    report_id += 1
+                    patient, report_text = f"patient {rng.randrange(args.reports // 20 + 1)}", new_report()
+                    patient_id = get_or_create_patient(conn, blind_index(name_key, patient), patient,
+                                                       lambda name: (encode_text(name, fernet_key), 1))
+                    conn.execute("INSERT INTO patient_reports VALUES (?, ?, '2024-01-01', ?, 1)",
+                                 (report_id, patient_id, encode_text(report_text, fernet_key)))
+                    index_report(conn, report_id, patient, report_text, key)
+            rate = added / (time.perf_counter() - start)
+
+            row, phrase_hits = f"{report_id:>10}{rate:>9.0f}", 0
+            for label, query, patient in queries:
+                ms, found = timed(lambda: search(conn, key, {1: fernet_key}, query, patient), 20)
+                row += f"{ms:>16.2f}"
+                if label == "phrase":
+                    phrase_hits = found["total"]
+            print(row + f"{phrase_hits:>12}")
+            checkpoint = min(args.reports, checkpoint * 10)
+        conn.close()
+
+
+def bench_alerts(args):
+    """Per-report alert rule evaluation cost as the number of active rules grows, vs scanning every rule."""
+    import random
+    from alerts import DEFAULT_RULES, AlertRules, check_rule, evaluate_alerts, patient_key
+    from Aimodal import MEDICAL_TESTS
+
+    report = sample_report(history_size=0)
+    tests = report["tests"]
+    previous = {test["test_name"]: (test["value"] * 0.8, "2024-01-01") for test in tests}
+    rng = random.Random(3)
+    kinds = ("above", "below", "delta", "rate")
+
+    def make_rules(count):
+        # The defaults, then patient-specific rules spread over many patients and every catalogue test
+        rules = list(DEFAULT_RULES)
+        while len(rules) < count:
+            rules.append({"id": f"rule-{len(rules)}", "test": rng.choice(list(MEDICAL_TESTS)),
+                          "kind": rng.choice(kinds), "threshold": rng.uniform(0.1, 100),
+                          "patient": f"patient {rng.randrange(max(1, count // 4))}"})
+        return rules
+
+    def scan(rules, patient_name):
+        patient = patient_key(patient_name)
+        fired = []
+        for test in tests:
+            for rule in rules:
+                if rule["test"] == test["test_name"] and rule.get("scope") in (None, patient):
+                    if check_rule(rule, test, test["value"], "2024-01-02", previous.get(test["test_name"])):
+                        fired.append(rule["id"])
+        return fired
+
+    print(f"{'rules':>8}{'indexed us':>12}{'scan us':>10}{'alerts':>8}")
+    count = 100
+    while True:
+        count = min(count, args.rules)
+        raw = make_rules(count)
+        index = AlertRules(raw)
+        flat = [dict(rule, scope=patient_key(rule["patient"]) if rule.get("patient") else None)
+                for rules in index.by_test.values() for rule in rules]
+        patient_name = f"patient {rng.randrange(max(1, count // 4))}"
+        indexed_ms, alerts = timed(lambda: evaluate_alerts(index, patient_name, "2024-01-02", tests,
+                                                           lambda names: previous), 200)
+        scan_ms, _ = timed(lambda: scan(flat, patient_name), max(1, 2000 // count))
+        print(f"{count:>8}{indexed_ms * 1000:>12.1f}{scan_ms * 1000:>10.0f}{len(alerts):>8}")
+        if count >= args.rules:
+            break
+        count *= 10
+
+
+def bench_units(args):
+    """Batch unit conversion throughput, vectorized vs one result at a time, and per-report cost."""
+    import random
+    from Aimodal import UNIT_REGISTRY
+
+    printed = {
+        "Hemoglobin": ["g/dl", "g/L", "mmol/L"], "W.B.C": ["cells/cu mm", "x10^9/L", "10^3/uL"],
+        "Platelet Count": ["lacs/cu mm", "x10^9/L", "cells/cu mm"], "Serum Creatinine": ["mg/dl", "umol/L"],
+        "Blood Urea": ["mg/dl", "mmol/L"], "Total Bilirubin": ["mg/dl", "µmol/L"], "P.C.V": ["%", "L/L"],
+        "Serum Potassium": ["mmol/L", "mEq/L"], "SGPT": ["U/L", "IU/L", "ukat/L"], "Albumin": ["g/dl", "g/L"],
+    }
+    rng = random.Random(9)
+    names = [rng.choice(list(printed)) for _ in range(args.results)]
+    units = [rng.choice(printed[name]) for name in names]
+    values = [rng.uniform(0.1, 500) for _ in names]
+
+    def one_at_a_time():
+        # Parse and resolve every result's unit on its own
+        out = []
+        for name, unit, value in zip(names, units, values):
+            factor = UNIT_REGISTRY._compute_factor(name, unit)
+            out.append(value if factor != factor else value * factor)
+        return out
+
+    vector_ms, (converted, _) = timed(lambda: UNIT_REGISTRY.to_canonical(names, values, units), 3)
+    loop_ms, looped = timed(one_at_a_time, 1)
+    assert max(abs(a - b) for a, b in zip(converted[:1000], looped[:1000])) < 1e-9
+    print(f"{args.results} results, {len(set(zip(names, units)))} distinct (test, unit) pairs")
+    print(f"  vectorized:       {vector_ms:8.1f} ms  ({args.results / vector_ms * 1000:,.0f} results/s)")
+    print(f"  one at a time:    {loop_ms:8.1f} ms  ({args.results / loop_ms * 1000:,.0f} results/s)")
+
+    report = sample_report(history_size=0)["tests"]
+
+    def canonicalize_report():
+        tests = [{k: v for k, v in test.items() if k not in ("original_value", "original_unit")} for test in report]
+        return UNIT_REGISTRY.canonicalize(tests)
+
+    report_ms, _ = timed(canonicalize_report, 500)
+    print(f"  one report ({len(report)} results): {report_ms * 1000:.0f} us")
+
+
+def _shard_writer(db_file, shards, patients, barrier, results):
+    """Writer process for bench_shards: saves one report per patient, timing from the shared start."""
+    os.environ["DB_FILE"], os.environ["DB_SHARDS"] = db_file, str(shards)
+    from Aimodal import save_report_to_db
+
+    report = sample_report(history_size=0)
+    barrier.wait()
+    start = time.perf_counter()
+    for patient in patients:
+        save_report_to_db(patient, "2024-01-15", dict(report, patient_name=patient))
+    results.put((start, time.perf_counter()))
+
+
+def bench_shards(args):
+    """Save throughput with concurrent writer processes as the number of shard files grows."""
+    import multiprocessing
+    import tempfile
+
+    context = multiprocessing.get_context("spawn")
+    patients = [f"Shard Patient {i}" for i in range(args.reports)]
+    print(f"{args.writers} writer processes, {args.reports} reports, {os.cpu_count()} CPUs")
+    print(f"{'shards':>8}{'reports/s':>12}{'speedup':>10}")
+    baseline = None
+    for shards in (int(count) for count in args.shards.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, "bench.db")
+            os.environ["DB_FILE"], os.environ["DB_SHARDS"] = db_file, str(shards)
+            from sharding import shard_files
+            from Aimodal import setup_shard
+            for shard_file in shard_files(db_file, shards):
+                setup_shard(shard_file)
+
+            barrier, results = context.Barrier(args.writers), context.Queue()
+            writers = [context.Process(target=_shard_writer,
+                                       args=(db_file, shards, patients[i::args.writers], barrier, results))
+                       for i in range(args.writers)]
+            for writer in writers:
+                writer.start()
+            spans = [results.get() for _ in writers]
+            for writer in writers:
+                writer.join()
+
+        rate = args.reports / (max(end for _, end in spans) - min(start for start, _ in spans))
+        baseline = baseline or rate
+        print(f"{shards:>8}{rate:>12.0f}{rate / baseline:>9.2f}x")
+
+
+def bench_patients(args):
+    """Patient lookup by blind index vs decrypting every stored name, as the patients table grows."""
+    import sqlite3
+    from cryptography.fernet import Fernet
+    from report_codec import encode_text
+    from patient_ids import blind_index, decrypt_name, find_patient, index_key, new_patient_id, setup_patient_tables
+
+    fernet_key = Fernet.generate_key()
+    key = index_key(fernet_key)
+    conn = sqlite3.connect(":memory:")
+    setup_patient_tables(conn)
+    print(f"{'patients':>10}{'index ms':>10}{'scan ms':>10}")
+    count, checkpoint = 0, 1000
+    while count < args.patients:
+        with conn:
+            conn.executemany("INSERT INTO patients (patient_id, name_index, name_data, key_version, created_at) "
+                             "VALUES (?, ?, ?, 1, '2024-01-01')",
+                             [(new_patient_id(), blind_index(key, f"Patient {i}"), encode_text(f"Patient {i}", fernet_key))
+                              for i in range(count, checkpoint)])
+        count = checkpoint
+        name = f"patient  {count // 2} "
+        index_ms, found = timed(lambda: find_patient(conn, blind_index(key, name)), 200)
+
+        def scan():
+            for patient_id, name_data in conn.execute("SELECT patient_id, name_data FROM patients"):
+                if decrypt_name(name_data, 1, {1: fernet_key}).lower() == " ".join(name.split()):
+                    return patient_id
+        scan_ms, scanned = timed(scan, 1)
+        assert found == scanned
+        print(f"{count:>10}{index_ms:>10.3f}{scan_ms:>10.1f}")
+        checkpoint = min(args.patients, checkpoint * 10)
+    conn.close()
+
+
+def bench_groupcommit(args):
+    """Save throughput with concurrent saving threads: one commit per save vs group commit."""
+    import tempfile
+    import threading
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_FILE"], os.environ["DB_SHARDS"] = os.path.join(tmp, "bench.db"), "1"
+        import group_commit
+        from Aimodal import save_report_to_db, setup_database
+
+        setup_database()
+        report = sample_report(history_size=0)
+        print(f"{args.reports} reports per run, window {group_commit.WINDOW_MS:g} ms, "
+              f"batches of up to {group_commit.MAX_BATCH}, {os.cpu_count()} CPUs")
+        print(f"{'threads':>8}{'per-call/s':>12}{'group/s':>10}{'speedup':>9}{'avg batch':>11}")
+        for concurrency in (int(count) for count in args.concurrency.split(",")):
+            rates = {}
+            for mode in (False, True):
+                group_commit.GROUP_COMMIT = mode
+                patients = [f"GC Patient {mode} {concurrency} {i}" for i in range(args.reports)]
+
+                def save_all(names):
+                    for patient in names:
+                        save_report_to_db(patient, "2024-01-15", dict(report, patient_name=patient))
+
+                threads = [threading.Thread(target=save_all, args=(patients[i::concurrency],))
+                           for i in range(concurrency)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                rates[mode] = args.reports / (time.perf_counter() - start)
+            writer = group_commit.get_writer(os.environ["DB_FILE"])
+            batch = writer.writes / max(writer.batches, 1)
+            writer.batches = writer.writes = 0
+            print(f"{concurrency:>8}{rates[False]:>12.0f}{rates[True]:>10.0f}"
+                  f"{rates[True] / rates[False]:>8.2f}x{batch:>11.1f}")
+        group_commit.close_writers()
+
+
+def bench_backends(args):
+    """Save and history-load throughput of the embedded SQLite files vs PostgreSQL (see report_store.py)."""
+    import tempfile
+    import threading
+
+    if not args.dsn:
+        print("❌ Pass --dsn or set DATABASE_URL to a database with EZ_reports/healthcare_schema.sql applied")
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_FILE"], os.environ["DB_SHARDS"] = os.path.join(tmp, "bench.db"), "1"
+        os.environ["DATABASE_URL"] = args.dsn
+        import report_store
+        from Aimodal import load_reports_from_db, save_report_to_db, setup_database
+
+        setup_database()
+        report = sample_report(history_size=0)
+        # Postgres only saves reports of registered patients; they are matched by patient_id
+        patients = [f"P-BENCH-{i:06d}" for i in range(args.patients)]
+        store = report_store.get_report_store("postgres")
+        store.setup()
+        store._call(store.pool.executemany(
+            "INSERT INTO patients (patient_id, first_name, last_name, date_of_birth, gender) "
+            "VALUES ($1, 'Bench', $2, '1980-01-01', 'Other') ON CONFLICT (patient_id) DO NOTHING",
+            [(patient, patient) for patient in patients]))
+
+        def run(concurrency, fn):
+            names = [patients[i % len(patients)] for i in range(args.reports)]
+            threads = [threading.Thread(target=lambda part: [fn(name) for name in part], args=(names[i::concurrency],))
+                       for i in range(concurrency)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return args.reports / (time.perf_counter() - start)
+
+        print(f"{args.reports} reports over {args.patients} patients, {os.cpu_count()} CPUs")
+        print(f"{'backend':>9}{'threads':>9}{'saves/s':>10}{'loads/s':>10}")
+        try:
+            for backend in ("sqlite", "postgres"):
+                report_store.STORAGE_BACKEND = backend
+                for concurrency in (int(count) for count in args.concurrency.split(",")):
+                    saves = run(concurrency, lambda name: save_report_to_db(name, "2024-01-15",
+                                                                            dict(report, patient_name=name)))
+                    loads = run(concurrency, load_reports_from_db)
+                    print(f"{backend:>9}{concurrency:>9}{saves:>10.0f}{loads:>10.0f}")
+        finally:
+            store._call(store.pool.execute("DELETE FROM patients WHERE patient_id LIKE 'P-BENCH-%'"))
+            report_store.close_report_store()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("encoding", help="response serialization and compression")
+    p.add_argument("--history", type=int, default=5, help="historical reports embedded in the payload")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_encoding)
+
+    p = sub.add_parser("ocr", help="OCR preprocessing speed and extraction recall")
+    p.add_argument("corpus", nargs="?", default=".", help="directory of sample PDF/JPG/PNG reports")
+    p.set_defaults(func=bench_ocr)
+
+    p = sub.add_parser("ocr-backends", help="per-page latency of each OCR backend")
+    p.add_argument("corpus", nargs="?", default=".", help="directory of sample PDF/JPG/PNG reports")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_ocr_backends)
+
+    p = sub.add_parser("streaming", help="memory and latency of page-streaming extraction")
+    p.add_argument("--pages", type=int, default=300)
+    p.add_argument("--scanned", action="store_true", help="rasterize pages so every page goes through OCR")
+    p.set_defaults(func=bench_streaming)
+
+    p = sub.add_parser("rotation", help="encryption key rotation throughput")
+    p.add_argument("--rows", type=int, default=100000)
+    p.add_argument("--chunk", type=int, default=1000)
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--rate", type=float, default=None)
+    p.set_defaults(func=bench_rotation)
+
+    p = sub.add_parser("storage", help="report storage format size and latency")
+    p.add_argument("--reports", type=int, default=2000)
+    p.set_defaults(func=bench_storage)
+
+    p = sub.add_parser("fuzzy", help="garbled test-name recall and fuzzy lookup throughput")
+    p.add_argument("corpus", nargs="?", default=None, help="directory of OCR'd .txt reports (default: synthetic)")
+    p.add_argument("--reports", type=int, default=200)
+    p.add_argument("--rate", type=float, default=0.3, help="fraction of words garbled in synthetic reports")
+    p.set_defaults(func=bench_fuzzy)
+
+    p = sub.add_parser("analytics", help="rollup update cost and abnormal-rate query latency")
+    p.add_argument("--reports", type=int, default=100000)
+    p.set_defaults(func=bench_analytics)
+
+    p = sub.add_parser("vitals", help="vitals ingestion throughput")
+    p.add_argument("--samples", type=int, default=1000000)
+    p.add_argument("--batch", type=int, default=250, help="samples per ingest call")
+    p.add_argument("--patients", type=int, default=200)
+    p.set_defaults(func=bench_vitals)
+
+    p = sub.add_parser("tables", help="layout-aware table extraction vs flattened-text regexes")
+    p.add_argument("corpus", nargs="?", default=None, help="directory of born-digital lab PDFs (default: synthetic)")
+    p.add_argument("--pages", type=int, default=50)
+    p.set_defaults(func=bench_tables)
+
+    p = sub.add_parser("neardup", help="MinHash/LSH near-duplicate lookup cost vs archive size")
+    p.add_argument("--reports", type=int, default=100000)
+    p.set_defaults(func=bench_neardup)
+
+    p = sub.add_parser("export", help="columnar export throughput, full and incremental")
+    p.add_argument("--reports", type=int, default=30000)
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--chunk", type=int, default=1000)
+    p.add_argument("--format", choices=("parquet", "arrow"), default="parquet")
+    p.set_defaults(func=bench_export)
+
+    p = sub.add_parser("search", help="full-text indexing rate and query latency vs archive size")
+    p.add_argument("--reports", type=int, default=100000)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("alerts", help="critical-value rule evaluation cost vs number of active rules")
+    p.add_argument("--rules", type=int, default=100000)
+    p.set_defaults(func=bench_alerts)
+
+    p = sub.add_parser("units", help="vectorized unit conversion throughput")
+    p.add_argument("--results", type=int, default=1000000)
+    p.set_defaults(func=bench_units)
+
+    p = sub.add_parser("shards", help="concurrent save throughput vs number of shard files")
+    p.add_argument("--reports", type=int, default=2000)
+    p.add_argument("--writers", type=int, default=8)
+    p.add_argument("--shards", default="1,2,4", help="comma-separated shard counts to compare")
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("patients", help="blind-index patient lookup vs decrypting every name")
+    p.add_argument("--patients", type=int, default=100000)
+    p.set_defaults(func=bench_patients)
+
+    p = sub.add_parser("groupcommit", help="concurrent save throughput, per-call commit vs group commit")
+    p.add_argument("--reports", type=int, default=1000)
+    p.add_argument("--concurrency", default="1,4,16,64", help="comma-separated thread counts to compare")
+    p.set_defaults(func=bench_groupcommit)
+
+    p = sub.add_parser("backends", help="save and history-load throughput, SQLite vs PostgreSQL")
+    p.add_argument("--dsn", default=os.getenv("DATABASE_URL"), help="PostgreSQL database (default: DATABASE_URL)")
+    p.add_argument("--reports", type=int, default=1000)
+    p.add_argument("--patients", type=int, default=200)
+    p.add_argument("--concurrency", default="1,8,32", help="comma-separated thread counts to compare")
+    p.set_defaults(func=bench_backends)
+
+    args = parser.parse_args()
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
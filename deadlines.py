@@ -0,0 +1,155 @@
+"""
+Deadline-aware analysis with degradation tiers.
+
+A request may carry a latency budget, as an X-Deadline-Ms header or a
+?deadline_ms= parameter. The pipeline then gives up quality in steps until
+its cost estimate fits the time left:
+
+    full                     nothing degraded
+    reduced_dpi              scanned pages are OCR'd at REDUCED_DPI
+    first_pages              only the first pages that fit are OCR'd
+    dictionary_explanations  no LLM explanations, knowledge dictionary only
+    no_history               past reports are not reloaded into the response
+
+The response reports the deepest step taken. Costs are per-worker moving
+averages of measured timings, seeded with conservative defaults, so the
+plan follows the machine it runs on.
+"""
+
+import math
+import os
+import time
+
+from ocr_preprocessing import MAX_DPI
+from page_stream import count_pages, iter_page_text
+
+TIERS = ("full", "reduced_dpi", "first_pages", "dictionary_explanations", "no_history")
+
+DEADLINE_HEADER = "X-Deadline-Ms"
+REDUCED_DPI = int(os.getenv("DEADLINE_REDUCED_DPI", "150"))
+# Share of the remaining budget the OCR plan may use; the rest is kept for
+# analysis, explanations and history
+OCR_BUDGET_SHARE = float(os.getenv("DEADLINE_OCR_SHARE", "0.8"))
+
+
+class CostModel:
+    """Exponentially weighted moving averages of step timings, in seconds."""
+
+    def __init__(self, alpha=0.2, **seeds):
+        self.alpha = alpha
+        self.costs = dict(seeds)
+
+    def observe(self, step, seconds):
+        self.costs[step] = (1 - self.alpha) * self.costs[step] + self.alpha * seconds
+
+    def __getitem__(self, step):
+        return self.costs[step]
+
+
+# ocr_page is the cost of one page at MAX_DPI; OCR time scales with pixel count
+COSTS = CostModel(
+    ocr_page=float(os.getenv("DEADLINE_OCR_PAGE_SECONDS", "1.5")),
+    text_page=0.005,
+    analysis=0.02,
+    llm_call=float(os.getenv("DEADLINE_LLM_SECONDS", "2.0")),
+    history=0.05,
+)
+
+
+def ocr_page_cost(dpi):
+    return COSTS["ocr_page"] * (dpi / MAX_DPI) ** 2
+
+
+class Deadline:
+    """The time budget of one request and the degradation steps taken to meet it."""
+
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self.expires = time.monotonic() + budget_ms / 1000.0
+        self.steps = []
+        self.ocr_dpi = None
+        self.pages_total = None
+        self.pages_analyzed = None
+
+    @classmethod
+    def from_request(cls, request):
+        """Deadline from the header or query parameter; None if the request has none. Raises ValueError."""
+        value = request.headers.get(DEADLINE_HEADER) or request.query_params.get("deadline_ms")
+        if not value:
+            return None
+        budget_ms = float(value)
+        if not budget_ms > 0:
+            raise ValueError(f"{DEADLINE_HEADER} must be a positive number of milliseconds")
+        return cls(budget_ms)
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def allows(self, seconds):
+        """True if work estimated at seconds still leaves time for the final steps."""
+        return self.remaining() - seconds >= COSTS["analysis"] + COSTS["history"]
+
+    def degrade(self, step):
+        if step not in self.steps:
+            self.steps.append(step)
+
+    @property
+    def tier(self):
+        return max(self.steps, key=TIERS.index, default="full")
+
+    def plan_pages(self, pages, needs_ocr):
+        """(ocr_dpi, max_pages) for a report of this many pages that fits the budget."""
+        self.pages_total = pages
+        if not needs_ocr or not pages:
+            return MAX_DPI, None
+        self.ocr_dpi = MAX_DPI
+        budget = self.remaining() * OCR_BUDGET_SHARE
+        if pages * ocr_page_cost(MAX_DPI) <= budget:
+            return MAX_DPI, None
+        self.degrade("reduced_dpi")
+        self.ocr_dpi = REDUCED_DPI
+        if pages * ocr_page_cost(REDUCED_DPI) <= budget:
+            return REDUCED_DPI, None
+        self.degrade("first_pages")
+        # Always read the first page: a report with no results is worse than a late one
+        return REDUCED_DPI, max(1, math.floor(budget / ocr_page_cost(REDUCED_DPI)))
+
+    def summary(self):
+        return {
+            "tier": self.tier,
+            "steps": list(self.steps),
+            "deadline_ms": self.budget_ms,
+            "elapsed_ms": round(self.budget_ms - self.remaining() * 1000),
+            "pages_analyzed": self.pages_analyzed,
+            "pages_total": self.pages_total,
+            "ocr_dpi": self.ocr_dpi,
+        }
+
+
+def iter_pages_within(deadline, source, filename):
+    """
+    iter_page_text degraded to fit the deadline. Pages are timed to keep the
+    cost model current, and reading stops early if a page would overrun.
+    """
+    pages, needs_ocr = count_pages(source, filename)
+    ocr_dpi, max_pages = deadline.plan_pages(pages, needs_ocr)
+    page_cost = ocr_page_cost(ocr_dpi) if needs_ocr else COSTS["text_page"]
+    deadline.pages_analyzed = 0
+
+    page_iter = iter_page_text(source, filename, max_pages, ocr_dpi)
+    while True:
+        if deadline.pages_analyzed and not deadline.allows(page_cost):
+            page_iter.close()
+            deadline.degrade("first_pages")
+            return
+        started = time.monotonic()
+        try:
+            text = next(page_iter)
+        except StopIteration:
+            return
+        elapsed = time.monotonic() - started
+        if needs_ocr:
+            COSTS.observe("ocr_page", elapsed * (MAX_DPI / ocr_dpi) ** 2)
+            page_cost = ocr_page_cost(ocr_dpi)
+        deadline.pages_analyzed += 1
+        yield text
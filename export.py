@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Columnar export of the report archive for analysis.
+
+Walks patient_reports by id in chunks, decrypts each chunk on a worker pool
+and flattens every report's tests into one row per result:
+
+    report_id, patient, report_date, cohort, test_name, value, unit,
+    range_low, range_high, status, category
+
+Rows are written as Parquet (or Arrow IPC) files partitioned by report
+month (report_month=2024-01/part-....parquet). Only a few chunks are in
+flight at a time, so memory stays bounded however large the archive is.
+
+Each destination keeps a watermark (the last exported report id) in the
+database, so the next run exports only reports saved since. Files are
+written under a temporary name and renamed when the run completes; an
+interrupted run leaves no partial parts behind and does not move the
+watermark.
+
+    python export.py exports/                  # incremental Parquet export
+    python export.py exports/ --format arrow
+    python export.py fresh/ --full             # everything, ignoring the watermark
+    python export.py exports/ --pseudonymize   # patient = patient_id instead of the name
+"""
+
+import argparse
+import io
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+from patient_ids import decrypt_name
+from report_codec import decode_report
+
+# Optional imports with fallback handling
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    pa = None
+    pq = None
+    PYARROW_AVAILABLE = False
+
+COLUMNS = ("report_id", "patient", "report_date", "cohort", "test_name", "value", "unit",
+           "range_low", "range_high", "status", "category")
+SCHEMA = pa.schema([
+    ("report_id", pa.int64()),
+    ("patient", pa.string()),
+    ("report_date", pa.date32()),
+    ("cohort", pa.string()),
+    ("test_name", pa.string()),
+    ("value", pa.float64()),
+    ("unit", pa.string()),
+    ("range_low", pa.float64()),
+    ("range_high", pa.float64()),
+    ("status", pa.string()),
+    ("category", pa.string()),
+]) if PYARROW_AVAILABLE else None
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+UNKNOWN_MONTH = "unknown"
+
+_worker_keys = None
+_pseudonymize = False
+
+
+def _init_worker(keys, pseudonymize):
+    """Stores the {version: key} ring and the patient column mode once per worker process."""
+    global _worker_keys, _pseudonymize
+    _worker_keys = keys
+    _pseudonymize = pseudonymize
+
+
+def parse_report_date(value):
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _flatten_rows(rows):
+    """
+    Decrypts (id, patient_id, name_data, name_version, report_date, blob,
+    key_version, cohort) rows and flattens their tests. Returns ({report_month: {column: [values]}}, failed).
+    """
+    months, failed = {}, 0
+    for report_id, patient_id, name_data, name_version, report_date, blob, key_version, cohort in rows:
+        keys = [_worker_keys[key_version]] if key_version in _worker_keys else list(_worker_keys.values())
+        try:
+            # No catalogue: explanations are not exported, so they are not expanded
+            report = decode_report(blob, keys)
+            patient = patient_id if _pseudonymize else decrypt_name(name_data, name_version, _worker_keys)
+        except Exception:
+            failed += 1
+            continue
+        day = parse_report_date(report_date)
+        month = day.strftime("%Y-%m") if day else UNKNOWN_MONTH
+        columns = months.get(month)
+        if columns is None:
+            columns = months[month] = {name: [] for name in COLUMNS}
+        for test in report.get("tests", []):
+            columns["report_id"].append(report_id)
+            columns["patient"].append(patient)
+            columns["report_date"].append(day)
+            columns["cohort"].append(cohort)
+            columns["test_name"].append(test.get("test_name"))
+            columns["value"].append(as_float(test.get("value")))
+            columns["unit"].append(test.get("unit"))
+            columns["range_low"].append(as_float(test.get("range_low")))
+            columns["range_high"].append(as_float(test.get("range_high")))
+            columns["status"].append(test.get("status"))
+            columns["category"].append(test.get("category"))
+    return months, failed
+
+
+def iter_result_chunks(db_file, keys, since_id=0, until_id=None, chunk_size=1000, workers=None,
+                       pseudonymize=False):
+    """
+    Yields (last_id, reports, {report_month: columns}, failed) for reports with
+    since_id < id <= until_id, in id order. workers=0 decrypts in this
+    process; otherwise up to two chunks per worker are in flight at once.
+    """
+    conn = sqlite3.connect(db_file, timeout=30)
+    if until_id is None:
+        until_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM patient_reports").fetchone()[0]
+
+    def read_chunks():
+        last_id = since_id
+        while True:
+            rows = conn.execute(
+                "SELECT r.id, r.patient_id, p.name_data, p.key_version, r.report_date, r.report_data, r.key_version, "
+                "r.cohort FROM patient_reports r JOIN patients p ON p.patient_id = r.patient_id "
+                "WHERE r.id > ? AND r.id <= ? ORDER BY r.id LIMIT ?", (last_id, until_id, chunk_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield last_id, rows
+
+    try:
+        if workers == 0:
+            _init_worker(keys, pseudonymize)
+            for last_id, rows in read_chunks():
+                yield (last_id, len(rows)) + _flatten_rows(rows)
+            return
+
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(keys, pseudonymize)) as pool:
+            pending = deque()
+            for last_id, rows in read_chunks():
+                pending.append((last_id, len(rows), pool.submit(_flatten_rows, rows)))
+                if len(pending) >= workers * 2:
+                    done_id, reports, future = pending.popleft()
+                    yield (done_id, reports) + future.result()
+            while pending:
+                done_id, reports, future = pending.popleft()
+                yield (done_id, reports) + future.result()
+    finally:
+        conn.close()
+
+
+def to_batch(columns):
+    return pa.RecordBatch.from_pydict(columns, schema=SCHEMA)
+
+
+class PartitionedWriter:
+    """One open Parquet/Arrow file per report month, renamed into place on commit."""
+
+    def __init__(self, out_dir, fmt, part_name):
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.part_name = part_name
+        self.writers = {}
+        self.paths = []
+
+    def write(self, month, columns):
+        writer = self.writers.get(month)
+        if writer is None:
+            directory = os.path.join(self.out_dir, f"report_month={month}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, self.part_name + FORMATS[self.fmt])
+            if self.fmt == "parquet":
+                writer = pq.ParquetWriter(path + ".tmp", SCHEMA, compression="zstd")
+            else:
+                writer = pa.ipc.new_file(path + ".tmp", SCHEMA)
+            self.writers[month] = writer
+            self.paths.append(path)
+        # Each chunk becomes one row group / record batch
+        if self.fmt == "parquet":
+            writer.write_batch(to_batch(columns))
+        else:
+            writer.write(to_batch(columns))
+
+    def commit(self):
+        for writer in self.writers.values():
+            writer.close()
+        for path in self.paths:
+            os.replace(path + ".tmp", path)
+        return self.paths
+
+    def abort(self):
+        for writer in self.writers.values():
+            try:
+                writer.close()
+            except Exception:
+                pass
+        for path in self.paths:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+
+def setup_watermarks(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            destination TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL, rows_exported INTEGER NOT NULL, updated_at TEXT NOT NULL
+        )
+    ''')
+    conn.commit()
+
+
+def export_results(db_file, keys, out_dir, fmt="parquet", full=False, chunk_size=1000, workers=None,
+                   pseudonymize=False):
+    """
+    Exports results of reports saved since the destination's watermark (all
+    reports with full=True) and advances the watermark.
+    Returns {"reports", "results", "failed", "files", "last_id"}.
+    """
+    if not PYARROW_AVAILABLE:
+        raise ImportError("pyarrow is required for exports (pip install pyarrow)")
+    destination = os.path.abspath(out_dir)
+    conn = sqlite3.connect(db_file, timeout=30)
+    setup_watermarks(conn)
+    row = conn.execute("SELECT last_id, rows_exported FROM export_watermarks WHERE destination = ?",
+                       (destination,)).fetchone()
+    since_id, rows_exported = (0, 0) if full or not row else row
+    until_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM patient_reports").fetchone()[0]
+    summary = {"reports": 0, "results": 0, "failed": 0, "files": [], "last_id": since_id}
+    if until_id <= since_id:
+        conn.close()
+        return summary
+
+    # Part names carry the id range, so runs never overwrite each other's files
+    writer = PartitionedWriter(destination, fmt, f"part-{since_id + 1:09d}-{until_id:09d}")
+    try:
+        for _, reports, months, failed in iter_result_chunks(db_file, keys, since_id, until_id, chunk_size,
+                                                             workers, pseudonymize):
+            for month, columns in months.items():
+                writer.write(month, columns)
+                summary["results"] += len(columns["report_id"])
+            summary["reports"] += reports
+            summary["failed"] += failed
+        summary["files"] = writer.commit()
+    except BaseException:
+        writer.abort()
+        conn.close()
+        raise
+
+    with conn:
+        conn.execute('''
+            INSERT INTO export_watermarks (destination, last_id, rows_exported, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(destination) DO UPDATE SET
+                last_id = excluded.last_id, rows_exported = excluded.rows_exported, updated_at = excluded.updated_at
+        ''', (destination, until_id, (0 if full else rows_exported) + summary["results"],
+              datetime.utcnow().isoformat()))
+    conn.close()
+    summary["last_id"] = until_id
+    return summary
+
+
+def iter_arrow_stream(ranges, keys, chunk_size=1000, workers=0, pseudonymize=False):
+    """
+    Arrow IPC stream bytes (schema, then one record batch per chunk and
+    month) for an HTTP response, covering each (db_file, since_id, until_id)
+    of ranges in turn.
+    """
+    if not PYARROW_AVAILABLE:
+        raise ImportError("pyarrow is required for exports (pip install pyarrow)")
+    sink = io.BytesIO()
+    stream = pa.ipc.new_stream(sink, SCHEMA)
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    yield drain()
+    for db_file, since_id, until_id in ranges:
+        for _, _, months, _ in iter_result_chunks(db_file, keys, since_id, until_id, chunk_size, workers,
+                                                  pseudonymize):
+            for columns in months.values():
+                stream.write_batch(to_batch(columns))
+            yield drain()
+    stream.close()
+    yield drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir", help="destination directory (one watermark per directory)")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--full", action="store_true", help="export every report, ignoring the watermark")
+    parser.add_argument("--chunk", type=int, default=1000, help="reports per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="decryption processes (default: CPU count)")
+    parser.add_argument("--pseudonymize", action="store_true", help="export the patient_id instead of the name")
+    args = parser.parse_args()
+
+    if args.full and os.path.isdir(args.out_dir) and any(
+            name.startswith("report_month=") for name in os.listdir(args.out_dir)):
+        print(f"❌ {args.out_dir} already holds an export; use an empty directory with --full")
+        return 1
+
+    from Aimodal import KEY_BYTES, SHARD_FILES, setup_database
+
+    setup_database()
+    started = time.perf_counter()
+    # Each shard keeps its own watermark; report ids are unique across shards, so part names never clash
+    summaries = [export_results(db_file, KEY_BYTES, args.out_dir, args.format, args.full, args.chunk,
+                                args.workers, args.pseudonymize) for db_file in SHARD_FILES]
+    elapsed = time.perf_counter() - started
+    watermarks = ",".join(str(summary["last_id"]) for summary in summaries)
+    files = [name for summary in summaries for name in summary["files"]]
+    if not files:
+        print(f"Nothing new to export (watermark at report id {watermarks})")
+        return 0
+    results, reports, failed = (sum(summary[field] for summary in summaries)
+                                for field in ("results", "reports", "failed"))
+    print(f"Exported {results} results from {reports} reports into "
+          f"{len(files)} files in {elapsed:.1f}s ({results / max(elapsed, 1e-9):.0f} results/s)"
+          + (f", {failed} unreadable" if failed else ""))
+    print(f"Watermark: report id {watermarks}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
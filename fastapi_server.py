@@ -1,6 +1,7 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 import os
 import json
@@ -10,11 +11,37 @@ from datetime import datetime
 from typing import List, Dict, Any, Optional
 import tempfile
 import shutil
+import hashlib
+import hmac
+import time
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Import the AI model functions from Aimodal.py
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from response_encoding import (
+    encode_response,
+    http_date,
+    is_not_modified,
+    not_modified_response,
+    representation_etag,
+    validator_headers,
+)
+from page_stream import iter_page_text
+from ocr_engine import warm_up_threads
+from vitals import METRICS, RESOLUTIONS, VitalsStore
+from pdf_tables import PDF_TABLE_EXTRACTION, PDF_TABLE_PROBE_PAGES
+from near_duplicates import NEAR_DUPLICATE_DETECTION, minhash
+from deadlines import COSTS, Deadline, iter_pages_within
+from export import PYARROW_AVAILABLE
+from group_commit import close_writers
+from report_store import close_report_store
+from admission import OCR_CONCURRENCY, AdmissionMiddleware, admission_stats, request_lane
+from prescription_alarm import schedule_alarms
+from search_index import MAX_OFFSET
+
 # Import only the necessary functions, avoiding Streamlit dependencies
 try:
     # Import the core functions we need
@@ -27,7 +54,15 @@ try:
         calculate_health_score,
         setup_database,
         save_report_to_db,
-        load_reports_from_db
+        submit_report,
+        load_reports_from_db,
+        get_patient_version,
+        iter_page_parameters,
+        iter_table_parameters,
+        load_abnormal_rates,
+        find_duplicate_report,
+        export_results_stream,
+        search_reports
     )
     
     # Define our own text extraction function to avoid Streamlit
@@ -36,48 +71,10 @@ try:
         if not uploaded_file:
             return None
 
-        file_extension = os.path.splitext(uploaded_file.name)[1].lower()
-        raw_text = ""
-
         try:
-            if file_extension == ".pdf":
-                try:
-                    import fitz  # PyMuPDF
-                    pdf_bytes = uploaded_file.getvalue()
-                    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-                    
-                    # Check if the PDF is scanned
-                    is_scanned = all(len(page.get_text().strip()) == 0 for page in doc)
-                    
-                    if is_scanned:
-                        try:
-                            import pytesseract
-                            from PIL import Image
-                            for page in doc:
-                                pix = page.get_pixmap(dpi=300)
-                                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                                raw_text += pytesseract.image_to_string(img)
-                        except ImportError:
-                            return {"error": "OCR not available for scanned PDF"}
-                    else:
-                        for page in doc:
-                            raw_text += page.get_text()
-                    doc.close()
-                except ImportError:
-                    return {"error": "PDF processing not available"}
-
-            elif file_extension in [".jpg", ".jpeg", ".png"]:
-                try:
-                    import pytesseract
-                    from PIL import Image
-                    img = Image.open(uploaded_file)
-                    raw_text = pytesseract.image_to_string(img)
-                except ImportError:
-                    return {"error": "Image OCR not available"}
-
-            elif file_extension == ".txt":
-                raw_text = uploaded_file.read().decode("utf-8")
-
+            raw_text = "".join(iter_page_text(uploaded_file.getvalue(), uploaded_file.name))
+        except ImportError as e:
+            return {"error": f"PDF/OCR processing not available: {e}"}
         except Exception as e:
             return {"error": f"Error processing file: {e}"}
 
@@ -100,7 +97,7 @@ except ImportError as e:
     def compute_health_status(extracted_params):
         return extracted_params
     
-    def generate_explanations(analyzed_params, use_llm=False):
+    def generate_explanations(analyzed_params, use_llm=False, api_key=None, llm_deadline=None):
         return analyzed_params
     
     def calculate_health_score(analyzed_params):
@@ -109,12 +106,40 @@ except ImportError as e:
     def setup_database():
         pass
     
-    def save_report_to_db(patient_name, report_date, report_data):
+    def save_report_to_db(patient_name, report_date, report_data, cohort=None, signature=None, clean_text=None):
         pass
     
+    def submit_report(patient_name, report_date, report_data, cohort=None, signature=None, clean_text=None):
+        future = Future()
+        future.set_result(None)
+        return future
+    
     def load_reports_from_db(patient_name):
         return []
     
+    def get_patient_version(patient_name):
+        return 0, None
+    
+    def iter_page_parameters(raw_pages):
+        pages = list(raw_pages)
+        yield {"page": len(pages), "clean_text": "".join(pages), "tests": [], "report_date": None,
+               "prescriptions": [], "final": True}
+    
+    def iter_table_parameters(pdf_source):
+        yield from ()
+    
+    def load_abnormal_rates(test_name, status="High", period="month", start=None, end=None, cohort="all"):
+        return []
+    
+    def find_duplicate_report(patient_name, signature, extracted_params):
+        return None
+    
+    def export_results_stream(since_id="0", pseudonymize=False):
+        return since_id, iter(())
+    
+    def search_reports(query, patient_name=None, limit=20, offset=0):
+        return {"total": 0, "results": []}
+    
     def extract_text_from_source(uploaded_file):
         return {"error": "AI model not available"}
 
@@ -122,54 +147,190 @@ except ImportError as e:
 def extract_text_from_file(file_path, filename):
     """Extract text from a file directly"""
     try:
-        file_extension = os.path.splitext(filename)[1].lower()
-        raw_text = ""
-
-        if file_extension == ".pdf":
-            try:
-                import fitz  # PyMuPDF
-                doc = fitz.open(file_path)
-                
-                # Check if the PDF is scanned
-                is_scanned = all(len(page.get_text().strip()) == 0 for page in doc)
-                
-                if is_scanned:
-                    try:
-                        import pytesseract
-                        from PIL import Image
-                        for page in doc:
-                            pix = page.get_pixmap(dpi=300)
-                            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                            raw_text += pytesseract.image_to_string(img)
-                    except ImportError:
-                        return {"error": "OCR not available for scanned PDF"}
-                else:
-                    for page in doc:
-                        raw_text += page.get_text()
-                doc.close()
-            except ImportError:
-                return {"error": "PDF processing not available"}
-
-        elif file_extension in [".jpg", ".jpeg", ".png"]:
-            try:
-                import pytesseract
-                from PIL import Image
-                img = Image.open(file_path)
-                raw_text = pytesseract.image_to_string(img)
-            except ImportError:
-                return {"error": "Image OCR not available"}
-
-        elif file_extension == ".txt":
-            with open(file_path, 'r', encoding='utf-8') as f:
-                raw_text = f.read()
-
-        return {"raw_text": raw_text}
-
+        return {"raw_text": "".join(iter_page_text(file_path, filename))}
+    except ImportError as e:
+        return {"error": f"PDF/OCR processing not available: {e}"}
     except Exception as e:
         return {"error": f"Error processing file: {e}"}
 
+def iter_report_parameters(content, filename, deadline=None):
+    """
+    Per-page extraction progress for one report. Born-digital PDFs are read
+    as tables from word coordinates; scanned PDFs, other formats, and PDFs
+    where no table rows are found go through the page-text regex pipeline,
+    degraded to fit the deadline if one is given.
+    """
+    if PDF_TABLE_EXTRACTION and os.path.splitext(filename)[1].lower() == ".pdf":
+        # Page events are held back only until a page with table rows turns
+        # up, so a fallback never reports the same page twice. After
+        # PDF_TABLE_PROBE_PAGES pages without one the table pass is dropped.
+        table_pages, held = iter_table_parameters(content), []
+        try:
+            for progress in table_pages:
+                if progress["tests"]:
+                    yield from held
+                    yield progress
+                    yield from table_pages
+                    return
+                held.append(progress)
+                if len(held) >= PDF_TABLE_PROBE_PAGES:
+                    break
+        finally:
+            table_pages.close()
+    if deadline:
+        yield from iter_page_parameters(iter_pages_within(deadline, content, filename))
+    else:
+        yield from iter_page_parameters(iter_page_text(content, filename))
+
+def report_details(progress):
+    """The report date and prescriptions of a pipeline progress event."""
+    return {"report_date": progress.get("report_date"), "prescriptions": progress.get("prescriptions", [])}
+
+# Uploads are extracted (rendered, OCR'd, parsed) on their own threads, as
+# many as the ocr admission lane admits at once. Each thread's OCR engine is
+# loaded at startup, and cheap requests never wait for these threads.
+ocr_pool = ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr")
+
+async def iterate_in_pool(pool, iterator):
+    """Async iteration over a blocking iterator, each step run on pool."""
+    loop, done = asyncio.get_running_loop(), object()
+    while True:
+        item = await loop.run_in_executor(pool, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+def collect_pipeline(events):
+    """Consumes pipeline progress events. Returns (clean_text, extracted_params, details)."""
+    clean_pages, extracted_params, details = [], [], {}
+    for progress in events:
+        if progress["clean_text"]:
+            clean_pages.append(progress["clean_text"])
+        extracted_params = progress["tests"]
+        details = report_details(progress)
+    return " ".join(clean_pages), extracted_params, details
+
+def run_page_pipeline(raw_pages):
+    """
+    Streams raw page texts through normalization and parameter extraction,
+    one page at a time. Returns (clean_text, extracted_params, details).
+    """
+    return collect_pipeline(iter_page_parameters(raw_pages))
+
+# LLM explanations for tests missing from the knowledge dictionary (off by default)
+API_LLM_EXPLANATIONS = os.getenv("API_LLM_EXPLANATIONS", "0") == "1"
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+def analyze_and_submit(patient_name, clean_text, extracted_params, cohort=None, deadline=None, details=None):
+    """
+    Builds the report and queues its save, unless the patient already has a
+    stored report with near-identical text and the same results (the same
+    paper photographed twice). That analysis is then returned, marked with
+    "duplicate_of", and no new history entry is written. Returns
+    (final_output, Future of the save or None).
+    """
+    signature = minhash(clean_text)
+    if NEAR_DUPLICATE_DETECTION:
+        duplicate = find_duplicate_report(patient_name, signature, extracted_params)
+        if duplicate:
+            report_id, score, final_output = duplicate
+            final_output["duplicate_of"] = {"report_id": report_id, "similarity": round(score, 2)}
+            return final_output, None
+
+    final_output = build_final_output(patient_name, extracted_params, deadline, details)
+    saved = submit_report(patient_name, final_output["report_date"], final_output, cohort, signature, clean_text)
+    return final_output, saved
+
+def analyze_or_reuse(patient_name, clean_text, extracted_params, cohort=None, deadline=None, details=None):
+    """analyze_and_submit, waiting for the save to commit."""
+    final_output, saved = analyze_and_submit(patient_name, clean_text, extracted_params, cohort, deadline, details)
+    if saved is not None:
+        saved.result()
+    return final_output
+
+def build_final_output(patient_name, extracted_params, deadline=None, details=None):
+    """
+    Runs classification, scoring and explanations and assembles the report.
+    LLM explanations (API_LLM_EXPLANATIONS) stop once they would overrun the deadline.
+    details is the report date and prescriptions found by the same scan as
+    the tests; a report without a printed date is dated today.
+    """
+    classified_params = classify_tests(extracted_params)
+    analyzed_params = compute_health_status(classified_params)
+    use_llm, llm_deadline = bool(API_LLM_EXPLANATIONS and OPENAI_API_KEY), None
+    if use_llm and deadline:
+        # Leave room for one more call plus saving and the history reload
+        llm_deadline = deadline.expires - COSTS["llm_call"] - COSTS["analysis"] - COSTS["history"]
+    final_params = generate_explanations(analyzed_params, use_llm=use_llm, api_key=OPENAI_API_KEY,
+                                         llm_deadline=llm_deadline)
+    if llm_deadline and time.monotonic() >= llm_deadline:
+        deadline.degrade("dictionary_explanations")
+    score, emoji = calculate_health_score(final_params)
+    
+    # Create the final output
+    details = details or {}
+    report_date = details.get("report_date") or datetime.now().strftime("%Y-%m-%d")
+    prescriptions = details.get("prescriptions", [])
+    return {
+        "patient_name": patient_name,
+        "report_date": report_date,
+        "health_score": {
+            "score": score,
+            "emoji": emoji,
+            "status": "Excellent" if score >= 90 else "Average" if score >= 70 else "Needs Attention"
+        },
+        "tests": final_params,
+        "summary": {
+            "total_tests": len(final_params),
+            "normal_tests": len([t for t in final_params if t["status"] == "Normal"]),
+            "abnormal_tests": len([t for t in final_params if t["status"] != "Normal"]),
+            "regular_tests": len([t for t in final_params if t["category"] == "regular"]),
+            "periodic_tests": len([t for t in final_params if t["category"] == "periodic"])
+        },
+        "prescriptions": prescriptions,
+        "alarms": schedule_alarms(prescriptions, report_date)
+    }
+
+async def read_report_input(request):
+    """
+    Reads the patient name and report from a multipart upload or a JSON
+    text_input body. Returns (patient_name, content_bytes, filename).
+    """
+    content_type = request.headers.get("content-type", "")
+    
+    # Handle multipart form data (file upload)
+    if "multipart/form-data" in content_type:
+        form = await request.form()
+        patient_name = form.get("patient_name")
+        file = form.get("file")
+        
+        if not patient_name:
+            raise HTTPException(status_code=400, detail="Patient name is required")
+        
+        if not file:
+            raise HTTPException(status_code=400, detail="No file provided")
+        
+        return patient_name, await file.read(), file.filename
+    
+    # Handle JSON data (text input)
+    body = await request.json()
+    patient_name = body.get("patient_name")
+    text_input = body.get("text_input")
+    
+    if not patient_name:
+        raise HTTPException(status_code=400, detail="Patient name is required")
+    
+    if not text_input:
+        raise HTTPException(status_code=400, detail="No text input provided")
+    
+    return patient_name, text_input.encode("utf-8"), "text_input.txt"
+
 app = FastAPI(title="Medical Report AI API", version="1.0.0")
 
+# Per-lane concurrency and queue limits; added before CORS so that 429/503
+# answers still carry CORS headers
+app.add_middleware(AdmissionMiddleware)
+
 # Enable CORS for Flutter app
 app.add_middleware(
     CORSMiddleware,
@@ -179,8 +340,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize database
-setup_database()
+# Initialize database, unless start_server.serve("prod") already did it once for all workers
+if os.getenv("DB_SETUP_DONE") != "1":
+    setup_database()
+
+WARM_UP_REPORT = "Hemoglobin: 13.5 g/dl\nSerum Creatinine 1.0 mg/dl\nSGOT 30 U/L"
+
+@app.on_event("startup")
+def warm_up_worker():
+    """
+    Runs once per worker before it accepts traffic, so the first real request
+    doesn't pay for lazy setup: extraction pipeline, DB connection, OCR engine.
+    """
+    started = time.perf_counter()
+    _, extracted_params, _ = run_page_pipeline([WARM_UP_REPORT])
+    build_final_output("warm-up", extracted_params)
+    get_patient_version("")
+    try:
+        warm_up_threads(ocr_pool, OCR_CONCURRENCY)
+    except Exception as e:
+        print(f"OCR engine not available in worker {os.getpid()}: {e}")
+    print(f"Worker {os.getpid()} warmed up in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+# Per-worker write-behind queue over the shared vitals store
+vitals_store = VitalsStore()
+
+@app.on_event("shutdown")
+def flush_writes():
+    vitals_store.close()
+    close_writers()
+    close_report_store()
+    ocr_pool.shutdown(wait=False, cancel_futures=True)
 
 @app.get("/")
 async def root():
@@ -188,153 +378,281 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {"status": "healthy", "timestamp": datetime.now().isoformat(), "admission": admission_stats()}
 
 @app.post("/analyze-report")
 async def analyze_report(request: Request):
     """
-    Analyze a medical report from file upload or text input
+    Analyze a medical report from file upload or text input. With an
+    X-Deadline-Ms header (or ?deadline_ms=) the analysis degrades to fit
+    the budget and reports the tier used in "analysis_tier".
     """
     try:
-        content_type = request.headers.get("content-type", "")
+        try:
+            deadline = Deadline.from_request(request)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid deadline: {e}")
+        patient_name, content, filename = await read_report_input(request)
         
-        # Handle multipart form data (file upload)
-        if "multipart/form-data" in content_type:
-            form = await request.form()
-            patient_name = form.get("patient_name")
-            file = form.get("file")
-            text_input = None
-            
-            if not patient_name:
-                raise HTTPException(status_code=400, detail="Patient name is required")
-            
-            if not file:
-                raise HTTPException(status_code=400, detail="No file provided")
-            
-            # Save uploaded file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp_file:
-                content = await file.read()
-                tmp_file.write(content)
-                tmp_file_path = tmp_file.name
-            
-            try:
-                # Create a mock uploaded file object for the existing function
-                class MockUploadedFile:
-                    def __init__(self, file_path, filename):
-                        self.name = filename
-                        self._file_path = file_path
-                    
-                    def getvalue(self):
-                        with open(self._file_path, 'rb') as f:
-                            return f.read()
-                
-                # Extract text directly from the file
-                raw_text_data = extract_text_from_file(tmp_file_path, file.filename)
-                
-                # Debug: Print the extracted text
-                if raw_text_data and raw_text_data.get("raw_text"):
-                    print(f"Extracted text length: {len(raw_text_data['raw_text'])}")
-                    print(f"First 200 chars: {raw_text_data['raw_text'][:200]}")
-                else:
-                    print("No text extracted from file")
-                    
-            finally:
-                # Clean up temporary file
-                if os.path.exists(tmp_file_path):
-                    os.unlink(tmp_file_path)
+        # Extract, normalize and parse the report one page at a time, off the
+        # event loop so OCR does not hold up cheap requests (see admission.py)
+        try:
+            events = iter_report_parameters(content, filename, deadline)
+            if request_lane(request.scope) == "ocr":
+                clean_text, extracted_params, details = await asyncio.get_running_loop().run_in_executor(
+                    ocr_pool, collect_pipeline, events)
+            else:
+                clean_text, extracted_params, details = await run_in_threadpool(collect_pipeline, events)
+        except Exception as e:
+            print(f"Text extraction failed: {e}")
+            clean_text, extracted_params, details = "", [], {}
         
-        # Handle JSON data (text input)
+        # Debug: Print the extracted text
+        if clean_text:
+            print(f"Extracted text length: {len(clean_text)}")
+            print(f"First 200 chars: {clean_text[:200]}")
         else:
-            body = await request.json()
-            patient_name = body.get("patient_name")
-            text_input = body.get("text_input")
-            file = None
-            
-            if not patient_name:
-                raise HTTPException(status_code=400, detail="Patient name is required")
-            
-            if not text_input:
-                raise HTTPException(status_code=400, detail="No text input provided")
-            
-            raw_text_data = {"raw_text": text_input}
+            print("No text extracted from input")
         
         # Validate input
-        if not raw_text_data or not raw_text_data.get("raw_text", "").strip():
+        if not clean_text:
             raise HTTPException(status_code=400, detail="Could not extract text from the provided input")
         
-        # Process the text through the AI pipeline
-        clean_text_data = clean_and_normalize_text(raw_text_data)
-        extracted_params = extract_parameters_with_ner(clean_text_data)
-        
         if not extracted_params:
             raise HTTPException(status_code=400, detail="No valid medical parameters found in the report")
         
-        # Run the full analysis pipeline
-        classified_params = classify_tests(extracted_params)
-        analyzed_params = compute_health_status(classified_params)
-        final_params = generate_explanations(analyzed_params, use_llm=False)  # Disable LLM for API
-        score, emoji = calculate_health_score(final_params)
-        
-        # Create the final output
-        report_date = datetime.now().strftime("%Y-%m-%d")
-        final_output = {
-            "patient_name": patient_name,
-            "report_date": report_date,
-            "health_score": {
-                "score": score,
-                "emoji": emoji,
-                "status": "Excellent" if score >= 90 else "Average" if score >= 70 else "Needs Attention"
-            },
-            "tests": final_params,
-            "summary": {
-                "total_tests": len(final_params),
-                "normal_tests": len([t for t in final_params if t["status"] == "Normal"]),
-                "abnormal_tests": len([t for t in final_params if t["status"] != "Normal"]),
-                "regular_tests": len([t for t in final_params if t["category"] == "regular"]),
-                "periodic_tests": len([t for t in final_params if t["category"] == "periodic"])
-            }
-        }
-        
-        # Save to database
-        save_report_to_db(patient_name, report_date, final_output)
+        # Run the full analysis pipeline and save the report (an optional
+        # ?cohort= label feeds the analytics rollups). Explanations, duplicate
+        # checks and history reads decrypt reports (and may call the LLM), so
+        # they run off the event loop too. Awaiting the commit lets other
+        # requests run meanwhile, and their saves share it.
+        final_output, saved = await run_in_threadpool(
+            analyze_and_submit, patient_name, clean_text, extracted_params,
+            request.query_params.get("cohort"), deadline, details)
+        if saved is not None:
+            await asyncio.wrap_future(saved)
         
         # Load historical data for trends
-        historical_reports = load_reports_from_db(patient_name)
-        final_output["historical_data"] = historical_reports
+        final_output["historical_data"] = await run_in_threadpool(load_history_within, patient_name, deadline)
         
-        return JSONResponse(content=final_output, media_type="application/json; charset=utf-8")
+        if deadline:
+            final_output["analysis_tier"] = deadline.summary()
+            return encode_response(request, final_output, headers={"X-Analysis-Tier": deadline.tier})
+        return encode_response(request, final_output)
         
     except HTTPException:
         raise
+    except LookupError as e:
+        # STORAGE_BACKEND=postgres only saves reports of registered patients
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+def load_history_within(patient_name, deadline=None):
+    """The patient's recent reports, or [] when the deadline leaves no time to load them."""
+    if deadline and deadline.remaining() < COSTS["history"]:
+        deadline.degrade("no_history")
+        return []
+    started = time.monotonic()
+    historical_reports = load_reports_from_db(patient_name)
+    COSTS.observe("history", time.monotonic() - started)
+    return historical_reports
+
+def iter_analysis_events(patient_name, content, filename, cohort=None, deadline=None):
+    """NDJSON events for /analyze-report/stream: one per page, then the final report."""
+    clean_pages, extracted_params, details = [], [], {}
+    try:
+        for progress in iter_report_parameters(content, filename, deadline):
+            if progress["clean_text"]:
+                clean_pages.append(progress["clean_text"])
+            extracted_params = progress["tests"]
+            details = report_details(progress)
+            if not progress["final"]:
+                yield json.dumps({"page": progress["page"], "tests": extracted_params}) + "\n"
+    except Exception as e:
+        yield json.dumps({"error": f"Error processing file: {e}"}) + "\n"
+        return
+
+    if not extracted_params:
+        yield json.dumps({"error": "No valid medical parameters found in the report"}) + "\n"
+        return
+
+    try:
+        final_output = analyze_or_reuse(patient_name, " ".join(clean_pages), extracted_params, cohort, deadline,
+                                        details)
+    except LookupError as e:
+        yield json.dumps({"error": str(e)}) + "\n"
+        return
+    final_output["historical_data"] = load_history_within(patient_name, deadline)
+    if deadline:
+        final_output["analysis_tier"] = deadline.summary()
+    yield json.dumps({"final": True, "report": final_output}) + "\n"
+
+@app.post("/analyze-report/stream")
+async def analyze_report_stream(request: Request):
+    """
+    Same input as /analyze-report, answered as newline-delimited JSON: the
+    tests found so far after every page, then the complete report.
+    """
+    try:
+        deadline = Deadline.from_request(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid deadline: {e}")
+    patient_name, content, filename = await read_report_input(request)
+    events = iter_analysis_events(patient_name, content, filename, request.query_params.get("cohort"), deadline)
+    if request_lane(request.scope) == "ocr":
+        events = iterate_in_pool(ocr_pool, events)
+    return StreamingResponse(events, media_type="application/x-ndjson")
+
 @app.get("/patient-history/{patient_name}")
-async def get_patient_history(patient_name: str):
+def get_patient_history(patient_name: str, request: Request):
     """
-    Get historical reports for a patient
+    Get historical reports for a patient.
+    Answers If-None-Match / If-Modified-Since with 304 from the patient's
+    version counter, without loading or decrypting any reports.
     """
     try:
+        version, updated_at = get_patient_version(patient_name)
+        etag = representation_etag(request, f"h{version}")
+        last_modified = http_date(updated_at)
+        if is_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
+
         historical_reports = load_reports_from_db(patient_name)
-        return JSONResponse(content={"patient_name": patient_name, "reports": historical_reports})
+        return encode_response(request, {"patient_name": patient_name, "reports": historical_reports},
+                               headers=validator_headers(etag, last_modified))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving patient history: {str(e)}")
 
+@app.get("/analytics/abnormal-rate")
+def get_abnormal_rate(request: Request, test: str, status: str = "High", period: str = "month",
+                            start: Optional[str] = None, end: Optional[str] = None, cohort: str = "all"):
+    """
+    Share of patients (and reports) with a given status for one test, per
+    day/week/month, e.g. ?test=SGPT&status=High&period=month&start=2024-01-01.
+    Served from incrementally maintained rollups, no report is decrypted.
+    """
+    if period not in ("day", "week", "month"):
+        raise HTTPException(status_code=400, detail="period must be day, week or month")
+    if status not in ("High", "Low", "Normal"):
+        raise HTTPException(status_code=400, detail="status must be High, Low or Normal")
+    try:
+        series = load_abnormal_rates(test, status, period, start, end, cohort)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start and end must be ISO dates (YYYY-MM-DD)")
+    return encode_response(request, {"test": test, "status": status, "period": period,
+                                     "cohort": cohort, "series": series})
+
+@app.get("/search")
+def search_report_text(request: Request, q: str, patient: Optional[str] = None,
+                             limit: int = 20, offset: int = 0):
+    """
+    Reports whose text contains every word and "quoted phrase" of q, best
+    match first, with a highlighted snippet, e.g. ?q="fatty liver"&patient=John.
+    """
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    if not 0 <= offset <= MAX_OFFSET:
+        raise HTTPException(status_code=400, detail=f"offset must be between 0 and {MAX_OFFSET}")
+    try:
+        found = search_reports(q, patient, limit, offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return encode_response(request, {"query": q, "patient": patient, "total": found["total"],
+                                     "limit": limit, "offset": offset, "results": found["results"]})
+
+# Bulk export of every patient's results is off unless a token is configured
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+
+@app.get("/export/results")
+def export_results(request: Request, since_id: str = "0", pseudonymize: bool = False):
+    """
+    Lab results of all reports saved after report id since_id, one row per
+    result, as an Arrow IPC stream. X-Export-Watermark is the last report id
+    included (comma-separated, one per shard, with DB_SHARDS > 1); pass it
+    as since_id next time. Requires Authorization: Bearer <EXPORT_TOKEN>.
+    """
+    if not EXPORT_TOKEN:
+        raise HTTPException(status_code=404, detail="Export is disabled (set EXPORT_TOKEN)")
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {EXPORT_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid export token")
+    if not PYARROW_AVAILABLE:
+        raise HTTPException(status_code=503, detail="pyarrow is not installed on the server")
+    try:
+        watermark, chunks = export_results_stream(since_id, pseudonymize)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid since_id: {e}")
+    return StreamingResponse(chunks, media_type="application/vnd.apache.arrow.stream",
+                             headers={"X-Export-Watermark": str(watermark)})
+
+@app.post("/vitals/{patient_id}")
+def ingest_vitals(patient_id: str, body: Dict[str, Any]):
+    """
+    Accepts a batch of device samples: {"samples": [{"metric": "heart_rate",
+    "value": 72, "ts": 1718000000.0}, ...]}. Rows shaped like the vitals table
+    ({"recorded_at": ..., "heart_rate": 72, "oxygen_saturation": 98}) work too.
+    """
+    samples = body.get("samples")
+    if not isinstance(samples, list):
+        raise HTTPException(status_code=400, detail="samples must be a list")
+    accepted, rejected = vitals_store.ingest(patient_id, samples)
+    return {"accepted": accepted, "rejected": rejected}
+
+@app.get("/vitals/{patient_id}/live")
+def get_live_vitals(patient_id: str, metric: str, seconds: int = 300):
+    """
+    Raw samples from the last `seconds`, read from the shared vitals store so
+    every worker sees every device. Samples posted to another worker appear
+    once it flushes, within VITALS_FLUSH_INTERVAL seconds.
+    """
+    if metric not in METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join(METRICS)}")
+    if seconds <= 0:
+        raise HTTPException(status_code=400, detail="seconds must be positive")
+    return {"patient_id": patient_id, "metric": metric, "samples": vitals_store.live(patient_id, metric, seconds)}
+
+@app.get("/vitals/{patient_id}/series")
+def get_vitals_series(request: Request, patient_id: str, metric: str, resolution: str = "minute",
+                      start: Optional[str] = None, end: Optional[str] = None):
+    """min/max/mean per minute, hour or day; start/end are ISO timestamps or epoch seconds."""
+    if metric not in METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join(METRICS)}")
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail="resolution must be minute, hour or day")
+    try:
+        start = float(start) if start and start.replace(".", "", 1).isdigit() else start
+        end = float(end) if end and end.replace(".", "", 1).isdigit() else end
+        series = vitals_store.series(patient_id, metric, resolution, start, end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start and end must be ISO timestamps or epoch seconds")
+    return encode_response(request, {"patient_id": patient_id, "metric": metric,
+                                     "resolution": resolution, "series": series})
+
+# The catalogue only changes with a deploy, so its payload and ETag are built once.
+# The ETag is weak: the same catalogue is served as JSON, MessagePack or CBOR,
+# compressed or not, and those bodies are equivalent but not byte-identical.
+TEST_PATTERNS = {
+    "message": "Test patterns available",
+    "supported_tests": [
+        "Hemoglobin", "P.C.V", "R.B.C", "W.B.C", "Platelet Count",
+        "Serum Creatinine", "Blood Urea", "Serum Sodium", "Serum Potassium",
+        "SGOT", "SGPT", "Albumin", "INR", "Blood Sugar"
+    ]
+}
+TEST_PATTERNS_ETAG = 'W/"tp-%s"' % hashlib.sha1(json.dumps(TEST_PATTERNS, sort_keys=True).encode()).hexdigest()[:16]
+
 @app.get("/test-patterns")
-async def get_test_patterns():
+async def get_test_patterns(request: Request):
     """
     Get available test patterns and their normal ranges
     """
     # This would return the medical_tests dictionary from Aimodal.py
     # For now, return a simplified version
-    return JSONResponse(content={
-        "message": "Test patterns available",
-        "supported_tests": [
-            "Hemoglobin", "P.C.V", "R.B.C", "W.B.C", "Platelet Count",
-            "Serum Creatinine", "Blood Urea", "Serum Sodium", "Serum Potassium",
-            "SGOT", "SGPT", "Albumin", "INR", "Blood Sugar"
-        ]
-    })
+    if is_not_modified(request, TEST_PATTERNS_ETAG):
+        return not_modified_response(TEST_PATTERNS_ETAG)
+    return encode_response(request, TEST_PATTERNS, headers=validator_headers(TEST_PATTERNS_ETAG))
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=5000, reload=True)
+    # Same entry point as start_server.py: dev (reload) unless SERVER_MODE=prod
+    from start_server import serve
+    sys.exit(serve(os.getenv("SERVER_MODE", "dev")))
@@ -0,0 +1,141 @@
+"""
+Fuzzy matching of OCR-garbled test names.
+
+A SymSpell-style deletion index is built once from the test catalogue and
+its aliases: every name is stored under all strings obtainable by deleting
+up to max_distance characters. A query only generates its own deletions and
+looks them up, so matching cost does not grow with the catalogue size.
+Candidates are verified with an optimal-string-alignment edit distance.
+
+correct_test_names() rewrites the word span just before each numeric value
+("Hemog1obin: 12.5", "Serum Creatinme 1.1", "S G O T 42") to the canonical
+catalogue name, so the exact regexes downstream pick them up.
+"""
+
+import re
+
+# Names shorter than this are only matched exactly (PT, CT, INR, ...)
+MIN_FUZZY_LENGTH = 5
+# Longest word span looked at before a value; spaced-out letters ("S G O T") need the most
+MAX_SPAN_WORDS = 6
+
+VALUE_TOKEN_RE = re.compile(r"^[\d\.]+")
+NON_ALNUM_RE = re.compile(r"[^0-9a-z]")
+TRAILING_PUNCT_RE = re.compile(r"[:\-=]+$")
+
+
+def normalize_name(text):
+    """Lowercases and drops spaces and punctuation: "S G O T" -> "sgot", "P.C.V" -> "pcv"."""
+    return NON_ALNUM_RE.sub("", text.lower())
+
+
+def allowed_distance(length, max_distance):
+    """Edit distance tolerated for a name of the given normalized length."""
+    if length < MIN_FUZZY_LENGTH:
+        return 0
+    if length < 9:
+        return min(1, max_distance)
+    return min(2, max_distance)
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance, or limit + 1 once it exceeds limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = current[0]
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+            row_min = min(row_min, current[j])
+        if row_min > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def deletions(word, distance):
+    """All strings obtained by deleting up to distance characters from word."""
+    variants, frontier = {word}, {word}
+    for _ in range(min(distance, len(word) - 1)):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        variants |= frontier
+    return variants
+
+
+class FuzzyNameIndex:
+    """Deletion index over {alias or name: canonical name}."""
+
+    def __init__(self, names, max_distance=2):
+        self.max_distance = max_distance
+        self.canonical = {}   # normalized key -> canonical name
+        self.index = {}       # deletion variant -> set of normalized keys
+        for name, canonical in names.items():
+            key = normalize_name(name)
+            if not key:
+                continue
+            self.canonical[key] = canonical
+            for variant in deletions(key, allowed_distance(len(key), max_distance)):
+                self.index.setdefault(variant, set()).add(key)
+
+    def lookup(self, text):
+        """Returns (canonical name, distance) of the closest catalogue name, or None."""
+        query = normalize_name(text)
+        if not query:
+            return None
+        if query in self.canonical:
+            return self.canonical[query], 0
+
+        limit = allowed_distance(len(query), self.max_distance)
+        if limit == 0:
+            return None
+        candidates = set()
+        for variant in deletions(query, limit):
+            candidates.update(self.index.get(variant, ()))
+
+        best = None
+        for key in candidates:
+            key_limit = min(limit, allowed_distance(len(key), self.max_distance))
+            distance = edit_distance(query, key, key_limit)
+            if distance <= key_limit and (best is None or distance < best[1]):
+                best = (self.canonical[key], distance)
+        return best
+
+    def correct_test_names(self, clean_text):
+        """
+        Rewrites garbled test names that directly precede a numeric value.
+        Exact (case-insensitive) catalogue names are left untouched.
+        """
+        tokens = clean_text.split(" ")
+        out = []
+        for token in tokens:
+            if VALUE_TOKEN_RE.match(token) and out:
+                self._correct_span_before(out)
+            out.append(token)
+        return " ".join(out)
+
+    def _correct_span_before(self, out):
+        best = None  # (distance, -span words, span words, canonical)
+        for span in range(1, min(MAX_SPAN_WORDS, len(out)) + 1):
+            words = out[-span:]
+            if not normalize_name(words[0]) or VALUE_TOKEN_RE.match(words[0]):
+                continue
+            if span > 3 and any(len(normalize_name(w)) > 1 for w in words):
+                continue  # long spans are only for spaced-out letters
+            match = self.lookup(" ".join(words))
+            if match and (best is None or (match[1], -span) < best[:2]):
+                best = (match[1], -span, span, match[0])
+
+        if best is None:
+            return
+        _, _, span, canonical = best
+        words = out[-span:]
+        if TRAILING_PUNCT_RE.sub("", " ".join(words)).lower() == canonical.lower():
+            return
+        suffix = TRAILING_PUNCT_RE.search(words[-1])
+        del out[-span:]
+        out.append(canonical + (suffix.group(0) if suffix else ""))
@@ -0,0 +1,190 @@
+"""
+Group commit for report saves.
+
+A save used to be its own transaction, and every commit waits for an fsync,
+so under concurrent uploads most database time went to fsyncs. Instead each
+database file gets one writer thread per process. Saves are queued as
+write(conn) callables; the writer takes whatever is queued, waits up to
+GROUP_COMMIT_WINDOW_MS for more (at most GROUP_COMMIT_MAX_BATCH), runs them
+all in one BEGIN IMMEDIATE transaction and commits once. Each write runs in
+its own savepoint, so one failing save does not take the others down.
+
+submit() returns a Future that resolves with the write's result only after
+the commit, so a caller that waits on it gets the same durability as
+before. Readers call wait_for_writes(db_file, key) first, so a history read
+never misses a save of the same patient that is still queued.
+
+GROUP_COMMIT=0 goes back to one transaction per save (commit_now).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait
+
+from sharding import writer_lock
+
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "1") != "0"
+WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "2"))
+MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "64"))
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+class GroupCommitWriter:
+    """Writer thread committing queued writes to one database file in batches."""
+
+    def __init__(self, db_file, window_ms=WINDOW_MS, max_batch=MAX_BATCH):
+        self.db_file = db_file
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = deque()
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.batches = self.writes = 0
+        self.thread = threading.Thread(target=self._run, name=f"group-commit {db_file}", daemon=True)
+        self.thread.start()
+
+    def submit(self, write, key=None):
+        """
+        Queues write(conn), which runs inside the batch transaction and must
+        not commit. Returns a Future of its result, set once committed. key
+        (e.g. a patient) is what wait_pending waits on.
+        """
+        future = Future()
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError(f"writer for {self.db_file} is closed")
+            self.queue.append((write, key, future))
+            if key is not None:
+                self.pending.setdefault(key, set()).add(future)
+            self.cond.notify()
+        return future
+
+    def wait_pending(self, key, timeout=None):
+        """Blocks until writes queued under key so far are committed (or failed)."""
+        with self.cond:
+            futures = list(self.pending.get(key, ()))
+        if futures:
+            wait(futures, timeout)
+
+    def _take_batch(self):
+        with self.cond:
+            while not self.queue and not self.stopped:
+                self.cond.wait()
+            if not self.queue:
+                return None
+            # Give concurrent requests a short window to join this commit
+            deadline = time.monotonic() + self.window
+            while len(self.queue) < self.max_batch and not self.stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return [self.queue.popleft() for _ in range(min(len(self.queue), self.max_batch))]
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                break
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        outcomes = []
+        try:
+            with writer_lock(self.db_file):
+                conn.execute("BEGIN IMMEDIATE")
+                for write, _, future in batch:
+                    conn.execute("SAVEPOINT batch_write")
+                    try:
+                        outcomes.append((future, write(conn), None))
+                        conn.execute("RELEASE batch_write")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO batch_write")
+                        conn.execute("RELEASE batch_write")
+                        outcomes.append((future, None, e))
+                conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            outcomes = [(future, None, e) for _, _, future in batch]
+
+        with self.cond:
+            self.batches += 1
+            self.writes += len(batch)
+            for _, key, future in batch:
+                waiting = self.pending.get(key)
+                if waiting is not None:
+                    waiting.discard(future)
+                    if not waiting:
+                        del self.pending[key]
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        """Commits what is still queued and stops the thread."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+
+
+def get_writer(db_file):
+    with _writers_lock:
+        writer = _writers.get(db_file)
+        if writer is None:
+            writer = _writers[db_file] = GroupCommitWriter(db_file)
+        return writer
+
+
+def commit_now(db_file, write):
+    """write(conn) in a transaction of its own, as a completed Future (GROUP_COMMIT=0)."""
+    future = Future()
+    conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+    try:
+        with writer_lock(db_file):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = write(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        future.set_result(result)
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        conn.close()
+    return future
+
+
+def submit_write(db_file, write, key=None):
+    """Group-committed write, or an immediate one with GROUP_COMMIT=0. Returns a Future of write's result."""
+    if GROUP_COMMIT:
+        return get_writer(db_file).submit(write, key)
+    return commit_now(db_file, write)
+
+
+def wait_for_writes(db_file, key):
+    """Read-your-writes: waits for this process's queued writes under key to db_file."""
+    writer = _writers.get(db_file)
+    if writer is not None:
+        writer.wait_pending(key)
+
+
+def close_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Online re-encryption of the patient_reports table.
+
+Re-encrypts every row (the report and its stored search text) that is not
+yet on the current key version, walking
+the table by id in small chunks. Each chunk is decrypted/re-encrypted by a
+worker pool and written back in one short transaction, so readers (WAL
+mode) are never locked out. Progress is checkpointed in the database, so an
+interrupted run resumes where it stopped, and --rate caps rows per second.
+Encrypted patient names (the patients table) are re-encrypted afterwards
+in one short pass. Without SEARCH_TOKEN_KEY the full-text index hashes
+words with a key derived from ENCRYPTION_KEY, so it is then rebuilt under
+the new key; until that finishes, search finds none of the older reports.
+
+Rotating to a new key:
+    1. Move the old key into RETIRED_ENCRYPTION_KEYS (e.g. "1:<old key>"). If
+       PATIENT_INDEX_KEY is not set, set it to the old key too, so patients
+       are still found by name
+    2. Set ENCRYPTION_KEY to the new key and bump ENCRYPTION_KEY_VERSION
+    3. Restart the server, then run:  python key_rotation.py
+       (it also rebuilds the search index unless SEARCH_TOKEN_KEY is set,
+       as python search_index.py rebuild would)
+    4. Once it reports 0 remaining rows, drop the old key from the env
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from report_codec import reencrypt
+
+_worker_keys = None
+
+
+def _init_worker(keys):
+    """Stores the {version: key} ring (current key first) once per worker process."""
+    global _worker_keys
+    _worker_keys = keys
+
+
+def _rotate_rows(rows):
+    """
+    Re-encrypts (id, blob, text_blob, key_version) rows with the current key,
+    keeping each blob's storage format. Returns (id, old blob, new blob,
+    new text blob); unreadable rows get None as the new blob.
+    """
+    current_key = next(iter(_worker_keys.values()))
+    rotated = []
+    for row_id, blob, text_blob, key_version in rows:
+        if key_version in _worker_keys:
+            keys = [_worker_keys[key_version]]
+        else:
+            keys = list(_worker_keys.values())
+        try:
+            new_text = reencrypt(text_blob, keys, current_key) if text_blob is not None else None
+            rotated.append((row_id, blob, reencrypt(blob, keys, current_key), new_text))
+        except Exception:
+            rotated.append((row_id, blob, None, None))
+    return rotated
+
+
+def setup_checkpoints(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS key_rotation_state (
+            target_version INTEGER PRIMARY KEY,
+            last_id INTEGER NOT NULL, rows_done INTEGER NOT NULL, updated_at TEXT NOT NULL
+        )
+    ''')
+    conn.commit()
+
+
+def load_checkpoint(conn, target_version):
+    row = conn.execute("SELECT last_id, rows_done FROM key_rotation_state WHERE target_version = ?",
+                       (target_version,)).fetchone()
+    return row if row else (0, 0)
+
+
+def remaining_rows(conn, target_version):
+    return conn.execute("SELECT COUNT(*) FROM patient_reports WHERE key_version IS NULL OR key_version != ?",
+                        (target_version,)).fetchone()[0]
+
+
+def rotate_keys(db_file, keys, target_version, chunk_size=1000, workers=None, rate=None, restart=False):
+    """
+    Re-encrypts all rows not on target_version. keys maps key version to raw
+    Fernet key, with the target (current) key first. rate caps rows/second
+    (None = unthrottled). Returns (rows_rotated, rows_failed).
+    """
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    setup_checkpoints(conn)
+    if restart:
+        conn.execute("DELETE FROM key_rotation_state WHERE target_version = ?", (target_version,))
+        conn.commit()
+
+    last_id, rows_done = load_checkpoint(conn, target_version)
+    print(f"Rotating to key version {target_version}: {remaining_rows(conn, target_version)} rows to go"
+          f"{f', resuming after id {last_id}' if last_id else ''}")
+
+    workers = workers or os.cpu_count() or 1
+    slice_size = max(1, chunk_size // workers)
+    rotated_total, failed_total = 0, 0
+    started = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(keys,)) as pool:
+        while True:
+            chunk_started = time.monotonic()
+            rows = conn.execute(
+                "SELECT id, report_data, text_data, key_version FROM patient_reports "
+                "WHERE id > ? AND (key_version IS NULL OR key_version != ?) ORDER BY id LIMIT ?",
+                (last_id, target_version, chunk_size)).fetchall()
+            if not rows:
+                break
+
+            slices = [rows[i:i + slice_size] for i in range(0, len(rows), slice_size)]
+            results = [item for part in pool.map(_rotate_rows, slices) for item in part]
+
+            updates = [(new_blob, new_text, target_version, row_id, old_blob)
+                       for row_id, old_blob, new_blob, new_text in results if new_blob is not None]
+            failed = len(results) - len(updates)
+            last_id = rows[-1][0]
+
+            # Only touch rows that were not rewritten by someone else meanwhile
+            with conn:
+                conn.executemany("UPDATE patient_reports SET report_data = ?, text_data = ?, key_version = ? "
+                                 "WHERE id = ? AND report_data = ?", updates)
+                conn.execute('''
+                    INSERT INTO key_rotation_state (target_version, last_id, rows_done, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(target_version) DO UPDATE SET
+                        last_id = excluded.last_id, rows_done = excluded.rows_done, updated_at = excluded.updated_at
+                ''', (target_version, last_id, rows_done + rotated_total + len(updates),
+                      datetime.utcnow().isoformat()))
+
+            rotated_total += len(updates)
+            failed_total += failed
+            if failed:
+                print(f"  {failed} rows up to id {last_id} could not be decrypted with any configured key")
+
+            elapsed = time.monotonic() - started
+            print(f"  id <= {last_id}: {rotated_total} rotated, {rotated_total / max(elapsed, 1e-9):.0f} rows/s")
+
+            # Throttle: each chunk takes at least len(rows) / rate seconds
+            if rate:
+                pause = len(rows) / rate - (time.monotonic() - chunk_started)
+                if pause > 0:
+                    time.sleep(pause)
+
+    print(f"Done: {rotated_total} rotated, {failed_total} unreadable, "
+          f"{remaining_rows(conn, target_version)} rows still on other keys")
+    conn.close()
+    return rotated_total, failed_total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk", type=int, default=1000, help="rows per transaction")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--rate", type=float, default=None, help="maximum rows per second")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    args = parser.parse_args()
+
+    from Aimodal import ENCRYPTION_KEY_VERSION, KEY_BYTES, SEARCH_KEY, SHARD_FILES, setup_database
+    from patient_ids import rotate_names
+    from search_index import rebuild_index
+
+    setup_database()
+    for db_file in SHARD_FILES:
+        rotate_keys(db_file, KEY_BYTES, ENCRYPTION_KEY_VERSION, args.chunk, args.workers, args.rate, args.restart)
+        rotated, failed = rotate_names(db_file, KEY_BYTES, ENCRYPTION_KEY_VERSION)
+        print(f"Patient names: {rotated} rotated{f', {failed} unreadable' if failed else ''}")
+        if not os.getenv("SEARCH_TOKEN_KEY"):
+            # The index's word hashes were keyed from the old ENCRYPTION_KEY
+            indexed, skipped = rebuild_index(db_file, SEARCH_KEY, KEY_BYTES)
+            print(f"Search index: {indexed} reports re-indexed under the new key"
+                  f"{f', {skipped} unreadable' if skipped else ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
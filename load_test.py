@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Load generator and capacity report for the Medical Report AI server.
+
+Drives /analyze-report (text, PDF and image uploads), /patient-history and
+/health with a weighted request mix, stepping up the load and printing a
+throughput-vs-latency table, error rates and the saturation point.
+Requests shed by admission control (429/503) are counted apart from
+errors. "cheap p95" covers text, history and health requests only, which
+should stay fast while uploads queue for OCR.
+
+    # closed loop: N concurrent clients per step
+    python load_test.py --spawn --concurrency 1,2,4,8,16,32
+    # the same, with a 1.5 s budget on every upload
+    python load_test.py --spawn --deadline-ms 1500 --slo 1500
+    # open loop: Poisson arrivals at R requests/second per step
+    python load_test.py --url http://127.0.0.1:8000 --rates 5,10,20,40
+
+--spawn starts a production-mode server (start_server.serve("prod")) on a
+copy of the database (DB_FILE, every shard), so load-test reports never
+reach the real one.
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from sharding import shard_files
+
+DEFAULT_MIX = "text=5,pdf=2,image=1,history=2,health=1"
+# Request kinds admitted to the server's cheap lane (see admission.py)
+CHEAP_KINDS = ("text", "history", "health")
+PATIENTS = 50
+
+
+def load_payloads():
+    """Reads the sample report in text, PDF and PNG form."""
+    with open("test_medical_report.txt", "r", encoding="utf-8") as f:
+        text = f.read()
+    with open("Report_2420056.pdf", "rb") as f:
+        pdf = f.read()
+
+    image = None
+    try:
+        import fitz  # PyMuPDF
+        doc = fitz.open(stream=pdf, filetype="pdf")
+        image = doc[0].get_pixmap(dpi=150).tobytes("png")
+        doc.close()
+    except ImportError:
+        pass
+    return {"text": text, "pdf": pdf, "image": image}
+
+
+def parse_mix(spec, payloads):
+    """Parses "text=5,pdf=2,..." into (kinds, weights), dropping unavailable payloads."""
+    kinds, weights = [], []
+    for part in spec.split(","):
+        kind, weight = part.split("=")
+        if kind in payloads and payloads[kind] is None:
+            print(f"⚠️  No {kind} payload available, dropping it from the mix")
+            continue
+        kinds.append(kind)
+        weights.append(float(weight))
+    return kinds, weights
+
+
+async def send(client, kind, payloads, rng):
+    """Sends one request of the given kind; returns the response."""
+    patient_name = f"Load Patient {rng.randrange(PATIENTS)}"
+    if kind == "text":
+        response = await client.post("/analyze-report",
+                                     json={"patient_name": patient_name, "text_input": payloads["text"]})
+    elif kind == "pdf":
+        response = await client.post("/analyze-report", data={"patient_name": patient_name},
+                                     files={"file": ("report.pdf", payloads["pdf"], "application/pdf")})
+    elif kind == "image":
+        response = await client.post("/analyze-report", data={"patient_name": patient_name},
+                                     files={"file": ("report.png", payloads["image"], "image/png")})
+    elif kind == "history":
+        response = await client.get(f"/patient-history/{patient_name}")
+    else:
+        response = await client.get("/health")
+    return response
+
+
+async def timed_send(client, kind, payloads, rng, samples, tiers):
+    start = time.perf_counter()
+    try:
+        response = await send(client, kind, payloads, rng)
+        status = response.status_code
+        tier = response.headers.get("X-Analysis-Tier")
+        if tier:
+            tiers[tier] = tiers.get(tier, 0) + 1
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    samples.append((kind, time.perf_counter() - start, status))
+
+
+async def run_closed_step(client, concurrency, duration, kinds, weights, payloads, rng, tiers):
+    """concurrency clients each send back-to-back requests for duration seconds."""
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def user():
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            await timed_send(client, kind, payloads, rng, samples, tiers)
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return samples, 0
+
+
+async def run_open_step(client, rate, duration, max_in_flight, kinds, weights, payloads, rng, tiers):
+    """Poisson arrivals at rate/s; arrivals beyond max_in_flight are counted as dropped."""
+    samples, tasks, dropped = [], set(), 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.expovariate(rate))
+        if len(tasks) >= max_in_flight:
+            dropped += 1
+            continue
+        kind = rng.choices(kinds, weights)[0]
+        task = asyncio.create_task(timed_send(client, kind, payloads, rng, samples, tiers))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return samples, dropped
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def summarize(load, samples, dropped, elapsed):
+    """One row of the capacity table."""
+    ok = sorted(latency for _, latency, status in samples if status == 200)
+    cheap = sorted(latency for kind, latency, status in samples if status == 200 and kind in CHEAP_KINDS)
+    shed = sum(1 for _, _, status in samples if status in (429, 503))
+    errors = len(samples) - len(ok) - shed
+    total = len(samples) + dropped
+    return {
+        "load": load,
+        "requests": len(samples),
+        "throughput": len(ok) / elapsed,
+        "p50_ms": percentile(ok, 50) * 1000,
+        "p95_ms": percentile(ok, 95) * 1000,
+        "p99_ms": percentile(ok, 99) * 1000,
+        "cheap_p95_ms": percentile(cheap, 95) * 1000,
+        "shed_rate": shed / total if total else 0.0,
+        "error_rate": (errors + dropped) / total if total else 0.0,
+    }
+
+
+def find_saturation(rows, slo_ms, max_error_rate):
+    """
+    Returns (best, knee): the highest-throughput step within the latency SLO
+    and error budget, and the first step where throughput stops growing
+    (<10% gain) while p95 latency climbs by 50% or more.
+    """
+    within = [r for r in rows if r["p95_ms"] <= slo_ms and r["error_rate"] + r["shed_rate"] <= max_error_rate]
+    best = max(within, key=lambda r: r["throughput"]) if within else None
+    knee = None
+    for previous, row in zip(rows, rows[1:]):
+        if row["throughput"] < previous["throughput"] * 1.1 and row["p95_ms"] >= previous["p95_ms"] * 1.5:
+            knee = previous
+            break
+    return best, knee
+
+
+def wait_for_server(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{url}/health", timeout=2).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def spawn_server(port, workers, db_dir):
+    """Starts the server in prod mode on a copy of the database (every shard of it, with DB_SHARDS)."""
+    from Aimodal import DB_FILE, DB_SHARDS, SHARD_FILES
+
+    db_file = os.path.join(db_dir, os.path.basename(DB_FILE))
+    for source, copy in zip(SHARD_FILES, shard_files(db_file, DB_SHARDS)):
+        if os.path.exists(source):
+            # backup() includes transactions still in the -wal file, which a file copy would lose
+            source_conn, copy_conn = sqlite3.connect(source), sqlite3.connect(copy)
+            try:
+                source_conn.backup(copy_conn)
+            finally:
+                copy_conn.close()
+                source_conn.close()
+    env = dict(os.environ, DB_FILE=db_file, SERVER_PORT=str(port), SERVER_HOST="127.0.0.1")
+    if workers:
+        env["SERVER_WORKERS"] = str(workers)
+    return subprocess.Popen([sys.executable, "-c", "import start_server, sys; sys.exit(start_server.serve('prod'))"],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+async def run(args):
+    payloads = load_payloads()
+    kinds, weights = parse_mix(args.mix, payloads)
+    rng = random.Random(args.seed)
+
+    if args.rates:
+        steps = [float(r) for r in args.rates.split(",")]
+        label = "req/s in"
+    else:
+        steps = [int(c) for c in args.concurrency.split(",")]
+        label = "clients"
+    max_in_flight = args.max_in_flight or 1000
+
+    limits = httpx.Limits(max_connections=max(max_in_flight if args.rates else max(steps), 1))
+    rows, failures, tiers = [], {}, {}
+    # With --deadline-ms every report upload carries a latency budget and the
+    # server degrades its analysis to meet it (see deadlines.py)
+    headers = {"X-Deadline-Ms": str(args.deadline_ms)} if args.deadline_ms else None
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits, headers=headers) as client:
+        print(f"{label:>9}{'reqs':>8}{'ok/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'cheap p95':>11}{'shed':>7}{'errors':>8}")
+        for step in steps:
+            started = time.perf_counter()
+            if args.rates:
+                samples, dropped = await run_open_step(client, step, args.duration, max_in_flight,
+                                                       kinds, weights, payloads, rng, tiers)
+            else:
+                samples, dropped = await run_closed_step(client, step, args.duration,
+                                                         kinds, weights, payloads, rng, tiers)
+            row = summarize(step, samples, dropped, time.perf_counter() - started)
+            for kind, _, status in samples:
+                if status != 200:
+                    failures[(kind, status)] = failures.get((kind, status), 0) + 1
+            rows.append(row)
+            print(f"{step:>9g}{row['requests']:>8}{row['throughput']:>9.1f}{row['p50_ms']:>9.0f}"
+                  f"{row['p95_ms']:>9.0f}{row['p99_ms']:>9.0f}{row['cheap_p95_ms']:>11.0f}{row['shed_rate']:>7.1%}{row['error_rate']:>8.1%}")
+            await asyncio.sleep(args.cooldown)
+
+    best, knee = find_saturation(rows, args.slo, args.max_error_rate)
+    print()
+    if best:
+        print(f"✅ Capacity: {best['throughput']:.1f} req/s at {best['load']:g} {label} "
+              f"(p95 {best['p95_ms']:.0f} ms <= {args.slo:.0f} ms, "
+              f"{best['error_rate'] + best['shed_rate']:.1%} failed)")
+    else:
+        print(f"❌ No step met p95 <= {args.slo:.0f} ms with <= {args.max_error_rate:.0%} failures")
+    if knee:
+        print(f"📈 Saturation: throughput flattens after {knee['load']:g} {label} "
+              f"({knee['throughput']:.1f} req/s) while latency keeps rising")
+    else:
+        print("📈 No saturation knee in the tested range; add higher steps")
+
+    if failures:
+        print("Failures by request type: " + ", ".join(
+            f"{kind} {status} x{count}" for (kind, status), count in sorted(failures.items(), key=str)))
+
+    if tiers:
+        print("Analysis tiers: " + ", ".join(f"{tier} x{count}" for tier, count in sorted(tiers.items())))
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Curve written to {args.csv}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--spawn", action="store_true", help="start a prod-mode server on a copy of the database")
+    parser.add_argument("--port", type=int, default=8765, help="port for --spawn")
+    parser.add_argument("--workers", type=int, default=None, help="server workers for --spawn (default: per core)")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="closed-loop client counts per step")
+    parser.add_argument("--rates", default=None, help="open-loop arrival rates (req/s) per step")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="open-loop cap on outstanding requests")
+    parser.add_argument("--duration", type=float, default=15, help="seconds per step")
+    parser.add_argument("--cooldown", type=float, default=2, help="idle seconds between steps")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="request mix weights")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--slo", type=float, default=2000, help="p95 latency target in ms")
+    parser.add_argument("--deadline-ms", type=float, default=None,
+                        help="send this latency budget with every request (X-Deadline-Ms)")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--csv", default=None, help="write the throughput/latency curve here")
+    args = parser.parse_args()
+
+    server = None
+    db_dir = None
+    if args.spawn:
+        db_dir = tempfile.mkdtemp(prefix="loadtest-")
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = spawn_server(args.port, args.workers, db_dir)
+        print(f"🚀 Starting server on {args.url} ...")
+        if not wait_for_server(args.url):
+            print("❌ Server did not become healthy")
+            os.killpg(server.pid, signal.SIGTERM)
+            return 1
+
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+            shutil.rmtree(db_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
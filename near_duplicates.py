@@ -0,0 +1,146 @@
+"""
+Near-duplicate report detection with MinHash and LSH.
+
+The same paper report photographed twice gives slightly different OCR text,
+so exact hashes miss it. Each saved report's clean text is reduced to a
+MinHash signature over character shingles, and the signature's bands are
+indexed per patient. Only shingles containing a digit are used: reports
+from the same lab share their template text, and it is the results, dates
+and sample numbers that tell two of them apart.
+
+    report_signatures  report id -> patient key, MinHash signature
+    report_lsh         (patient key, band, band hash) -> report id
+
+A new report's bands are looked up with one indexed query, so the cost
+depends on how many stored reports share a band, not on the size of the
+archive. Candidates are then ranked by estimated Jaccard similarity.
+
+Reports saved before signatures existed have no stored text and are not
+indexed.
+"""
+
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+
+from analytics import patient_key
+
+# Set NEAR_DUPLICATE_DETECTION=0 to analyze and save every upload
+NEAR_DUPLICATE_DETECTION = os.getenv("NEAR_DUPLICATE_DETECTION", "1") != "0"
+# Estimated Jaccard similarity of shingle sets above which two reports are near-duplicates
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+# 16 bands of 8 rows: pairs at 0.8 similarity share a band 95% of the time,
+# pairs at 0.5 (a new report on the same template) about 6% of the time
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+# Multiply-shift hash family: h(x) = (a * x + b) >> 32 over 64-bit words, a odd
+_rng = np.random.RandomState(20240517)
+_A = (_rng.randint(0, 2 ** 31, NUM_PERM, dtype=np.uint64) << np.uint64(32)) | \
+     _rng.randint(0, 2 ** 32, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_B = (_rng.randint(0, 2 ** 31, NUM_PERM, dtype=np.uint64) << np.uint64(32)) | \
+     _rng.randint(0, 2 ** 32, NUM_PERM, dtype=np.uint64)
+_SHIFT = np.uint64(32)
+_EMPTY = np.full(NUM_PERM, 2 ** 32 - 1, dtype=np.uint32)
+
+NON_WORD_RE = re.compile(r"[^a-z0-9.]+")
+DIGIT_RE = re.compile(r"\d")
+
+
+def setup_signature_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS report_signatures (
+            report_id INTEGER PRIMARY KEY, patient_key TEXT NOT NULL, signature BLOB NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS report_lsh (
+            patient_key TEXT NOT NULL, band INTEGER NOT NULL, bucket INTEGER NOT NULL, report_id INTEGER NOT NULL,
+            PRIMARY KEY (patient_key, band, bucket, report_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def shingles(clean_text):
+    """
+    crc32 of the SHINGLE_SIZE-character windows of the lower-cased,
+    punctuation-free text that contain a digit (all windows if none do).
+    """
+    text = NON_WORD_RE.sub(" ", clean_text.lower()).strip()
+    windows = {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))} if text else set()
+    with_digits = {window for window in windows if DIGIT_RE.search(window)}
+    return np.fromiter((zlib.crc32(window.encode("utf-8")) for window in with_digits or windows), dtype=np.uint64)
+
+
+def minhash(clean_text):
+    """NUM_PERM uint32 minimum hashes of the text's shingle set."""
+    values = shingles(clean_text)
+    if not len(values):
+        return _EMPTY.copy()
+    # (NUM_PERM, shingles) matrix of hashes; uint64 arithmetic wraps around as intended
+    hashed = (_A[:, None] * values[None, :] + _B[:, None]) >> _SHIFT
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def band_buckets(signature):
+    """[(band, bucket)] with each band's rows hashed to a signed 64-bit integer."""
+    return [(band, int.from_bytes(hashlib.blake2b(signature[band * ROWS:(band + 1) * ROWS].tobytes(),
+                                                  digest_size=8).digest(), "little", signed=True))
+            for band in range(BANDS)]
+
+
+def similarity(signature, other):
+    """Estimated Jaccard similarity of the two shingle sets."""
+    return float(np.count_nonzero(signature == other)) / NUM_PERM
+
+
+def store_signature(conn, report_id, patient_id, signature):
+    """Indexes a saved report. Runs inside the caller's transaction."""
+    key = patient_key(patient_id)
+    conn.execute("INSERT OR REPLACE INTO report_signatures (report_id, patient_key, signature) VALUES (?, ?, ?)",
+                 (report_id, key, signature.tobytes()))
+    conn.executemany("INSERT OR IGNORE INTO report_lsh (patient_key, band, bucket, report_id) VALUES (?, ?, ?, ?)",
+                     [(key, band, bucket, report_id) for band, bucket in band_buckets(signature)])
+
+
+def find_near_duplicates(conn, patient_id, signature, threshold=None):
+    """[(report_id, similarity)] of the patient's indexed reports at or above threshold, most similar first."""
+    threshold = NEAR_DUPLICATE_THRESHOLD if threshold is None else threshold
+    buckets = band_buckets(signature)
+    # Joining from the VALUES list makes each band one primary-key lookup
+    rows = conn.execute(f'''
+        SELECT s.report_id, s.signature FROM report_signatures s
+        WHERE s.report_id IN (
+            SELECT l.report_id FROM (VALUES {", ".join(["(?, ?)"] * len(buckets))}) v
+            JOIN report_lsh l ON l.patient_key = ? AND l.band = v.column1 AND l.bucket = v.column2
+        )
+    ''', [value for bucket in buckets for value in bucket] + [patient_key(patient_id)]).fetchall()
+
+    matches = []
+    for report_id, blob in rows:
+        score = similarity(signature, np.frombuffer(blob, dtype=np.uint32))
+        if score >= threshold:
+            matches.append((report_id, score))
+    return sorted(matches, key=lambda match: -match[1])
+
+
+def same_results(tests, stored_tests, min_overlap=0.8):
+    """
+    True if two extractions report the same results: most test names are
+    shared (OCR may miss a row in one copy) and every shared test has the same
+    value. A new report printed from the same lab template shares most of its
+    text with older ones, so similar text alone is not enough.
+    """
+    values = {t["test_name"]: round(float(t["value"]), 3) for t in tests}
+    stored = {t["test_name"]: round(float(t["value"]), 3) for t in stored_tests}
+    shared = values.keys() & stored.keys()
+    union = values.keys() | stored.keys()
+    if not union or len(shared) < min_overlap * len(union):
+        return False
+    return all(values[name] == stored[name] for name in shared)
@@ -0,0 +1,137 @@
+"""
+OCR backends.
+
+pytesseract writes every image to a temp file and spawns a fresh tesseract
+process that reloads the language data each time. The tesserocr backend
+keeps one initialized TessBaseAPI per worker thread instead, so each page
+only pays for recognition. Select with OCR_BACKEND=auto|tesserocr|pytesseract
+(auto prefers tesserocr when it is installed) and OCR_LANG (default "eng").
+
+Since tesserocr's API is per thread, OCR belongs on a fixed pool of
+threads that are warmed up once (warm_up_threads), not on a general
+threadpool whose threads would each load their own copy on first use.
+"""
+
+import os
+import threading
+from concurrent.futures import wait
+
+# Optional imports with fallback handling
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto").lower()
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+
+
+class PytesseractEngine:
+    """Spawns the tesseract CLI for every image (the original behaviour)."""
+
+    name = "pytesseract"
+
+    def __init__(self, lang=OCR_LANG):
+        if pytesseract is None:
+            raise ImportError("pytesseract is not installed")
+        self.lang = lang
+
+    def image_to_string(self, img):
+        return pytesseract.image_to_string(img, lang=self.lang)
+
+    def warm_up(self):
+        pytesseract.get_tesseract_version()
+
+
+class TesserocrEngine:
+    """Keeps one initialized tesseract API per thread for the life of the worker."""
+
+    name = "tesserocr"
+
+    def __init__(self, lang=OCR_LANG):
+        if tesserocr is None:
+            raise ImportError("tesserocr is not installed")
+        self.lang = lang
+        self._local = threading.local()
+
+    def _api(self):
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = tesserocr.PyTessBaseAPI(lang=self.lang)
+            self._local.api = api
+        return api
+
+    def image_to_string(self, img):
+        api = self._api()
+        api.SetImage(img)
+        return api.GetUTF8Text()
+
+    def warm_up(self):
+        self._api()
+
+
+BACKENDS = {
+    "tesserocr": TesserocrEngine,
+    "pytesseract": PytesseractEngine,
+}
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def available_backends():
+    """Names of the OCR backends whose Python package is installed."""
+    names = []
+    if tesserocr is not None:
+        names.append("tesserocr")
+    if pytesseract is not None:
+        names.append("pytesseract")
+    return names
+
+
+def get_ocr_engine(backend=None):
+    """
+    Returns the shared engine for backend (default: OCR_BACKEND).
+    Raises ImportError when no OCR backend is installed.
+    """
+    backend = (backend or OCR_BACKEND).lower()
+    if backend == "auto":
+        installed = available_backends()
+        if not installed:
+            raise ImportError("No OCR backend installed. Install tesserocr or pytesseract.")
+        backend = installed[0]
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown OCR backend '{backend}'. Choose from: auto, {', '.join(BACKENDS)}")
+
+    with _engines_lock:
+        if backend not in _engines:
+            _engines[backend] = BACKENDS[backend]()
+        return _engines[backend]
+
+
+def warm_up_threads(pool, threads, backend=None, timeout=60):
+    """
+    Loads the OCR engine on each of the pool's threads (a ThreadPoolExecutor
+    with max_workers=threads) before they take real work.
+    """
+    # Each task holds its thread until all have started, so every thread gets one
+    barrier = threading.Barrier(threads, timeout=timeout)
+
+    def warm_up():
+        barrier.wait()
+        get_ocr_engine(backend).warm_up()
+
+    futures = [pool.submit(warm_up) for _ in range(threads)]
+    wait(futures)
+    for future in futures:
+        future.result()
+
+
+def ocr_image(img, backend=None):
+    """Recognizes the text in a PIL image with the configured backend."""
+    return get_ocr_engine(backend).image_to_string(img)
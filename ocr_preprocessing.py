@@ -0,0 +1,203 @@
+"""
+Image preprocessing for OCR.
+
+Scanned pages and phone photos are normalized before they reach tesseract:
+the render DPI (or downscale factor) is picked from the measured text line
+height, JPEGs are decoded in reduced-size draft mode, and the image is
+converted to grayscale, binarized, deskewed and cropped to the text region.
+Set OCR_PREPROCESS=0 to fall back to the raw 300 DPI / full-resolution path.
+"""
+
+import os
+
+# Optional imports with fallback handling
+try:
+    import numpy as np
+    from PIL import Image, ImageOps
+    PREPROCESSING_AVAILABLE = True
+except ImportError:
+    np = None
+    Image = None
+    ImageOps = None
+    PREPROCESSING_AVAILABLE = False
+
+PREPROCESS_ENABLED = os.getenv("OCR_PREPROCESS", "1").lower() not in ("0", "false", "no")
+
+DEFAULT_DPI = 300
+MIN_DPI = 150
+MAX_DPI = 300
+PROBE_DPI = 72
+# Tesseract is most accurate when a text line is roughly 30-50 px tall.
+TARGET_LINE_HEIGHT = 40
+# Longest side a phone photo is decoded to (about A4 at 300 DPI).
+MAX_IMAGE_SIDE = 3508
+MAX_SKEW_DEGREES = 5.0
+SKEW_STEP_DEGREES = 0.25
+CROP_MARGIN = 12
+
+
+def otsu_threshold(gray):
+    """Returns the Otsu threshold of an 8-bit grayscale PIL image."""
+    histogram = gray.histogram()[:256]
+    total = sum(histogram)
+    sum_all = sum(i * h for i, h in enumerate(histogram))
+    sum_bg, weight_bg = 0.0, 0
+    best_threshold, best_variance = 127, -1.0
+    for level, count in enumerate(histogram):
+        weight_bg += count
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += level * count
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best_variance, best_threshold = variance, level
+    return best_threshold
+
+
+def binarize(gray):
+    """Converts a grayscale image to black text on a white background."""
+    threshold = otsu_threshold(gray)
+    return gray.point(lambda p: 255 if p > threshold else 0)
+
+
+def estimate_line_height(gray):
+    """
+    Estimates the median text line height in pixels from the horizontal
+    projection profile. Returns None when no text lines are found.
+    """
+    dark = np.asarray(binarize(gray)) == 0
+    if not dark.any():
+        return None
+    rows = dark.sum(axis=1) > max(1, dark.shape[1] // 100)
+
+    heights, run = [], 0
+    for is_text in rows:
+        if is_text:
+            run += 1
+        elif run:
+            heights.append(run)
+            run = 0
+    if run:
+        heights.append(run)
+
+    heights = [h for h in heights if h >= 2]
+    if not heights:
+        return None
+    return float(np.median(heights))
+
+
+def choose_render_dpi(page):
+    """
+    Picks the render DPI for a scanned PDF page by probing it at low
+    resolution and scaling so text lines land near TARGET_LINE_HEIGHT.
+    """
+    if not (PREPROCESS_ENABLED and PREPROCESSING_AVAILABLE):
+        return DEFAULT_DPI
+    try:
+        import fitz  # PyMuPDF
+        pix = page.get_pixmap(dpi=PROBE_DPI, colorspace=fitz.csGRAY)
+        probe = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+    except Exception:
+        return DEFAULT_DPI
+
+    line_height = estimate_line_height(probe)
+    if not line_height:
+        return DEFAULT_DPI
+    dpi = PROBE_DPI * TARGET_LINE_HEIGHT / line_height
+    dpi = int(round(dpi / 25.0) * 25)
+    return max(MIN_DPI, min(MAX_DPI, dpi))
+
+
+def open_image(source, max_side=MAX_IMAGE_SIDE):
+    """
+    Opens an uploaded image for OCR. JPEGs are decoded in draft mode,
+    directly to grayscale and at the smallest power-of-two reduction that
+    still keeps the longest side above max_side.
+    """
+    img = Image.open(source)
+    if PREPROCESS_ENABLED and img.format == "JPEG":
+        scale = max(img.size) / max_side
+        if scale > 1:
+            img.draft("L", (int(img.size[0] / scale), int(img.size[1] / scale)))
+        else:
+            img.draft("L", img.size)
+    return img
+
+
+def deskew(binary):
+    """Rotates a binarized page so its text lines are horizontal."""
+    small = binary.copy()
+    small.thumbnail((800, 800))
+    best_angle, best_score = 0.0, -1.0
+    steps = int(MAX_SKEW_DEGREES / SKEW_STEP_DEGREES)
+    for i in range(-steps, steps + 1):
+        angle = i * SKEW_STEP_DEGREES
+        rotated = small.rotate(angle, resample=Image.NEAREST, fillcolor=255)
+        profile = (np.asarray(rotated) == 0).sum(axis=1)
+        score = float(np.var(profile))
+        if score > best_score:
+            best_angle, best_score = angle, score
+
+    if abs(best_angle) < SKEW_STEP_DEGREES:
+        return binary
+    return binary.rotate(best_angle, resample=Image.NEAREST, expand=True, fillcolor=255)
+
+
+def crop_to_text(binary):
+    """Crops a binarized image to the bounding box of its dark pixels plus a margin."""
+    bbox = ImageOps.invert(binary).getbbox()
+    if not bbox:
+        return binary
+    left, top, right, bottom = bbox
+    return binary.crop((
+        max(0, left - CROP_MARGIN),
+        max(0, top - CROP_MARGIN),
+        min(binary.width, right + CROP_MARGIN),
+        min(binary.height, bottom + CROP_MARGIN),
+    ))
+
+
+def preprocess_for_ocr(img, max_side=MAX_IMAGE_SIDE):
+    """
+    Grayscale -> resolution normalization -> binarize -> deskew -> crop.
+    Returns the image unchanged when preprocessing is disabled or unavailable.
+    """
+    if not (PREPROCESS_ENABLED and PREPROCESSING_AVAILABLE):
+        # Raw path keeps full resolution unless a caller asks for less
+        if max_side < MAX_IMAGE_SIDE and max(img.size) > max_side:
+            img.thumbnail((max_side, max_side))
+        return img
+
+    gray = ImageOps.exif_transpose(img)
+    if gray.mode != "L":
+        gray = gray.convert("L")
+    if max(gray.size) > max_side:
+        gray.thumbnail((max_side, max_side))
+
+    # Phone photos are often shot far closer than needed; shrink them so
+    # text lines are near the size tesseract works best at.
+    line_height = estimate_line_height(gray)
+    if line_height and line_height > TARGET_LINE_HEIGHT * 1.5:
+        scale = TARGET_LINE_HEIGHT / line_height
+        gray = gray.resize((max(1, int(gray.width * scale)), max(1, int(gray.height * scale))), Image.LANCZOS)
+
+    binary = binarize(gray)
+    binary = deskew(binary)
+    return crop_to_text(binary)
+
+
+def render_page_for_ocr(page, max_dpi=MAX_DPI):
+    """Renders a scanned PDF page to a PIL image ready for OCR, at no more than max_dpi."""
+    if not (PREPROCESS_ENABLED and PREPROCESSING_AVAILABLE):
+        pix = page.get_pixmap(dpi=min(DEFAULT_DPI, max_dpi))
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+    import fitz  # PyMuPDF
+    pix = page.get_pixmap(dpi=min(choose_render_dpi(page), max_dpi), colorspace=fitz.csGRAY)
+    gray = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+    return preprocess_for_ocr(gray)
@@ -0,0 +1,97 @@
+"""
+Page-at-a-time text extraction.
+
+iter_page_text yields the raw text of one page at a time, so only a single
+rendered pixmap is alive at any moment and callers can start parsing before
+the last page of a long scan has been OCR'd.
+"""
+
+import io
+import os
+from itertools import islice
+
+from ocr_engine import get_ocr_engine
+from ocr_preprocessing import MAX_DPI, MAX_IMAGE_SIDE, open_image, preprocess_for_ocr, render_page_for_ocr
+
+PDF_EXTENSIONS = (".pdf",)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+TEXT_EXTENSIONS = (".txt",)
+
+
+def open_pdf(source):
+    import fitz  # PyMuPDF
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+def is_scanned(doc):
+    # A PDF is treated as scanned only when no page has a text layer;
+    # this stops at the first page with text, so it is cheap either way.
+    return all(len(page.get_text().strip()) == 0 for page in doc)
+
+
+def iter_pdf_pages(source, max_pages=None, ocr_dpi=MAX_DPI):
+    """
+    Yields the text of each PDF page (the first max_pages only, if given);
+    OCRs every page at up to ocr_dpi if the PDF is scanned.
+    """
+    doc = open_pdf(source)
+    try:
+        if is_scanned(doc):
+            engine = get_ocr_engine()
+            for page in islice(doc, max_pages):
+                yield engine.image_to_string(render_page_for_ocr(page, ocr_dpi))
+        else:
+            for page in islice(doc, max_pages):
+                yield page.get_text()
+    finally:
+        doc.close()
+
+
+def read_text_report(source):
+    if isinstance(source, (bytes, bytearray)):
+        return source.decode("utf-8")
+    with open(source, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def count_pages(source, filename):
+    """(pages, needs_ocr) for a report, without extracting any text."""
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension in PDF_EXTENSIONS:
+        doc = open_pdf(source)
+        try:
+            return len(doc), is_scanned(doc)
+        finally:
+            doc.close()
+    if file_extension in IMAGE_EXTENSIONS:
+        return 1, True
+    if file_extension in TEXT_EXTENSIONS:
+        return read_text_report(source).count("\f") + 1, False
+    return 0, False
+
+
+def iter_page_text(source, filename, max_pages=None, ocr_dpi=MAX_DPI):
+    """
+    Yields raw text page by page for a PDF, image or plain-text report.
+    source is a file path or the file's bytes; filename picks the format.
+    max_pages stops after the first pages; ocr_dpi caps the OCR resolution
+    (images are downscaled to match). Raises ImportError when the format
+    needs PyMuPDF or OCR and it is missing.
+    """
+    file_extension = os.path.splitext(filename)[1].lower()
+
+    if file_extension in PDF_EXTENSIONS:
+        yield from iter_pdf_pages(source, max_pages, ocr_dpi)
+
+    elif file_extension in IMAGE_EXTENSIONS:
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        max_side = int(MAX_IMAGE_SIDE * min(ocr_dpi, MAX_DPI) / MAX_DPI)
+        engine = get_ocr_engine()
+        yield engine.image_to_string(preprocess_for_ocr(open_image(source, max_side), max_side))
+
+    elif file_extension in TEXT_EXTENSIONS:
+        # Plain-text reports may carry form feeds as page breaks
+        yield from islice(read_text_report(source).split("\f"), max_pages)
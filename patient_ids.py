@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Patient identifiers without plaintext names.
+
+Reports used to be keyed by their patient_name column, the one identifying
+field stored in the clear, and because names are free text "Akhil Reddy"
+and "akhil reddy " were two patients. Now every patient has one row in the
+patients table and every other table refers to its patient_id:
+
+    patient_id   stable id (P-2026-3F9A1C07D2), like patients.patient_id in healthcare_schema.sql
+    name_index   HMAC-SHA256 blind index of the normalized name (UNIQUE)
+    name_data    the name as first entered, encrypted like report_data
+
+A lookup by name normalizes it (Unicode NFKC, case-folded, whitespace
+collapsed), computes its blind index and finds the row through the UNIQUE
+index, so equality lookups stay O(log n) while the database holds no
+names. Shards are chosen from the blind index too.
+
+The index key comes from PATIENT_INDEX_KEY, or is derived from
+ENCRYPTION_KEY. Set PATIENT_INDEX_KEY before rotating encryption keys: a
+new index key needs  python patient_ids.py reindex  (single database only,
+since with DB_SHARDS > 1 it would also move every patient).
+
+setup_database migrates databases that still have patient_name columns in
+place: names become patients rows, patient-keyed tables are re-keyed and
+the plaintext columns are dropped (needs SQLite 3.35+).
+
+    python patient_ids.py lookup "Akhil Reddy"
+    python patient_ids.py reindex
+"""
+
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import sys
+import unicodedata
+from datetime import datetime
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from analytics import patient_key
+from report_codec import decode_text, reencrypt
+
+# Hex characters of the blind index kept (128 bits)
+INDEX_CHARS = 32
+
+
+def normalize_name(patient_name):
+    """The form names are compared in: "  Akhil   REDDY " -> "akhil reddy"."""
+    return " ".join(unicodedata.normalize("NFKC", patient_name or "").casefold().split())
+
+
+def index_key(key_material):
+    """32-byte HMAC key from PATIENT_INDEX_KEY or a Fernet key."""
+    if isinstance(key_material, str):
+        key_material = key_material.encode()
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"ez-reports patient index")
+    return hkdf.derive(key_material)
+
+
+def blind_index(key, patient_name):
+    return hmac.new(key, normalize_name(patient_name).encode("utf-8"), hashlib.sha256).hexdigest()[:INDEX_CHARS]
+
+
+def new_patient_id():
+    return f"P-{datetime.utcnow():%Y}-{secrets.token_hex(5).upper()}"
+
+
+def setup_patient_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            patient_id TEXT PRIMARY KEY,
+            name_index TEXT NOT NULL UNIQUE, name_data BLOB NOT NULL, key_version INTEGER,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    # One row per patient, bumped on every save so readers can answer
+    # conditional GETs without loading or decrypting any reports.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patient_versions (
+            patient_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL, updated_at TEXT NOT NULL
+        )
+    ''')
+
+
+def find_patient(conn, name_index):
+    """patient_id for a blind index, or None for a patient never saved."""
+    row = conn.execute("SELECT patient_id FROM patients WHERE name_index = ?", (name_index,)).fetchone()
+    return row[0] if row else None
+
+
+def get_or_create_patient(conn, name_index, patient_name, encrypt_name):
+    """
+    patient_id for a blind index, adding the patient if new. encrypt_name(name)
+    returns (blob, key_version). Call inside a write transaction.
+    """
+    patient_id = find_patient(conn, name_index)
+    if patient_id is None:
+        patient_id = new_patient_id()
+        name_data, key_version = encrypt_name(" ".join(patient_name.split()))
+        conn.execute("INSERT INTO patients (patient_id, name_index, name_data, key_version, created_at) "
+                     "VALUES (?, ?, ?, ?, ?)", (patient_id, name_index, name_data, key_version,
+                                                datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")))
+    return patient_id
+
+
+def decrypt_name(name_data, key_version, keys_by_version):
+    keys = [keys_by_version[key_version]] if key_version in keys_by_version else list(keys_by_version.values())
+    return decode_text(name_data, keys)
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def migrate_patient_names(conn, key, encrypt_name):
+    """
+    Moves a database keyed by plaintext patient_name onto patients rows, in
+    one transaction. patient_key columns (rollups, near-duplicate
+    signatures) are re-keyed from the name to the patient_id. Returns
+    (names, patients); fewer patients than names means some names were
+    merged and the rollups need a rebuild. Run after setup_patient_tables.
+    """
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        raise RuntimeError(f"Moving patient names out of the database needs SQLite 3.35+ "
+                           f"(this is {sqlite3.sqlite_version})")
+    versions_by_name = "patient_name" in _columns(conn, "patient_versions")
+    outbox_by_name = "patient_name" in _columns(conn, "notification_outbox")
+    sources = ["patient_reports"] + (["patient_versions"] if versions_by_name else []) + (
+        ["notification_outbox"] if outbox_by_name else [])
+
+    with conn:
+        # sqlite3 would leave the DDL below outside the transaction
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute("CREATE TEMP TABLE patient_name_map (patient_name TEXT, patient_id TEXT NOT NULL, "
+                     "old_key TEXT NOT NULL, new_key TEXT NOT NULL)")
+        conn.execute("CREATE INDEX temp.idx_patient_name_map_name ON patient_name_map (patient_name)")
+        conn.execute("CREATE INDEX temp.idx_patient_name_map_key ON patient_name_map (old_key)")
+        names = [row[0] for row in conn.execute(" UNION ".join(f"SELECT DISTINCT patient_name FROM {table}"
+                                                               for table in sources)).fetchall()]
+        for name in names:
+            patient_id = get_or_create_patient(conn, blind_index(key, name), name or "", encrypt_name)
+            conn.execute("INSERT INTO patient_name_map VALUES (?, ?, ?, ?)",
+                         (name, patient_id, patient_key(name or ""), patient_key(patient_id)))
+        mapped = "(SELECT m.patient_id FROM patient_name_map m WHERE m.patient_name IS {table}.patient_name)"
+
+        if "patient_id" not in _columns(conn, "patient_reports"):
+            conn.execute("ALTER TABLE patient_reports ADD COLUMN patient_id TEXT")
+        conn.execute(f"UPDATE patient_reports SET patient_id = {mapped.format(table='patient_reports')}")
+        conn.execute("DROP INDEX IF EXISTS idx_patient_reports_patient")
+        conn.execute("ALTER TABLE patient_reports DROP COLUMN patient_name")
+
+        if versions_by_name:
+            # Names that normalize alike become one patient; summing keeps the version moving forward
+            conn.execute("ALTER TABLE patient_versions RENAME TO patient_versions_by_name")
+            setup_patient_tables(conn)
+            conn.execute('''
+                INSERT INTO patient_versions (patient_id, version, updated_at)
+                SELECT m.patient_id, SUM(v.version), MAX(v.updated_at)
+                FROM patient_versions_by_name v JOIN patient_name_map m ON m.patient_name IS v.patient_name
+                GROUP BY m.patient_id
+            ''')
+            conn.execute("DROP TABLE patient_versions_by_name")
+
+        if outbox_by_name:
+            conn.execute("ALTER TABLE notification_outbox ADD COLUMN patient_id TEXT")
+            conn.execute(f"UPDATE notification_outbox SET patient_id = {mapped.format(table='notification_outbox')}")
+            conn.execute("DROP INDEX IF EXISTS idx_notification_outbox_patient")
+            conn.execute("ALTER TABLE notification_outbox DROP COLUMN patient_name")
+
+        rekeyed = "(SELECT m.new_key FROM patient_name_map m WHERE m.old_key = {table}.patient_key)"
+        for table in ("test_rollup_members", "report_lsh", "report_signatures"):
+            if _columns(conn, table):
+                # Rows of names that now share a patient collapse into one
+                conn.execute(f"UPDATE OR IGNORE {table} SET patient_key = {rekeyed.format(table=table)} "
+                             "WHERE patient_key IN (SELECT old_key FROM patient_name_map)")
+                conn.execute(f"DELETE FROM {table} WHERE patient_key IN (SELECT old_key FROM patient_name_map)")
+        patients = conn.execute("SELECT COUNT(DISTINCT patient_id) FROM patient_name_map").fetchone()[0]
+        conn.execute("DROP TABLE patient_name_map")
+    return len(names), patients
+
+
+def reindex_patients(db_file, key, keys_by_version):
+    """Recomputes every blind index with key (after changing PATIENT_INDEX_KEY). Returns (reindexed, skipped)."""
+    conn = sqlite3.connect(db_file, timeout=30)
+    updates, skipped = [], 0
+    for patient_id, name_data, key_version in conn.execute(
+            "SELECT patient_id, name_data, key_version FROM patients").fetchall():
+        try:
+            updates.append((blind_index(key, decrypt_name(name_data, key_version, keys_by_version)), patient_id))
+        except Exception:
+            skipped += 1
+    with conn:
+        # Park every row on a placeholder first so swapped indexes cannot collide
+        conn.execute("UPDATE patients SET name_index = 'reindex:' || patient_id")
+        conn.executemany("UPDATE patients SET name_index = ? WHERE patient_id = ?", updates)
+    conn.close()
+    return len(updates), skipped
+
+
+def rotate_names(db_file, keys, target_version):
+    """Re-encrypts patient names not on target_version with the current (first) key. Returns (rotated, failed)."""
+    conn = sqlite3.connect(db_file, timeout=30)
+    current_key = next(iter(keys.values()))
+    updates, failed = [], 0
+    for patient_id, name_data, key_version in conn.execute(
+            "SELECT patient_id, name_data, key_version FROM patients WHERE key_version IS NULL OR key_version != ?",
+            (target_version,)).fetchall():
+        ring = [keys[key_version]] if key_version in keys else list(keys.values())
+        try:
+            updates.append((reencrypt(name_data, ring, current_key), target_version, patient_id, name_data))
+        except Exception:
+            failed += 1
+    with conn:
+        conn.executemany("UPDATE patients SET name_data = ?, key_version = ? WHERE patient_id = ? AND name_data = ?",
+                         updates)
+    conn.close()
+    return len(updates), failed
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "lookup":
+        from Aimodal import PATIENT_INDEX_KEY, patient_db_file, setup_database
+
+        setup_database()
+        conn = sqlite3.connect(patient_db_file(sys.argv[2]))
+        try:
+            patient_id = find_patient(conn, blind_index(PATIENT_INDEX_KEY, sys.argv[2]))
+            if patient_id is None:
+                print("❌ No patient with that name")
+                return 1
+            reports = conn.execute("SELECT COUNT(*) FROM patient_reports WHERE patient_id = ?",
+                                   (patient_id,)).fetchone()[0]
+        finally:
+            conn.close()
+        print(f"{patient_id}: {reports} reports")
+        return 0
+
+    if len(sys.argv) != 2 or sys.argv[1] != "reindex":
+        print(__doc__)
+        return 1
+
+    from Aimodal import DB_SHARDS, KEY_BYTES, PATIENT_INDEX_KEY, SHARD_FILES, setup_database
+
+    if DB_SHARDS > 1:
+        print("❌ Patients are placed on shards by their blind index, so a sharded database cannot be reindexed "
+              "in place. Rebalance to 1 shard, reindex, then rebalance back.")
+        return 1
+    setup_database()
+    reindexed, skipped = reindex_patients(SHARD_FILES[0], PATIENT_INDEX_KEY, KEY_BYTES)
+    print(f"Reindexed {reindexed} patients{f' ({skipped} could not be decrypted)' if skipped else ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+Layout-aware extraction of lab result tables from born-digital PDFs.
+
+Instead of flattening a page to text, words from PyMuPDF's
+page.get_text("words") are grouped into rows by their vertical position
+and split into cells at wide horizontal gaps. When the page has a header
+row ("Test / Result / Unit / Reference Range") its column positions are used
+to place every cell; otherwise cells are read left to right as
+name, value, unit, range. Each row is parsed once, so the printed
+reference range stays attached to its own test.
+"""
+
+import os
+import re
+from statistics import median
+
+from page_stream import open_pdf
+
+# Set PDF_TABLE_EXTRACTION=0 to always use the flattened-text regex pipeline
+PDF_TABLE_EXTRACTION = os.getenv("PDF_TABLE_EXTRACTION", "1") != "0"
+# Leading pages without a table row before a PDF is handed to the page-text
+# pipeline instead (cover or patient-details pages come before the results)
+PDF_TABLE_PROBE_PAGES = int(os.getenv("PDF_TABLE_PROBE_PAGES", "3"))
+
+# Words whose vertical centres differ by less than this fraction of the
+# median word height belong to the same row
+ROW_TOLERANCE = 0.5
+# A horizontal gap wider than this fraction of the word height starts a new cell
+CELL_GAP = 0.8
+
+NUMBER_RE = re.compile(r"^[<>]?\d+(?:\.\d+)?$")
+RANGE_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(\d+(?:\.\d+)?)$", re.IGNORECASE)
+TRAILING_RANGE_RE = re.compile(r"[(\[]?\s*(\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(\d+(?:\.\d+)?)\s*[)\]]?$", re.IGNORECASE)
+UPPER_LIMIT_RE = re.compile(r"^(?:<|<=|≤|up\s*to)\s*(\d+(?:\.\d+)?)$", re.IGNORECASE)
+LETTERS_RE = re.compile(r"[A-Za-z]")
+FLAGS = {"H", "L", "HIGH", "LOW", "*", "(H)", "(L)"}
+
+HEADER_WORDS = {
+    "name": ("test", "investigation", "parameter", "description", "examination"),
+    "value": ("result", "value", "observed"),
+    "unit": ("unit", "units"),
+    "range": ("reference", "range", "interval", "normal", "biological"),
+}
+
+
+def group_rows(words):
+    """Groups (x0, y0, x1, y1, text, ...) words into rows sorted top to bottom, left to right."""
+    if not words:
+        return [], 0
+    height = median(w[3] - w[1] for w in words)
+    rows, current, current_y = [], [], None
+    for word in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        y = (word[1] + word[3]) / 2
+        if current and abs(y - current_y) > height * ROW_TOLERANCE:
+            rows.append(sorted(current, key=lambda w: w[0]))
+            current = []
+        if not current:
+            current_y = y
+        current.append(word)
+    if current:
+        rows.append(sorted(current, key=lambda w: w[0]))
+    return rows, height
+
+
+def split_cells(row, height):
+    """Splits a row of words into cells [(x0, x1, text)] at gaps wider than CELL_GAP * height."""
+    cells = []
+    for word in row:
+        if cells and word[0] - cells[-1][1] <= height * CELL_GAP:
+            x0, _, text = cells[-1]
+            cells[-1] = (x0, word[2], f"{text} {word[4]}")
+        else:
+            cells.append((word[0], word[2], word[4]))
+    return cells
+
+
+def header_columns(cells):
+    """{"name": x_centre, "value": ..., ...} if the row looks like a table header, else None."""
+    columns = {}
+    for x0, x1, text in cells:
+        lowered = text.lower()
+        for column, keywords in HEADER_WORDS.items():
+            if column not in columns and any(keyword in lowered for keyword in keywords):
+                columns[column] = (x0 + x1) / 2
+                break
+        else:
+            columns.setdefault(f"other{len(columns)}", (x0 + x1) / 2)
+    if {"name", "value"} <= columns.keys() and len(columns.keys() & HEADER_WORDS.keys()) >= 3:
+        return columns
+    return None
+
+
+def place_cells(cells, columns):
+    """Merges cells into [name, value, unit, range] texts by nearest header column."""
+    placed = {}
+    for x0, x1, text in cells:
+        centre = (x0 + x1) / 2
+        # The name column is left aligned, so compare its left edge as well
+        column = min(columns, key=lambda c: min(abs(columns[c] - centre), abs(columns[c] - x0)))
+        placed[column] = f"{placed[column]} {text}" if column in placed else text
+    return [placed.get(column, "") for column in ("name", "value", "unit", "range")]
+
+
+def strip_flags(text):
+    return " ".join(token for token in text.split() if token.upper() not in FLAGS)
+
+
+def parse_range(text):
+    """(low, high) from "12.0 - 16.0", "12-16" or "< 200"; None otherwise."""
+    text = text.strip().strip("()[]")
+    match = RANGE_RE.match(text)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    match = UPPER_LIMIT_RE.match(text)
+    if match:
+        return 0.0, float(match.group(1))
+    return None
+
+
+def split_trailing_range(text):
+    """"g/dl (12.0 - 16.0)" -> ("g/dl", (12.0, 16.0)); ranges only count at the end of a cell."""
+    match = TRAILING_RANGE_RE.search(text)
+    if not match:
+        return text, None
+    return text[:match.start()].strip(), (float(match.group(1)), float(match.group(2)))
+
+
+def parse_row(texts):
+    """
+    Reads {"name", "value", "unit", "range"} from a row's cell texts (name
+    first). Returns None for rows without a test name followed by a number.
+    """
+    if len(texts) == 1:
+        # "Hemoglobin: 12.5 g/dl" set with ordinary spacing: split at the first number
+        tokens = texts[0].split()
+        first_number = next((i for i, t in enumerate(tokens) if NUMBER_RE.match(t)), None)
+        if not first_number:
+            return None
+        texts = [" ".join(tokens[:first_number]), " ".join(tokens[first_number:])]
+    if len(texts) < 2 or not LETTERS_RE.search(texts[0]):
+        return None
+    name, rest = texts[0].strip(" :"), [strip_flags(t) for t in texts[1:] if t.strip()]
+
+    value, unit, value_range = None, "", None
+    for text in rest:
+        if value is None:
+            tokens = text.split()
+            if not tokens or not NUMBER_RE.match(tokens[0]):
+                if LETTERS_RE.search(text):
+                    return None  # text between name and value: not a result row
+                continue
+            value = float(tokens[0].lstrip("<>"))
+            text = " ".join(tokens[1:])
+            if not text:
+                continue
+        if value_range is None and parse_range(text):
+            value_range = parse_range(text)
+            continue
+        if value_range is None:
+            text, value_range = split_trailing_range(text)
+        if not unit and (LETTERS_RE.search(text) or "%" in text):
+            unit = text
+    if value is None:
+        return None
+    return {"name": name, "value": value, "unit": unit, "range": value_range}
+
+
+def iter_table_rows(source):
+    """
+    Yields (page_number, page_text, parsed_rows) for each page of a PDF.
+    Yields nothing for image-only (scanned) PDFs.
+    """
+    doc = open_pdf(source)
+    try:
+        # Same rule as page_stream: no text layer on any page means scanned
+        if not any(page.get_text("words") for page in doc):
+            return
+
+        for page_number, page in enumerate(doc, start=1):
+            rows, height = group_rows(page.get_text("words"))
+            columns, parsed, lines = None, [], []
+            for row in rows:
+                cells = split_cells(row, height)
+                lines.append(" ".join(text for _, _, text in cells))
+                found_header = header_columns(cells)
+                if found_header:
+                    columns = found_header
+                    continue
+                texts = place_cells(cells, columns) if columns else [text for _, _, text in cells]
+                result = parse_row(texts)
+                if result:
+                    parsed.append(result)
+            yield page_number, "\n".join(lines), parsed
+    finally:
+        doc.close()
@@ -1,97 +1,189 @@
-import re
-from datetime import datetime, timedelta
-from Aimodal import extract_text_from_source, clean_and_normalize_text
-
-def extract_prescription_date(text):
-    """
-    Extracts the date from the report text.
-    Looks for patterns like 'Date: YYYY-MM-DD' or 'Report Date: DD/MM/YYYY'.
-    """
-    date_patterns = [
-        r"Date[:\s]+(\d{4}-\d{2}-\d{2})",
-        r"Report Date[:\s]+(\d{2}/\d{2}/\d{4})"
-    ]
-    for pattern in date_patterns:
-        match = re.search(pattern, text)
-        if match:
-            date_str = match.group(1)
-            try:
-                if "-" in date_str:
-                    return datetime.strptime(date_str, "%Y-%m-%d")
-                elif "/" in date_str:
-                    return datetime.strptime(date_str, "%d/%m/%Y")
-            except ValueError:
-                continue
-    # fallback: use today if no date found
-    return datetime.now()
-
-def extract_prescriptions(text):
-    """
-    Extract medicines, dosage, and frequency from report text.
-    """
-    prescriptions = []
-    # Example pattern: "Paracetamol 500mg 3 times a day"
-    pattern = r"([A-Za-z\s]+)\s+(\d+mg|\d+ml)\s+([\d\s\w]+)"
-    matches = re.finditer(pattern, text)
-    for match in matches:
-        prescriptions.append({
-            "medicine": match.group(1).strip(),
-            "dosage": match.group(2).strip(),
-            "frequency": match.group(3).strip()
-        })
-    return prescriptions
-
-def schedule_alarms(prescriptions, report_date):
-    """
-    Schedules alarms based on prescription frequency.
-    """
-    alarms = []
-    for p in prescriptions:
-        # Simple example: "3 times a day" => every 8 hours
-        freq_match = re.search(r'(\d+)', p['frequency'])
-        if freq_match:
-            times_per_day = int(freq_match.group(1))
-            interval_hours = 24 / times_per_day
-            alarms.append({
-                "medicine": p['medicine'],
-                "next_dose": report_date + timedelta(hours=interval_hours)
-            })
-    return alarms
-
-def process_report(uploaded_file=None, input_text=""):
-    """
-    Main function: takes a file or plain text report,
-    extracts prescription info, report date, and returns alarms.
-    """
-    raw_text_data = None
-    if uploaded_file:
-        raw_text_data = extract_text_from_source(uploaded_file)
-    elif input_text:
-        raw_text_data = {"raw_text": input_text}
-
-    if not raw_text_data or not raw_text_data.get("raw_text", "").strip():
-        return None, None, None
-
-    clean_text_data = clean_and_normalize_text(raw_text_data)
-    clean_text = clean_text_data.get("clean_text", "")
-
-    report_date = extract_prescription_date(clean_text)
-    prescriptions = extract_prescriptions(clean_text)
-    alarms = schedule_alarms(prescriptions, report_date)
-
-    return report_date, prescriptions, alarms
-
-# --- Example usage ---
-if __name__ == "__main__":
-    # Example: Replace this with uploaded file or text
-    report_text = """
-    Patient Name: John Doe
-    Report Date: 2025-10-12
-    Paracetamol 500mg 3 times a day
-    Amoxicillin 250mg 2 times a day
-    """
-    date, prescriptions, alarms = process_report(input_text=report_text)
-
-    print("Report Date:", date)
-    print("Prescriptions:", prescriptions)
-    print("Scheduled Alarms:", alarms)
+"""
+Report dates, prescriptions and dose alarms.
+
+DETAILS_RE finds both the report date and prescription lines
+("Tab Paracetamol 500mg 3 times a day") in cleaned report text. It is not
+run on its own: Aimodal.ParameterStream scans it over the same buffers as
+the lab test patterns, so an upload is OCR'd and normalized once and every
+pipeline event carries "report_date" and "prescriptions" next to "tests".
+schedule_alarms turns the prescriptions into next-dose times counted from
+the report date.
+
+Usage:
+    python prescription_alarm.py report.pdf
+    python prescription_alarm.py --text "Report Date: 12/10/2025 Paracetamol 500mg 3 times a day"
+"""
+
+import argparse
+import re
+import sys
+from datetime import datetime, timedelta
+
+DATE_VALUE = (r"\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[/.\-]\d{1,2}[/.\-]\d{2}(?:\d{2})?\b"
+              r"|\d{1,2}[\s\-][A-Za-z]{3,9}[\s\-,]+\d{2}(?:\d{2})?\b")
+FREQUENCY = (r"\d+\s*(?:x|times?)\s*(?:a|per|/)?\s*day|(?:once|twice|thrice)\s+(?:a\s+)?(?:day|daily)"
+             r"|every\s+\d+\s*(?:hours?|hrs?)|\b(?:OD|BD|BID|TDS|TID|QID|HS)\b")
+DETAILS_RE = re.compile(
+    rf"\b(?P<label>Report(?:ed)?(?:\s+Date|\s+On)?|Collect(?:ed|ion)(?:\s+Date|\s+On)?|Date)\s*[:\-]?\s*"
+    rf"(?P<date>{DATE_VALUE})"
+    rf"|(?:\b(?:Tab|Tablet|Cap|Capsule|Syp|Syrup|Inj)\.?\s+)?\b(?P<medicine>[A-Za-z][A-Za-z\-]+)\s+"
+    rf"(?P<dosage>\d+(?:\.\d+)?\s?(?:mg|mcg|ml|iu)\b)\s*(?P<frequency>{FREQUENCY})",
+    re.IGNORECASE)
+
+DATE_SEPARATORS_RE = re.compile(r"[\s,\-/.]+")
+DOSES_PER_DAY = {"od": 1, "hs": 1, "once": 1, "bd": 2, "bid": 2, "twice": 2,
+                 "tds": 3, "tid": 3, "thrice": 3, "qid": 4}
+
+
+def parse_report_date(value):
+    """'12/10/2025', '2025-10-12', '13-May-25' -> datetime, or None. Day-first, as printed on Indian reports."""
+    parts = DATE_SEPARATORS_RE.sub(" ", value.strip()).split()
+    if len(parts[0]) == 4:
+        date_formats = ("%Y %m %d",)
+    else:
+        # %Y would read a two-digit year as year 25
+        year = "%y" if len(parts[-1]) == 2 else "%Y"
+        date_formats = (f"%d %m {year}", f"%d %b {year}", f"%d %B {year}")
+    for date_format in date_formats:
+        try:
+            return datetime.strptime(" ".join(parts), date_format)
+        except ValueError:
+            continue
+    return None
+
+
+class ReportDetails:
+    """Report date and prescriptions collected from DETAILS_RE matches."""
+
+    def __init__(self):
+        self.report_date = None
+        self._date_rank = None
+        self.prescriptions = []
+
+    def scan(self, text, pos, limit):
+        """Records matches in text from pos that end by limit. Returns where the next scan should start."""
+        for match in DETAILS_RE.finditer(text, pos):
+            if match.end() > limit:
+                break
+            pos = match.end()
+            if match.group("date"):
+                # "Report Date" / "Reported On" beats a collection or plain date
+                rank = 0 if match.group("label").lower().startswith("report") else 1
+                parsed = parse_report_date(match.group("date"))
+                if parsed and (self._date_rank is None or rank < self._date_rank):
+                    self.report_date, self._date_rank = parsed, rank
+            else:
+                self.prescriptions.append({
+                    "medicine": match.group("medicine"),
+                    "dosage": match.group("dosage").replace(" ", ""),
+                    "frequency": match.group("frequency")
+                })
+        return pos
+
+    def results(self):
+        return {"report_date": self.report_date.strftime("%Y-%m-%d") if self.report_date else None,
+                "prescriptions": list(self.prescriptions)}
+
+
+def extract_prescription_date(text):
+    """
+    Extracts the date from the report text, or today if none is printed.
+    """
+    details = ReportDetails()
+    details.scan(text, 0, len(text))
+    return details.report_date or datetime.now()
+
+
+def extract_prescriptions(text):
+    """
+    Extract medicines, dosage, and frequency from report text.
+    """
+    details = ReportDetails()
+    details.scan(text, 0, len(text))
+    return details.prescriptions
+
+
+def doses_per_day(frequency):
+    """'3 times a day', 'twice daily', 'BD', 'every 6 hours' -> doses per day, or None."""
+    words = frequency.lower().split()
+    number = re.search(r"\d+", frequency)
+    if words[0] == "every":
+        return 24 / int(number.group()) if number and int(number.group()) else None
+    if number:
+        return int(number.group()) or None
+    return DOSES_PER_DAY.get(words[0])
+
+
+def schedule_alarms(prescriptions, report_date):
+    """
+    Schedules alarms based on prescription frequency. report_date is a
+    datetime or 'YYYY-MM-DD'; next_dose is an ISO timestamp.
+    """
+    if isinstance(report_date, str):
+        report_date = datetime.strptime(report_date, "%Y-%m-%d")
+    alarms = []
+    for p in prescriptions:
+        times_per_day = doses_per_day(p["frequency"])
+        if times_per_day:
+            interval_hours = 24 / times_per_day
+            alarms.append({
+                "medicine": p["medicine"],
+                "dosage": p["dosage"],
+                "interval_hours": round(interval_hours, 2),
+                "next_dose": (report_date + timedelta(hours=interval_hours)).isoformat(timespec="minutes")
+            })
+    return alarms
+
+
+def process_report(uploaded_file=None, input_text=""):
+    """
+    Takes a file or plain text report and returns (report date,
+    prescriptions, alarms), from the same single pass over the text that
+    finds the lab tests (see Aimodal.extract_report_fields).
+    """
+    from Aimodal import clean_and_normalize_text, extract_report_fields, extract_text_from_source
+
+    raw_text_data = None
+    if uploaded_file:
+        raw_text_data = extract_text_from_source(uploaded_file)
+    elif input_text:
+        raw_text_data = {"raw_text": input_text}
+
+    if not raw_text_data or not raw_text_data.get("raw_text", "").strip():
+        return None, None, None
+
+    fields = extract_report_fields(clean_and_normalize_text(raw_text_data))
+    report_date = fields["report_date"] or datetime.now().strftime("%Y-%m-%d")
+    return report_date, fields["prescriptions"], schedule_alarms(fields["prescriptions"], report_date)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", nargs="?", help="PDF, image or text report")
+    parser.add_argument("--text", default="", help="report text instead of a file")
+    args = parser.parse_args()
+    if not args.file and not args.text:
+        parser.error("give a report file or --text")
+
+    from page_stream import iter_page_text
+    if args.file:
+        try:
+            text = "".join(iter_page_text(args.file, args.file))
+        except (OSError, ImportError) as e:
+            print(f"❌ {e}")
+            return 1
+    else:
+        text = args.text
+    report_date, prescriptions, alarms = process_report(input_text=text)
+    if report_date is None:
+        print("❌ No text found in the report")
+        return 1
+
+    print("Report Date:", report_date)
+    print("Prescriptions:", prescriptions)
+    print("Scheduled Alarms:", alarms)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
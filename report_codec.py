@@ -0,0 +1,184 @@
+"""
+Storage format for encrypted reports.
+
+Legacy rows hold Fernet(json.dumps(report)). The v2 format stores
+
+    b"EZR" | version (1 byte) | flags (1 byte) | nonce (12 bytes) | AES-GCM ciphertext
+
+where the plaintext is the report serialized with MessagePack (or compact
+JSON), with every dictionary explanation replaced by a short catalogue
+reference, then compressed with zstd (or zlib). The 5-byte header is bound
+to the ciphertext as associated data. The AES-256 key is derived with HKDF
+from the row's Fernet key, so key versioning and rotation work unchanged.
+Legacy blobs are still read transparently.
+"""
+
+import base64
+import json
+import os
+import zlib
+
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Optional imports with fallback handling
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"EZR"
+FORMAT_VERSION = 2
+HEADER_SIZE = len(MAGIC) + 2
+NONCE_SIZE = 12
+
+FLAG_MSGPACK = 0x01   # otherwise compact JSON
+FLAG_ZSTD = 0x02      # otherwise zlib
+
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+# "v2" writes the compact AES-GCM format, "fernet" keeps writing legacy blobs
+REPORT_STORAGE_FORMAT = os.getenv("REPORT_STORAGE_FORMAT", "v2").lower()
+
+_aead_cache = {}
+
+
+def aead_for(fernet_key):
+    """AES-GCM cipher keyed by HKDF over a Fernet key (cached per key)."""
+    if fernet_key not in _aead_cache:
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"ez-reports report storage v2")
+        _aead_cache[fernet_key] = AESGCM(hkdf.derive(base64.urlsafe_b64decode(fernet_key)))
+    return _aead_cache[fernet_key]
+
+
+def is_legacy_blob(blob):
+    return not bytes(blob[:len(MAGIC)]) == MAGIC
+
+
+def compact_explanations(report_data, catalogue_refs):
+    """Replaces catalogue explanation texts with {"explanation_ref": ref}."""
+    tests = []
+    for test in report_data.get("tests", []):
+        ref = catalogue_refs.get(test.get("explanation"))
+        if ref is not None:
+            test = {k: v for k, v in test.items() if k != "explanation"}
+            test["explanation_ref"] = ref
+        tests.append(test)
+    return dict(report_data, tests=tests)
+
+
+def expand_explanations(report_data, catalogue, fallback):
+    """Inverse of compact_explanations; unknown refs get fallback(test)."""
+    tests = []
+    for test in report_data.get("tests", []):
+        if "explanation_ref" in test:
+            test = dict(test)
+            ref = test.pop("explanation_ref")
+            test["explanation"] = catalogue.get(ref) or fallback(test)
+        tests.append(test)
+    return dict(report_data, tests=tests)
+
+
+def seal(flags, payload, fernet_key):
+    """Encrypts an already serialized+compressed payload into a v2 blob."""
+    header = MAGIC + bytes([FORMAT_VERSION, flags])
+    nonce = os.urandom(NONCE_SIZE)
+    return header + nonce + aead_for(fernet_key).encrypt(nonce, payload, header)
+
+
+def unseal(blob, fernet_keys):
+    """Decrypts a v2 blob, trying fernet_keys in order. Returns (flags, payload)."""
+    blob = bytes(blob)
+    header, nonce, ciphertext = blob[:HEADER_SIZE], blob[HEADER_SIZE:HEADER_SIZE + NONCE_SIZE], blob[HEADER_SIZE + NONCE_SIZE:]
+    if header[len(MAGIC)] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported report format version {header[len(MAGIC)]}")
+    last_error = None
+    for key in fernet_keys:
+        try:
+            return header[-1], aead_for(key).decrypt(nonce, ciphertext, header)
+        except Exception as e:
+            last_error = e
+    raise last_error or ValueError("No encryption keys configured")
+
+
+def encode_report(report_data, fernet_key, catalogue_refs=None):
+    """Serializes, compresses and encrypts a report for storage."""
+    if REPORT_STORAGE_FORMAT == "fernet":
+        return Fernet(fernet_key).encrypt(json.dumps(report_data).encode())
+
+    if catalogue_refs:
+        report_data = compact_explanations(report_data, catalogue_refs)
+
+    flags = 0
+    if msgpack is not None:
+        payload = msgpack.packb(report_data, use_bin_type=True)
+        flags |= FLAG_MSGPACK
+    else:
+        payload = json.dumps(report_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    if zstandard is not None:
+        payload = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+        flags |= FLAG_ZSTD
+    else:
+        payload = zlib.compress(payload, ZLIB_LEVEL)
+
+    return seal(flags, payload, fernet_key)
+
+
+def decode_report(blob, fernet_keys, catalogue=None, fallback=None):
+    """Decrypts a stored report in either format, trying fernet_keys in order."""
+    if is_legacy_blob(blob):
+        return json.loads(MultiFernet([Fernet(k) for k in fernet_keys]).decrypt(bytes(blob)).decode())
+
+    flags, payload = unseal(blob, fernet_keys)
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise ImportError("zstandard is required to read this report")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        payload = zlib.decompress(payload)
+
+    if flags & FLAG_MSGPACK:
+        if msgpack is None:
+            raise ImportError("msgpack is required to read this report")
+        report_data = msgpack.unpackb(payload, raw=False)
+    else:
+        report_data = json.loads(payload.decode("utf-8"))
+
+    if catalogue is not None:
+        report_data = expand_explanations(report_data, catalogue, fallback or (lambda test: ""))
+    return report_data
+
+
+def encode_text(text, fernet_key):
+    """Compresses and encrypts a report's clean text as a v2 blob."""
+    payload = text.encode("utf-8")
+    if zstandard is not None:
+        return seal(FLAG_ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload), fernet_key)
+    return seal(0, zlib.compress(payload, ZLIB_LEVEL), fernet_key)
+
+
+def decode_text(blob, fernet_keys):
+    """Inverse of encode_text."""
+    flags, payload = unseal(blob, fernet_keys)
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise ImportError("zstandard is required to read this text")
+        return zstandard.ZstdDecompressor().decompress(payload).decode("utf-8")
+    return zlib.decompress(payload).decode("utf-8")
+
+
+def reencrypt(blob, fernet_keys, new_key):
+    """Re-encrypts a blob under new_key without decoding it (used by key rotation)."""
+    if is_legacy_blob(blob):
+        return MultiFernet([Fernet(new_key)] + [Fernet(k) for k in fernet_keys]).rotate(bytes(blob))
+    flags, payload = unseal(blob, fernet_keys)
+    return seal(flags, payload, new_key)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Report storage backends.
+
+save_report_to_db and load_reports_from_db keep reports in the embedded
+SQLite files by default (STORAGE_BACKEND=sqlite). With
+STORAGE_BACKEND=postgres they use the Flutter app's PostgreSQL database
+(EZ_reports/healthcare_schema.sql) at DATABASE_URL instead, so analyzed
+reports show up next to the patients, vitals and notifications the app
+already manages:
+
+    medical_reports    one 'Lab Report' row per analysis, abnormal results as findings
+    report_results     one row per test result (canonical value and unit, status, range)
+    report_analyses    the full analysis, encrypted like SQLite's report_data
+    notifications      critical-value alerts (see alerts.py)
+
+The app's patients rows need a date of birth and gender, which a report
+does not carry, so reports can only be saved for registered patients: the
+patient_name sent with a report is matched against patients.patient_id,
+then against first and last name (ignoring case and spacing). An unknown
+or ambiguous name fails the save with LookupError.
+
+Connections come from an asyncpg pool (PG_POOL_MIN / PG_POOL_MAX) run on
+a background event loop. Saves are batched like group_commit.py: those
+arriving within GROUP_COMMIT_WINDOW_MS are written in one transaction with
+one executemany per table, on statements prepared once per connection.
+
+Analytics, search, export and near-duplicate checks read the SQLite files,
+so they only cover reports saved there.
+
+    python report_store.py setup    # create report_results and report_analyses in DATABASE_URL
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import uuid
+from concurrent.futures import Future, wait
+from datetime import date, timezone
+
+# Optional imports with fallback handling
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from alerts import NOTIFICATION_TYPE, parse_day
+from group_commit import MAX_BATCH, WINDOW_MS
+from patient_ids import normalize_name
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+DATABASE_URL = os.getenv("DATABASE_URL")
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+
+# Tables the analysis server adds to healthcare_schema.sql (also listed there)
+RESULT_TABLES = '''
+CREATE TABLE IF NOT EXISTS report_results (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    report_id UUID NOT NULL REFERENCES medical_reports(id) ON DELETE CASCADE,
+    test_name TEXT NOT NULL,
+    value DOUBLE PRECISION,
+    unit TEXT,
+    status TEXT,
+    range_low DOUBLE PRECISION,
+    range_high DOUBLE PRECISION,
+    original_value DOUBLE PRECISION,
+    original_unit TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS report_analyses (
+    report_id UUID PRIMARY KEY REFERENCES medical_reports(id) ON DELETE CASCADE,
+    report_data BYTEA NOT NULL,
+    key_version INTEGER,
+    health_score INTEGER,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_report_results_report_id ON report_results(report_id);
+CREATE INDEX IF NOT EXISTS idx_report_results_test ON report_results(test_name);
+'''
+
+FULL_NAME = r"lower(regexp_replace(btrim(first_name) || ' ' || btrim(last_name), '\s+', ' ', 'g'))"
+FIND_PATIENTS = f'''
+    SELECT id, patient_id, {FULL_NAME} AS full_name FROM patients
+    WHERE is_active IS NOT FALSE AND (patient_id = ANY($1::text[]) OR {FULL_NAME} = ANY($2::text[]))
+'''
+INSERT_REPORT = '''
+    INSERT INTO medical_reports (id, patient_id, report_type, report_name, report_date, description, findings)
+    VALUES ($1, $2, 'Lab Report', $3, $4, $5, $6)
+'''
+INSERT_ANALYSIS = "INSERT INTO report_analyses (report_id, report_data, key_version, health_score) VALUES ($1, $2, $3, $4)"
+INSERT_RESULT = '''
+    INSERT INTO report_results (report_id, test_name, value, unit, status, range_low, range_high,
+                                original_value, original_unit)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+'''
+INSERT_NOTIFICATION = "INSERT INTO notifications (patient_id, title, message, type, priority) VALUES ($1, $2, $3, $4, $5)"
+LOAD_REPORTS = '''
+    SELECT r.report_date, a.report_data, a.key_version
+    FROM medical_reports r JOIN report_analyses a ON a.report_id = r.id
+    WHERE r.patient_id = $1 AND r.status = 'Active'
+    ORDER BY r.report_date DESC, r.created_at DESC LIMIT $2
+'''
+# Changes with every report added, edited (updated_at trigger) or deleted
+PATIENT_VERSION = '''
+    SELECT COUNT(*) + COALESCE((EXTRACT(EPOCH FROM MAX(r.updated_at)) * 1000000)::BIGINT, 0), MAX(r.updated_at)
+    FROM medical_reports r JOIN report_analyses a ON a.report_id = r.id
+    WHERE r.patient_id = $1
+'''
+PREVIOUS_VALUES = '''
+    SELECT DISTINCT ON (x.test_name) x.test_name, x.value, r.report_date
+    FROM report_results x JOIN medical_reports r ON r.id = x.report_id
+    WHERE r.patient_id = $1 AND r.report_date <= $2 AND r.status = 'Active'
+          AND x.test_name = ANY($3::text[]) AND x.value IS NOT NULL
+    ORDER BY x.test_name, r.report_date DESC, r.created_at DESC
+'''
+
+
+def number(value):
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def report_day(report_date):
+    return parse_day(report_date) or date.today()
+
+
+def report_summary(report_data):
+    """(description, findings, health score) for a report's medical_reports row."""
+    tests = report_data.get("tests", [])
+    score = report_data.get("health_score")
+    score = score.get("score") if isinstance(score, dict) else score[0] if score else None
+    abnormal = [f"{test['test_name']} {test.get('value')} {test.get('unit') or ''}".rstrip() + f" ({test['status']})"
+                for test in tests if test.get("status") not in (None, "Normal")]
+    description = f"{len(tests)} results analyzed" + (f", health score {score}%" if score is not None else "")
+    return description, "; ".join(abnormal) or "All results within normal range", score
+
+
+def match_patient(rows, patient_name):
+    """patients.id for a name or patient_id among rows of FIND_PATIENTS, else a LookupError to raise."""
+    by_id = [row["id"] for row in rows if row["patient_id"] == patient_name.strip()]
+    matches = by_id or [row["id"] for row in rows if row["full_name"] == normalize_name(patient_name)]
+    if len(matches) == 1:
+        return matches[0]
+    if matches:
+        return LookupError(f"'{patient_name}' matches {len(matches)} registered patients; send their patient_id")
+    return LookupError(f"No registered patient '{patient_name}'")
+
+
+class PostgresReportStore:
+    """Reports in the app's PostgreSQL schema, written in batches through an asyncpg pool."""
+
+    name = "postgres"
+
+    def __init__(self, dsn=DATABASE_URL, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX,
+                 window_ms=WINDOW_MS, max_batch=MAX_BATCH):
+        if asyncpg is None:
+            raise ImportError("asyncpg is not installed")
+        if not dsn:
+            raise ValueError("DATABASE_URL is not set")
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.batches = self.writes = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="postgres store", daemon=True)
+        self.thread.start()
+        self.pool, self.queue = self._call(self._open(dsn, min_size, max_size))
+        self.batcher = asyncio.run_coroutine_threadsafe(self._write_batches(), self.loop)
+
+    def _call(self, coro):
+        """Runs a coroutine on the store's loop and waits for it (from any other thread)."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _open(self, dsn, min_size, max_size):
+        return await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size), asyncio.Queue()
+
+    def setup(self):
+        self._call(self._setup())
+
+    async def _setup(self):
+        async with self.pool.acquire() as conn:
+            missing = [table for table in ("patients", "medical_reports", "notifications")
+                       if await conn.fetchval("SELECT to_regclass($1)", table) is None]
+            if missing:
+                raise RuntimeError(f"{', '.join(missing)} not found: apply EZ_reports/healthcare_schema.sql first")
+            await conn.execute(RESULT_TABLES)
+
+    def submit(self, patient_name, report_date, report_data, report_blob, key_version):
+        """Queues a report; returns a Future of its medical_reports id, set once committed."""
+        future = Future()
+        with self.lock:
+            self.pending.setdefault(normalize_name(patient_name), set()).add(future)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait,
+                                       (patient_name, report_date, report_data, report_blob, key_version, future))
+        return future
+
+    def wait_pending(self, patient_name):
+        """Read-your-writes: waits for this process's queued saves for the patient."""
+        with self.lock:
+            futures = list(self.pending.get(normalize_name(patient_name), ()))
+        if futures:
+            wait(futures)
+
+    async def _write_batches(self):
+        stopping = False
+        while not stopping:
+            batch = [await self.queue.get()]
+            if batch[0] is None:
+                break
+            # Let concurrent requests join this transaction
+            if self.window and self.queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                outcomes = await self._write(conn, batch)
+        except Exception as e:
+            if len(batch) > 1:
+                # One bad report should not fail the others: write them one by one
+                for item in batch:
+                    await self._commit([item])
+                return
+            outcomes = [(batch[0][-1], None, e)]
+
+        with self.lock:
+            self.batches += 1
+            self.writes += len(batch)
+            for item in batch:
+                key = normalize_name(item[0])
+                waiting = self.pending.get(key)
+                if waiting is not None:
+                    waiting.discard(item[-1])
+                    if not waiting:
+                        del self.pending[key]
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    async def _find_patients(self, conn, names):
+        rows = await conn.fetch(FIND_PATIENTS, [name.strip() for name in names],
+                                [normalize_name(name) for name in names])
+        return {name: match_patient(rows, name) for name in names}
+
+    async def _write(self, conn, batch):
+        patients = await self._find_patients(conn, list({item[0] for item in batch}))
+        reports, analyses, results, notifications, outcomes = [], [], [], [], []
+        for patient_name, report_date, report_data, report_blob, key_version, future in batch:
+            patient = patients[patient_name]
+            if isinstance(patient, Exception):
+                outcomes.append((future, None, patient))
+                continue
+            report_id = uuid.uuid4()
+            description, findings, score = report_summary(report_data)
+            day = report_day(report_date)
+            reports.append((report_id, patient, f"Lab Report {day.isoformat()}", day, description, findings))
+            analyses.append((report_id, report_blob, key_version, score))
+            results.extend((report_id, test["test_name"], number(test.get("value")), test.get("unit"),
+                            test.get("status"), number(test.get("range_low")), number(test.get("range_high")),
+                            number(test.get("original_value")), test.get("original_unit"))
+                           for test in report_data.get("tests", []))
+            notifications.extend((patient, alert["title"], alert["message"], NOTIFICATION_TYPE, alert["priority"])
+                                 for alert in report_data.get("alerts", []))
+            outcomes.append((future, str(report_id), None))
+
+        for statement, rows in ((INSERT_REPORT, reports), (INSERT_ANALYSIS, analyses),
+                                (INSERT_RESULT, results), (INSERT_NOTIFICATION, notifications)):
+            if rows:
+                await conn.executemany(statement, rows)
+        return outcomes
+
+    def load_reports(self, patient_name, limit=5):
+        """[(report_date, report_data blob, key_version)], newest first; [] for unknown patients."""
+        self.wait_pending(patient_name)
+        return self._call(self._load_reports(patient_name, limit))
+
+    async def _load_reports(self, patient_name, limit):
+        async with self.pool.acquire() as conn:
+            patient = (await self._find_patients(conn, [patient_name]))[patient_name]
+            if isinstance(patient, Exception):
+                return []
+            rows = await conn.fetch(LOAD_REPORTS, patient, limit)
+        return [(row["report_date"].isoformat(), bytes(row["report_data"]), row["key_version"]) for row in rows]
+
+    def version(self, patient_name):
+        """(version, updated_at) of a patient's reports; (0, None) if there are none."""
+        self.wait_pending(patient_name)
+        return self._call(self._version(patient_name))
+
+    async def _version(self, patient_name):
+        async with self.pool.acquire() as conn:
+            patient = (await self._find_patients(conn, [patient_name]))[patient_name]
+            if isinstance(patient, Exception):
+                return 0, None
+            version, updated_at = await conn.fetchrow(PATIENT_VERSION, patient)
+        if updated_at is None:
+            return 0, None
+        return version, updated_at.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def previous_values(self, patient_name, report_date, test_names):
+        """{test_name: (value, report_date)}: each test's latest result on or before report_date."""
+        return self._call(self._previous_values(patient_name, report_date, test_names))
+
+    async def _previous_values(self, patient_name, report_date, test_names):
+        async with self.pool.acquire() as conn:
+            patient = (await self._find_patients(conn, [patient_name]))[patient_name]
+            if isinstance(patient, Exception):
+                return {}
+            rows = await conn.fetch(PREVIOUS_VALUES, patient, report_day(report_date), list(test_names))
+        return {row["test_name"]: (row["value"], row["report_date"].isoformat()) for row in rows}
+
+    def close(self):
+        """Writes what is still queued, then closes the pool and the loop."""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+        self.batcher.result()
+        self._call(self.pool.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+BACKENDS = {
+    "postgres": PostgresReportStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_report_store(backend=None):
+    """
+    The shared store for backend (default: STORAGE_BACKEND), or None for
+    the embedded SQLite files. Raises ValueError for unknown backends.
+    """
+    global _store
+    backend = (backend or STORAGE_BACKEND).lower()
+    if backend == "sqlite":
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend '{backend}'. Choose from: sqlite, {', '.join(BACKENDS)}")
+    with _store_lock:
+        if _store is None:
+            _store = BACKENDS[backend]()
+        return _store
+
+
+def close_report_store():
+    global _store
+    with _store_lock:
+        store, _store = _store, None
+    if store is not None:
+        store.close()
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] != "setup":
+        print(__doc__)
+        return 1
+    try:
+        store = PostgresReportStore()
+        store.setup()
+    except (ImportError, ValueError, RuntimeError) as e:
+        print(f"❌ {e}")
+        return 1
+    store.close()
+    print("report_results and report_analyses are ready")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Response encoding for the Medical Report AI API.
+
+Picks the wire format from the Accept header (orjson JSON by default,
+MessagePack or CBOR on request), optionally deduplicates repeated
+explanation strings into a lookup table, and compresses large bodies
+with brotli or gzip depending on Accept-Encoding. Also implements the
+ETag / Last-Modified validators used for conditional GETs.
+"""
+
+import gzip
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi.responses import Response
+
+# Optional encoders with fallback handling
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_MEDIA_TYPE = "application/json; charset=utf-8"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+CBOR_MEDIA_TYPE = "application/cbor"
+# Short names of the media types, for ETags
+MEDIA_TYPE_TAGS = {JSON_MEDIA_TYPE: "json", MSGPACK_MEDIA_TYPE: "msgpack", CBOR_MEDIA_TYPE: "cbor"}
+
+# Bodies smaller than this are sent uncompressed; the header overhead and
+# CPU cost are not worth it for tiny payloads.
+COMPRESSION_THRESHOLD = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Request headers that change the body (?compact=1 is already part of the URL)
+VARY = "Accept, Accept-Encoding, X-Compact"
+
+
+def dedupe_explanations(payload):
+    """
+    Replaces repeated "explanation" strings with integer references into a
+    top-level "explanations" table. Works on the analyze-report output as
+    well as the patient-history payload (tests nested under historical data).
+    """
+    table = []
+    index = {}
+
+    def intern(text):
+        if text not in index:
+            index[text] = len(table)
+            table.append(text)
+        return index[text]
+
+    def walk(node):
+        if isinstance(node, dict):
+            out = {}
+            for key, value in node.items():
+                if key == "explanation" and isinstance(value, str):
+                    out["explanation_id"] = intern(value)
+                else:
+                    out[key] = walk(value)
+            return out
+        if isinstance(node, list):
+            return [walk(item) for item in node]
+        return node
+
+    compact = walk(payload)
+    if isinstance(compact, dict):
+        compact["explanations"] = table
+    return compact
+
+
+def negotiate_media_type(accept_header):
+    """Returns the media type to serve for the given Accept header."""
+    accept = (accept_header or "").lower()
+    if msgpack is not None and ("application/msgpack" in accept or "application/x-msgpack" in accept):
+        return MSGPACK_MEDIA_TYPE
+    if cbor2 is not None and "application/cbor" in accept:
+        return CBOR_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def serialize(content, media_type):
+    """Serializes content to bytes in the requested format."""
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return msgpack.packb(content, use_bin_type=True)
+    if media_type == CBOR_MEDIA_TYPE:
+        return cbor2.dumps(content)
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def accepted_codings(accept_encoding):
+    """
+    Codings the client accepts: {coding: q} from Accept-Encoding, with
+    "*" standing for any coding not listed. q=0 means "not acceptable".
+    """
+    codings = {}
+    for token in (accept_encoding or "").lower().split(","):
+        coding, _, params = token.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def is_accepted(codings, coding):
+    """True unless the client gave the coding (or "*", if it is not listed) q=0."""
+    return codings.get(coding, codings.get("*", 0.0)) > 0
+
+
+def compress(body, accept_encoding):
+    """Compresses body if it is large enough. Returns (body, content_encoding)."""
+    if len(body) < COMPRESSION_THRESHOLD:
+        return body, None
+
+    # br;q=0 or gzip;q=0 rule a coding out even when "*" would allow it
+    accepted = accepted_codings(accept_encoding)
+    if brotli is not None and is_accepted(accepted, "br"):
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if is_accepted(accepted, "gzip"):
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+def wants_compact(request):
+    """Clients opt in to the explanation lookup table with ?compact=1 or X-Compact: 1."""
+    flag = request.query_params.get("compact") or request.headers.get("x-compact", "")
+    return flag.lower() in ("1", "true", "yes")
+
+
+def encode_response(request, content, status_code=200, headers=None):
+    """
+    Builds a Response for content using the client's Accept and
+    Accept-Encoding headers.
+    """
+    if wants_compact(request):
+        content = dedupe_explanations(content)
+
+    media_type = negotiate_media_type(request.headers.get("accept"))
+    body = serialize(content, media_type)
+    body, content_encoding = compress(body, request.headers.get("accept-encoding"))
+
+    response_headers = {"Vary": VARY}
+    if content_encoding:
+        response_headers["Content-Encoding"] = content_encoding
+    if headers:
+        response_headers.update(headers)
+
+    return Response(content=body, status_code=status_code, media_type=media_type, headers=response_headers)
+
+
+def http_date(timestamp):
+    """Converts an ISO "YYYY-MM-DDTHH:MM:SSZ" timestamp to an HTTP-date, or None."""
+    if not timestamp:
+        return None
+    moment = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    return format_datetime(moment, usegmt=True)
+
+
+def representation_etag(request, tag):
+    """
+    Weak ETag for tag in the representation this request gets: its media
+    type and compact or full form, so a validator from one representation
+    never answers 304 for another.
+    """
+    media_type = negotiate_media_type(request.headers.get("accept"))
+    form = "compact" if wants_compact(request) else "full"
+    return f'W/"{tag}-{MEDIA_TYPE_TAGS[media_type]}-{form}"'
+
+
+def validator_headers(etag, last_modified=None):
+    """Headers sent with every conditional-GET capable response."""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """
+    Evaluates If-None-Match (preferred) or If-Modified-Since against the
+    current validators, using weak comparison as RFC 9110 requires for GET.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        current = etag[2:] if etag.startswith("W/") else etag
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip()
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate == current:
+                return True
+        return False
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def not_modified_response(etag, last_modified=None):
+    """Empty 304 response carrying the current validators."""
+    headers = validator_headers(etag, last_modified)
+    headers["Vary"] = VARY
+    return Response(status_code=304, headers=headers)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Full-text search over report text with SQLite FTS5.
+
+save_report_to_db stores each report's clean text encrypted next to the
+report (patient_reports.text_data) and indexes it in a contentless FTS5
+table. The index never holds plaintext: every word is replaced by a keyed
+hash (HMAC-SHA256, truncated), and queries are hashed the same way. Word
+positions are kept, so phrase queries ("fatty liver") and bm25 ranking work
+as usual. Only the page of hits being returned is decrypted, to build
+snippets.
+
+    report_search  rowid = report id; patient (hashed name), body (hashed words)
+
+The token key comes from SEARCH_TOKEN_KEY, or is derived from the current
+ENCRYPTION_KEY. After changing either, re-index with
+
+    python search_index.py rebuild
+"""
+
+import base64
+import hashlib
+import hmac
+import re
+import sqlite3
+import sys
+import time
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from patient_ids import decrypt_name, normalize_name
+from report_codec import decode_text
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+QUERY_TERM_RE = re.compile(r'"([^"]*)"|(\S+)')
+TOKEN_BYTES = 8
+SNIPPET_WORDS = 12
+MAX_QUERY_TERMS = 16
+# Deepest page a query may ask for; every shard ranks offset + limit hits
+MAX_OFFSET = 1000
+
+
+def search_key(key_material):
+    """32-byte HMAC key from SEARCH_TOKEN_KEY or a Fernet key."""
+    if isinstance(key_material, str):
+        key_material = key_material.encode()
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"ez-reports search tokens")
+    return hkdf.derive(key_material)
+
+
+def token(key, word):
+    digest = hmac.new(key, word.lower().encode("utf-8"), hashlib.sha256).digest()[:TOKEN_BYTES]
+    # Base32 keeps tokens within what the FTS5 unicode61 tokenizer treats as one word
+    return base64.b32encode(digest).decode("ascii").rstrip("=").lower()
+
+
+def patient_token(key, patient_name):
+    return token(key, "patient:" + normalize_name(patient_name))
+
+
+def setup_search_tables(conn):
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS report_search USING fts5(patient, body, content='')
+    ''')
+
+
+def index_report(conn, report_id, patient_name, clean_text, key):
+    """Adds a saved report's text to the index. Runs inside the caller's transaction."""
+    body = " ".join(token(key, word) for word in WORD_RE.findall(clean_text))
+    conn.execute("INSERT INTO report_search (rowid, patient, body) VALUES (?, ?, ?)",
+                 (report_id, patient_token(key, patient_name), body))
+
+
+def parse_query(query):
+    """[[word, ...], ...]: one entry per bare word or quoted phrase. Raises ValueError if empty."""
+    terms = []
+    for phrase, word in QUERY_TERM_RE.findall(query):
+        words = WORD_RE.findall(phrase or word)
+        if words:
+            terms.append(words)
+    if not terms:
+        raise ValueError("query has no searchable words")
+    if len(terms) > MAX_QUERY_TERMS:
+        raise ValueError(f"query has more than {MAX_QUERY_TERMS} terms")
+    return terms
+
+
+def match_expression(key, terms, patient_name=None):
+    """FTS5 MATCH string: every term (a phrase of hashed words) must occur in the body."""
+    body = " AND ".join('"' + " ".join(token(key, word) for word in words) + '"' for words in terms)
+    if patient_name:
+        return f'patient : "{patient_token(key, patient_name)}" AND body : ({body})'
+    return f"body : ({body})"
+
+
+def make_snippet(text, terms, width=SNIPPET_WORDS):
+    """About width words around the first match, with matched words wrapped in <mark>."""
+    words = list(WORD_RE.finditer(text))
+    lowered = [match.group(0).lower() for match in words]
+    hits = set()
+    for phrase in terms:
+        phrase = [word.lower() for word in phrase]
+        for i in range(len(lowered) - len(phrase) + 1):
+            if lowered[i:i + len(phrase)] == phrase:
+                hits.update(range(i, i + len(phrase)))
+    if not words:
+        return ""
+    first = min(hits) if hits else 0
+    start = max(0, first - width // 3)
+    end = min(len(words), start + width)
+    pieces, position = [], words[start].start()
+    for i in range(start, end):
+        match = words[i]
+        pieces.append(text[position:match.start()])
+        pieces.append(f"<mark>{match.group(0)}</mark>" if i in hits else match.group(0))
+        position = match.end()
+    snippet = " ".join("".join(pieces).split())
+    return ("… " if start > 0 else "") + snippet + (" …" if end < len(words) else "")
+
+
+def search_hits(conn, key, terms, patient_name=None, limit=20, offset=0):
+    """(total, [(report_id, rank), ...]) for parsed query terms, best first. Reads only the index."""
+    expression = match_expression(key, terms, patient_name)
+    total = conn.execute("SELECT COUNT(*) FROM report_search WHERE report_search MATCH ?", (expression,)).fetchone()[0]
+    hits = conn.execute("SELECT rowid, bm25(report_search) AS rank FROM report_search "
+                        "WHERE report_search MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+                        (expression, limit, offset)).fetchall()
+    return total, hits
+
+
+def load_hits(conn, keys_by_version, terms, hits):
+    """
+    Decrypts the patient name and text of each (report_id, rank) hit to build
+    its result entry, in the order given.
+    """
+    if not hits:
+        return []
+    rows = {row[0]: row for row in conn.execute(f'''
+        SELECT r.id, p.name_data, p.key_version, r.report_date, r.text_data, r.key_version
+        FROM patient_reports r
+        LEFT JOIN patients p ON p.patient_id = r.patient_id
+        WHERE r.id IN ({", ".join("?" * len(hits))})
+    ''', [report_id for report_id, _ in hits])}
+
+    results = []
+    for report_id, rank in hits:
+        if report_id not in rows:
+            continue
+        _, name_data, name_version, report_date, text_data, key_version = rows[report_id]
+        try:
+            row_patient = decrypt_name(name_data, name_version, keys_by_version)
+        except Exception:
+            row_patient = None
+        snippet = ""
+        if text_data is not None:
+            keys = [keys_by_version[key_version]] if key_version in keys_by_version else list(keys_by_version.values())
+            try:
+                snippet = make_snippet(decode_text(text_data, keys), terms)
+            except Exception:
+                pass
+        results.append({"report_id": report_id, "patient_name": row_patient, "report_date": report_date,
+                        "score": round(-rank, 3), "snippet": snippet})
+    return results
+
+
+def search(conn, key, keys_by_version, query, patient_name=None, limit=20, offset=0):
+    """
+    Ranked reports matching query (bare words and "quoted phrases", all
+    required). Returns {"total", "results": [{report_id, patient_name,
+    report_date, score, snippet}]}. Raises ValueError for an empty query.
+    """
+    terms = parse_query(query)
+    total, hits = search_hits(conn, key, terms, patient_name, limit, offset)
+    return {"total": total, "results": load_hits(conn, keys_by_version, terms, hits)}
+
+
+def rebuild_index(db_file, key, keys_by_version, batch_size=500):
+    """Re-indexes every report that has stored text. Returns (indexed, skipped)."""
+    conn = sqlite3.connect(db_file, timeout=30)
+    setup_search_tables(conn)
+    indexed = skipped = 0
+    with conn:
+        conn.execute("INSERT INTO report_search (report_search) VALUES ('delete-all')")
+        cursor = conn.execute("SELECT r.id, p.name_data, p.key_version, r.text_data, r.key_version "
+                              "FROM patient_reports r JOIN patients p ON p.patient_id = r.patient_id "
+                              "WHERE r.text_data IS NOT NULL ORDER BY r.id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for report_id, name_data, name_version, text_data, key_version in rows:
+                keys = [keys_by_version[key_version]] if key_version in keys_by_version else list(keys_by_version.values())
+                try:
+                    patient_name = decrypt_name(name_data, name_version, keys_by_version)
+                    index_report(conn, report_id, patient_name, decode_text(text_data, keys), key)
+                    indexed += 1
+                except Exception:
+                    skipped += 1
+    conn.close()
+    return indexed, skipped
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] != "rebuild":
+        print(__doc__)
+        return 1
+
+    from Aimodal import KEY_BYTES, SEARCH_KEY, SHARD_FILES, setup_database
+
+    setup_database()
+    started = time.perf_counter()
+    indexed, skipped = (sum(totals) for totals in zip(*(rebuild_index(db_file, SEARCH_KEY, KEY_BYTES)
+                                                        for db_file in SHARD_FILES)))
+    print(f"Indexed {indexed} reports in {time.perf_counter() - started:.1f}s"
+          f"{f' ({skipped} could not be decrypted)' if skipped else ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
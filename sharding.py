@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Sharded patient-report storage.
+
+SQLite lets one writer at a time into a database file, so with a single
+patient_reports.db every save, from every server worker and batch job,
+queues on the same lock. With DB_SHARDS=N patients are spread over N
+database files by a stable hash of their name's blind index (see
+patient_ids.py). Each file holds the full schema (patients, reports,
+versions, rollups, signatures, search index, outbox) for its own patients, so saves to different shards never wait for each
+other.
+
+    DB_SHARDS=1 (default)   DB_FILE, as before
+    DB_SHARDS=4             patient_reports.shard0of4.db ... patient_reports.shard3of4.db
+
+Anything about one patient (saving, history, duplicates) opens only that
+patient's shard. Questions over every patient (analytics, search, export,
+pending alerts) run on all shards in parallel and merge the answers.
+
+Patients are placed with jump consistent hashing, so going from N to M
+shards moves only the patients that must move (a quarter of them from 3
+to 4 shards). Report ids stay unique across shards: each shard of an
+N-shard layout allocates ids from its own range. Reports copied into a
+shard are renumbered into its range (keeping their order), so a file
+never holds ids above the ones it will hand out next.
+
+    python sharding.py status
+    python sharding.py check          # every patient on its own shard, no patient on two
+    python sharding.py rebalance 8    # server stopped: copy into an 8-shard layout, then set DB_SHARDS=8
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from analytics import patient_key
+
+MAX_SHARDS = 64
+# Each (shard count, shard index) owns 2^32 report ids; all ranges stay below 2^53 for JSON clients
+ID_RANGE_BITS = 32
+
+_writer_locks = {}
+_writer_locks_lock = threading.Lock()
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping & Veach) of a 64-bit key into [0, buckets)."""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_for_key(key, count):
+    """Shard index of a patient's name index (hex) in a count-shard layout."""
+    return jump_hash(int(key, 16), count) if count > 1 else 0
+
+
+def shard_files(db_file, count):
+    """Database files of a count-shard layout; a single shard is db_file itself."""
+    if not 1 <= count <= MAX_SHARDS:
+        raise ValueError(f"shard count must be between 1 and {MAX_SHARDS}")
+    if count == 1:
+        return [db_file]
+    stem, ext = os.path.splitext(db_file)
+    return [f"{stem}.shard{index}of{count}{ext or '.db'}" for index in range(count)]
+
+
+def id_range(count, index):
+    """(first, last) report id owned by shard index of a count-shard layout. One shard keeps ids from 1."""
+    base = (count * (count - 1) // 2 + index) << ID_RANGE_BITS
+    return base + 1, base + (1 << ID_RANGE_BITS) - 1
+
+
+def next_report_id(conn, count, index):
+    """Next free id in the shard's range. Call inside a write transaction (BEGIN IMMEDIATE)."""
+    first, last = id_range(count, index)
+    current = conn.execute("SELECT MAX(id) FROM patient_reports WHERE id BETWEEN ? AND ?", (first, last)).fetchone()[0]
+    if current == last:
+        raise RuntimeError(f"shard {index} of {count} has used up its report ids")
+    return first if current is None else current + 1
+
+
+def writer_lock(db_file):
+    """
+    One lock per shard file, so threads of one process queue for their own
+    shard instead of spinning on SQLite's busy timeout.
+    """
+    with _writer_locks_lock:
+        return _writer_locks.setdefault(db_file, threading.Lock())
+
+
+def fan_out(fn, db_files):
+    """[fn(db_file) for each shard], run on all shards at once."""
+    if len(db_files) == 1:
+        return [fn(db_files[0])]
+    with ThreadPoolExecutor(max_workers=len(db_files)) as pool:
+        return list(pool.map(fn, db_files))
+
+
+def shard_stats(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        reports, patients = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM patient_reports), (SELECT COUNT(*) FROM patients)").fetchone()
+    finally:
+        conn.close()
+    return {"file": db_file, "reports": reports, "patients": patients, "bytes": os.path.getsize(db_file)}
+
+
+REPORT_COLUMNS = "{id}, {patient_id}, report_date, report_data, key_version, cohort, text_data"
+# Outbox ids are per shard, so copied notifications are numbered afresh
+OUTBOX_COLUMNS = ("{patient_id}, {report_id}, rule_id, test_name, title, message, type, priority, "
+                  "is_read, scheduled_at, sent_at, created_at")
+
+
+def copy_patients(conn, ids, where, params=(), move=False):
+    """
+    Copies the patients of conn's main database matching where (a condition
+    on main.patients p) and all their rows into the database attached as
+    target. Their reports are renumbered, in order, into ids = (first, last),
+    the target shard's range, so every report id of a file stays in its range
+    and new saves there get the highest ids (export watermarks rely on it).
+    A patient the target already knows by name index is merged into that
+    patient. With move=True they are then deleted from main. Call in a
+    transaction; rollups and the search index are rebuilt afterwards, not copied.
+
+    A commit across attached WAL databases is atomic per file only, so a move
+    can land on the target and not be deleted from main. A patient the target
+    already has under the same id and name index is that copy: none of its
+    rows are copied again, and move=True still deletes them from main.
+    """
+    conn.create_function("patient_key", 1, patient_key, deterministic=True)
+    conn.execute("CREATE TEMP TABLE moving AS SELECT p.patient_id, COALESCE(t.patient_id, p.patient_id) AS new_id, "
+                 "COALESCE(t.patient_id = p.patient_id, 0) AS copied "
+                 f"FROM main.patients p LEFT JOIN target.patients t ON t.name_index = p.name_index WHERE {where}",
+                 params)
+    first, last = ids
+    top = conn.execute("SELECT MAX(id) FROM target.patient_reports WHERE id BETWEEN ? AND ?", ids).fetchone()[0]
+    conn.execute("CREATE TEMP TABLE renumbered (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+    conn.execute("INSERT INTO renumbered SELECT id, ? + ROW_NUMBER() OVER (ORDER BY id) FROM main.patient_reports "
+                 "WHERE patient_id IN (SELECT patient_id FROM moving WHERE NOT copied)", ((top or first - 1),))
+    if (conn.execute("SELECT MAX(new_id) FROM renumbered").fetchone()[0] or 0) > last:
+        raise RuntimeError("target shard has no report ids left for the copied reports")
+
+    conn.execute("INSERT INTO target.patients SELECT * FROM main.patients "
+                 "WHERE patient_id IN (SELECT patient_id FROM moving WHERE new_id = patient_id AND NOT copied)")
+    conn.execute(f"INSERT INTO target.patient_reports ({REPORT_COLUMNS.format(id='id', patient_id='patient_id')}) "
+                 f"SELECT {REPORT_COLUMNS.format(id='n.new_id', patient_id='m.new_id')} "
+                 "FROM main.patient_reports r JOIN moving m USING (patient_id) JOIN renumbered n ON n.old_id = r.id")
+    conn.execute("INSERT INTO target.patient_versions (patient_id, version, updated_at) "
+                 "SELECT m.new_id, v.version, v.updated_at FROM main.patient_versions v JOIN moving m USING (patient_id) "
+                 "WHERE NOT m.copied ON CONFLICT (patient_id) DO UPDATE SET version = version + excluded.version, "
+                 "updated_at = MAX(updated_at, excluded.updated_at)")
+    new_key = ("(SELECT patient_key(m.new_id) FROM main.patient_reports r JOIN moving m USING (patient_id) "
+               "WHERE r.id = s.report_id)")
+    conn.execute(f"INSERT INTO target.report_signatures SELECT n.new_id, {new_key}, s.signature "
+                 "FROM main.report_signatures s JOIN renumbered n ON n.old_id = s.report_id")
+    conn.execute(f"INSERT INTO target.report_lsh SELECT {new_key}, s.band, s.bucket, n.new_id "
+                 "FROM main.report_lsh s JOIN renumbered n ON n.old_id = s.report_id")
+    renumbered_report = "(SELECT n.new_id FROM renumbered n WHERE n.old_id = o.report_id)"
+    conn.execute(f"INSERT INTO target.notification_outbox "
+                 f"({OUTBOX_COLUMNS.format(patient_id='patient_id', report_id='report_id')}) "
+                 f"SELECT {OUTBOX_COLUMNS.format(patient_id='m.new_id', report_id=renumbered_report)} "
+                 "FROM main.notification_outbox o JOIN moving m USING (patient_id) WHERE NOT m.copied ORDER BY o.id")
+    if move:
+        for table in ("report_signatures", "report_lsh"):
+            conn.execute(f"DELETE FROM main.{table} WHERE report_id IN (SELECT old_id FROM renumbered)")
+        for table in ("patient_reports", "patient_versions", "notification_outbox", "patients"):
+            conn.execute(f"DELETE FROM main.{table} WHERE patient_id IN (SELECT patient_id FROM moving)")
+    moved = conn.execute("SELECT COUNT(*) FROM moving").fetchone()[0]
+    conn.execute("DROP TABLE moving")
+    conn.execute("DROP TABLE renumbered")
+    return moved
+
+
+def misplaced_patients(db_file, index, count):
+    """Patients in shard index of a count-shard layout whose name index belongs on another shard."""
+    conn = sqlite3.connect(db_file)
+    try:
+        return sum(1 for (key,) in conn.execute("SELECT name_index FROM patients")
+                   if shard_for_key(key, count) != index)
+    finally:
+        conn.close()
+
+
+def place_patients(db_files, finish_shard):
+    """
+    Moves patients stored on the wrong shard of db_files to their own.
+    Databases sharded before patients were placed by name index (see
+    patient_ids.py) start out that way. finish_shard(file) rebuilds each
+    shard that changed. Returns the number of patients moved.
+    """
+    count, moved, changed = len(db_files), 0, set()
+    for index, source in enumerate(db_files):
+        if not misplaced_patients(source, index, count):
+            continue
+        conn = sqlite3.connect(source, timeout=30, isolation_level=None)
+        conn.create_function("target_shard", 1, lambda key: shard_for_key(key, count), deterministic=True)
+        for target_index, target in enumerate(db_files):
+            if target_index == index:
+                continue
+            conn.execute("ATTACH DATABASE ? AS target", (target,))
+            # Another worker starting at the same time waits here, then finds nothing left to move
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                patients = copy_patients(conn, id_range(count, target_index), "target_shard(p.name_index) = ?",
+                                         (target_index,), move=True)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("DETACH DATABASE target")
+            if patients:
+                moved += patients
+                changed.update((source, target))
+        conn.close()
+    for db_file in db_files:
+        if db_file in changed:
+            finish_shard(db_file)
+    return moved
+
+
+def check_placement(db_files):
+    """
+    What is wrong with where patients are stored: patients on another
+    shard than their name index's, a name index on more than one shard,
+    reports or versions of patients the shard does not have, report ids
+    outside the shard's range. [] when sound.
+    """
+    problems, seen = [], {}
+    for index, db_file in enumerate(db_files):
+        misplaced = misplaced_patients(db_file, index, len(db_files))
+        if misplaced:
+            problems.append(f"{db_file}: {misplaced} patients belong on another shard")
+        conn = sqlite3.connect(db_file)
+        try:
+            for (key,) in conn.execute("SELECT name_index FROM patients"):
+                if key in seen:
+                    problems.append(f"a patient is stored on both {seen[key]} and {db_file}")
+                seen.setdefault(key, db_file)
+            for table in ("patient_reports", "patient_versions"):
+                orphans = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE patient_id NOT IN "
+                                       "(SELECT patient_id FROM patients)").fetchone()[0]
+                if orphans:
+                    problems.append(f"{db_file}: {orphans} {table} rows of patients not on this shard")
+            outside = conn.execute("SELECT COUNT(*) FROM patient_reports WHERE id NOT BETWEEN ? AND ?",
+                                   id_range(len(db_files), index)).fetchone()[0]
+            if outside:
+                # Left by rebalances before copied reports were renumbered; rebalancing again renumbers them
+                problems.append(f"{db_file}: {outside} reports have ids outside this shard's range, so later "
+                                f"saves would fall below the export watermark")
+        finally:
+            conn.close()
+    return problems
+
+
+def rebalance(db_file, from_count, to_count, setup_shard, finish_shard):
+    """
+    Copies every patient from the from_count-shard layout into a new
+    to_count-shard layout. setup_shard(file) creates the schema and
+    finish_shard(file) rebuilds what cannot be copied (rollups, search
+    index). Old files are left in place. Returns {target file: reports}.
+    """
+    sources, targets = shard_files(db_file, from_count), shard_files(db_file, to_count)
+    if from_count == to_count:
+        raise ValueError(f"already on {to_count} shards")
+    for target in targets:
+        if os.path.exists(target) and target not in sources:
+            if shard_stats(target)["reports"]:
+                raise ValueError(f"{target} already holds reports")
+    for target in targets:
+        setup_shard(target)
+
+    for source in sources:
+        conn = sqlite3.connect(source, timeout=30)
+        conn.create_function("target_shard", 1, lambda key: shard_for_key(key, to_count), deterministic=True)
+        for index, target in enumerate(targets):
+            conn.execute("ATTACH DATABASE ? AS target", (target,))
+            with conn:
+                copy_patients(conn, id_range(to_count, index), "target_shard(p.name_index) = ?", (index,))
+            conn.execute("DETACH DATABASE target")
+        conn.close()
+
+    for target in targets:
+        finish_shard(target)
+    return {target: shard_stats(target)["reports"] for target in targets}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="reports and patients per shard")
+    sub.add_parser("check", help="verify every patient is stored once, on its own shard")
+    p = sub.add_parser("rebalance", help="copy all patients into a layout with a new shard count")
+    p.add_argument("shards", type=int)
+    args = parser.parse_args()
+
+    from Aimodal import DB_FILE, DB_SHARDS, SHARD_FILES, rebuild_shard, setup_database, setup_shard
+
+    setup_database()
+    if args.command == "status":
+        for stats in fan_out(shard_stats, SHARD_FILES):
+            print(f"{stats['file']}: {stats['reports']} reports, {stats['patients']} patients, "
+                  f"{stats['bytes'] / 1e6:.1f} MB")
+        return 0
+    if args.command == "check":
+        problems = check_placement(SHARD_FILES)
+        for problem in problems:
+            print(f"❌ {problem}")
+        if not problems:
+            print(f"✅ {len(SHARD_FILES)} shards: every patient is stored once, on its own shard")
+        return 1 if problems else 0
+
+    started = time.perf_counter()
+    try:
+        moved = rebalance(DB_FILE, DB_SHARDS, args.shards, setup_shard, rebuild_shard)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    for target, reports in moved.items():
+        print(f"{target}: {reports} reports")
+    print(f"Copied {sum(moved.values())} reports into {args.shards} shards in {time.perf_counter() - started:.1f}s")
+    print(f"Set DB_SHARDS={args.shards} and restart the server. Export watermarks start over on the "
+          f"new files, so point incremental exports at a fresh directory. Remove the old files once satisfied.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,48 @@
 #!/usr/bin/env python3
 """
 Startup script for the Medical Report AI FastAPI server
+
+    python start_server.py            # dev: one process, auto-reload on code changes
+    python start_server.py --prod     # prod: one worker per core, warm-up, backpressure
+
+In prod mode send SIGHUP to the server process to replace the workers one
+at a time (each new worker is warmed up before the old one is stopped).
+Prod mode needs ENCRYPTION_KEY set (python setup_env.py writes one to .env):
+every worker has to encrypt, index and place patients with the same key.
 """
 
+import argparse
 import subprocess
 import sys
 import os
 from pathlib import Path
 
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+# Production settings, overridable from the environment / .env
+SERVER_HOST = os.getenv("SERVER_HOST")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "0"))  # 0 = one per CPU core
+# Concurrent connections per worker before uvicorn answers a bare HTTP 503
+# (default: see limit_concurrency)
+SERVER_LIMIT_CONCURRENCY = int(os.getenv("SERVER_LIMIT_CONCURRENCY", "0"))
+# Room above the admission lanes for /health, refusals being written and idle keep-alive connections
+LIMIT_CONCURRENCY_HEADROOM = 64
+# Set for the prod workers once serve() has created/migrated the schema,
+# so fastapi_server skips its own setup_database() at import
+DB_SETUP_DONE_ENV = "DB_SETUP_DONE"
+# Pending connections the kernel may queue before refusing new ones
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "512"))
+# Recycle a worker after this many requests (jittered so they don't all restart at once)
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", "10000"))
+SERVER_MAX_REQUESTS_JITTER = int(os.getenv("SERVER_MAX_REQUESTS_JITTER", "1000"))
+SERVER_KEEP_ALIVE = int(os.getenv("SERVER_KEEP_ALIVE", "5"))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+
 def check_dependencies():
     """Check if required dependencies are installed"""
     required_packages = [
@@ -73,8 +108,87 @@ def check_optional_dependencies():
     
     return len(missing_optional) == 0
 
+def limit_concurrency():
+    """
+    uvicorn's per-worker connection limit. With admission control on it has
+    to sit above what the lanes hold (running plus queued), or uvicorn's bare
+    503 would answer first and the lanes' 429/Retry-After never be reached.
+    """
+    from admission import ADMISSION_CONTROL, lane_capacity
+
+    if not ADMISSION_CONTROL:
+        return SERVER_LIMIT_CONCURRENCY or 64
+    capacity = lane_capacity()
+    if SERVER_LIMIT_CONCURRENCY and SERVER_LIMIT_CONCURRENCY < capacity:
+        print(f"⚠️  SERVER_LIMIT_CONCURRENCY={SERVER_LIMIT_CONCURRENCY} is below the {capacity} requests the "
+              f"admission lanes hold; clients will get bare 503s instead of 429 with Retry-After")
+    return SERVER_LIMIT_CONCURRENCY or capacity + LIMIT_CONCURRENCY_HEADROOM
+
+def server_command(mode):
+    """Builds the uvicorn command line for dev or prod mode."""
+    if mode == "dev":
+        return [
+            sys.executable, '-m', 'uvicorn',
+            'fastapi_server:app',
+            '--host', SERVER_HOST or '127.0.0.1',
+            '--port', str(SERVER_PORT),
+            '--reload'
+        ]
+
+    workers = SERVER_WORKERS or os.cpu_count() or 1
+    return [
+        sys.executable, '-m', 'uvicorn',
+        'fastapi_server:app',
+        '--host', SERVER_HOST or '0.0.0.0',
+        '--port', str(SERVER_PORT),
+        '--workers', str(workers),
+        '--limit-concurrency', str(limit_concurrency()),
+        '--backlog', str(SERVER_BACKLOG),
+        '--limit-max-requests', str(SERVER_MAX_REQUESTS),
+        '--limit-max-requests-jitter', str(SERVER_MAX_REQUESTS_JITTER),
+        '--timeout-keep-alive', str(SERVER_KEEP_ALIVE),
+        '--timeout-graceful-shutdown', str(SERVER_GRACEFUL_TIMEOUT),
+        '--no-access-log'
+    ]
+
+def serve(mode="dev"):
+    """Runs the server in the foreground until it exits or Ctrl+C."""
+    env = None
+    if mode == "prod":
+        # Without it each worker would generate its own temporary key (see Aimodal.py)
+        if not os.getenv("ENCRYPTION_KEY"):
+            print("❌ ENCRYPTION_KEY is not set. Prod workers must share one key: "
+                  "run  python setup_env.py  or add it to .env")
+            return 1
+        # Create/migrate the schema once here; the workers see DB_SETUP_DONE and skip it
+        from Aimodal import setup_database
+        setup_database()
+        env = dict(os.environ, **{DB_SETUP_DONE_ENV: "1"})
+
+    command = server_command(mode)
+    host, port = command[command.index('--host') + 1], command[command.index('--port') + 1]
+    print(f"🌐 Starting FastAPI server ({mode} mode)...")
+    if mode == "prod":
+        print(f"👷 Workers: {command[command.index('--workers') + 1]}, "
+              f"max {command[command.index('--limit-concurrency') + 1]} concurrent connections each")
+    print(f"📍 Server will be available at: http://{host}:{port}")
+    print(f"📚 API documentation: http://{host}:{port}/docs")
+    print("🔄 Press Ctrl+C to stop the server")
+    print("=" * 50)
+
+    try:
+        return subprocess.run(command, env=env).returncode
+    except KeyboardInterrupt:
+        print("\n👋 Server stopped by user")
+        return 0
+
 def main():
     """Main startup function"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prod', action='store_true', help='multi-worker production mode')
+    args = parser.parse_args()
+    mode = 'prod' if args.prod or os.getenv("SERVER_MODE") == "prod" else 'dev'
+
     print("🚀 Starting Medical Report AI Server...")
     print("=" * 50)
     
@@ -98,28 +212,11 @@ def main():
     print()
     
     # Start the server
-    print("🌐 Starting FastAPI server...")
-    print("📍 Server will be available at: http://127.0.0.1:8000")
-    print("📚 API documentation: http://127.0.0.1:8000/docs")
-    print("🔄 Press Ctrl+C to stop the server")
-    print("=" * 50)
-    
     try:
-        # Start the FastAPI server
-        subprocess.run([
-            sys.executable, '-m', 'uvicorn',
-            'fastapi_server:app',
-            '--host', '127.0.0.1',
-            '--port', '8000',
-            '--reload'
-        ])
-    except KeyboardInterrupt:
-        print("\n👋 Server stopped by user")
+        return serve(mode)
     except Exception as e:
         print(f"❌ Error starting server: {e}")
         return 1
-    
-    return 0
 
 if __name__ == "__main__":
     sys.exit(main())
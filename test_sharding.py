@@ -0,0 +1,75 @@
+"""
+Patient placement across shards (sharding.py).
+
+    python -m pytest test_sharding.py     # or:  python test_sharding.py
+"""
+
+import os
+import sqlite3
+import tempfile
+
+from Aimodal import setup_shard
+from sharding import check_placement, copy_patients, id_range, place_patients, shard_files, shard_for_key
+
+
+def misplaced_patient_shards(tmp):
+    """Two shards where shard 0 holds a patient (2 reports, version 2) that belongs on shard 1."""
+    db_files = shard_files(os.path.join(tmp, "reports.db"), 2)
+    for db_file in db_files:
+        setup_shard(db_file)
+    name_index = next(key for key in (f"{n:064x}" for n in range(1, 100)) if shard_for_key(key, 2) == 1)
+    first, _ = id_range(2, 0)
+    conn = sqlite3.connect(db_files[0])
+    with conn:
+        conn.execute("INSERT INTO patients (patient_id, name_index, name_data, key_version, created_at) "
+                     "VALUES ('p1', ?, x'00', 1, '2025-01-01T00:00:00Z')", (name_index,))
+        conn.executemany("INSERT INTO patient_reports (id, patient_id, report_date, report_data, key_version) "
+                         "VALUES (?, 'p1', ?, x'00', 1)", [(first, "2025-01-01"), (first + 1, "2025-02-01")])
+        conn.execute("INSERT INTO patient_versions (patient_id, version, updated_at) "
+                     "VALUES ('p1', 2, '2025-02-01T00:00:00Z')")
+    conn.close()
+    return db_files
+
+
+def shard_counts(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute("SELECT (SELECT COUNT(*) FROM patients), (SELECT COUNT(*) FROM patient_reports), "
+                            "(SELECT SUM(version) FROM patient_versions)").fetchone()
+    finally:
+        conn.close()
+
+
+def test_place_patients_moves_misplaced_patient():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_files = misplaced_patient_shards(tmp)
+        assert place_patients(db_files, lambda db_file: None) == 1
+        assert shard_counts(db_files[0]) == (0, 0, None)
+        assert shard_counts(db_files[1]) == (1, 2, 2)
+        assert check_placement(db_files) == []
+
+
+def test_place_patients_finishes_half_done_move():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_files = misplaced_patient_shards(tmp)
+        # The copy committed on the target, the delete never did on the source
+        conn = sqlite3.connect(db_files[0], isolation_level=None)
+        conn.create_function("target_shard", 1, lambda key: shard_for_key(key, 2), deterministic=True)
+        conn.execute("ATTACH DATABASE ? AS target", (db_files[1],))
+        conn.execute("BEGIN IMMEDIATE")
+        copy_patients(conn, id_range(2, 1), "target_shard(p.name_index) = ?", (1,))
+        conn.execute("COMMIT")
+        conn.close()
+        assert shard_counts(db_files[0]) == shard_counts(db_files[1]) == (1, 2, 2)
+
+        assert place_patients(db_files, lambda db_file: None) == 1
+        assert shard_counts(db_files[0]) == (0, 0, None)
+        assert shard_counts(db_files[1]) == (1, 2, 2)
+        assert check_placement(db_files) == []
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")
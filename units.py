@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Unit registry for lab results.
+
+Every catalogue test has a canonical unit (its MEDICAL_TESTS unit). The
+unit a report prints after a value ("88 umol/L", "250 x10^9/L") is
+recognised and the value, and a reference range printed in the same unit,
+are converted to the canonical unit when the report is extracted. Each
+result keeps what the report said as original_value / original_unit, so
+trends, rollups, alerts and scores all read canonical values and nothing
+converts at read time.
+
+Units are grouped by dimension (cell counts per microlitre, mass and molar
+concentration, fraction, enzyme activity, time). Within a dimension the
+factor is a ratio of scales; between molar and mass concentration it uses
+the test's molar mass. Unknown or incompatible units are left as printed.
+
+Conversion is vectorized: factors are computed once per distinct
+(test, unit) pair and applied with numpy, so batch jobs cost about the same
+per result however many reports they cover.
+
+    python units.py reprocess    # convert reports saved before canonical units
+"""
+
+import math
+import re
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+# Normalized unit -> (dimension, scale in the dimension's base unit)
+UNIT_SCALES = {
+    # Cells per microlitre (1 cu mm = 1 uL)
+    "/ul": ("count", 1.0),
+    "10^3/ul": ("count", 1e3),
+    "10^9/l": ("count", 1e3),
+    "lac/ul": ("count", 1e5),
+    "10^5/ul": ("count", 1e5),
+    "10^6/ul": ("count", 1e6),
+    "10^12/l": ("count", 1e6),
+    # Mass concentration, g/L
+    "g/dl": ("mass", 10.0),
+    "g/l": ("mass", 1.0),
+    "mg/dl": ("mass", 0.01),
+    "mg/l": ("mass", 0.001),
+    # Molar concentration, mol/L
+    "mol/l": ("molar", 1.0),
+    "mmol/l": ("molar", 1e-3),
+    "umol/l": ("molar", 1e-6),
+    # Volume fraction
+    "%": ("fraction", 0.01),
+    "l/l": ("fraction", 1.0),
+    # Enzyme activity, U/L
+    "u/l": ("enzyme", 1.0),
+    "ukat/l": ("enzyme", 60.0),
+    # Time, seconds
+    "s": ("time", 1.0),
+    "min": ("time", 60.0),
+    "mm/h": ("rate", 1.0),
+}
+
+# Spellings seen on reports, after normalize_unit's lowercasing and cu mm -> ul
+UNIT_SYNONYMS = {
+    "cells/ul": "/ul", "cell/ul": "/ul",
+    "thousand/ul": "10^3/ul", "thou/ul": "10^3/ul", "k/ul": "10^3/ul",
+    "lacs/ul": "lac/ul", "lakhs/ul": "lac/ul", "lakh/ul": "lac/ul",
+    "million/ul": "10^6/ul", "millions/ul": "10^6/ul", "mill/ul": "10^6/ul",
+    "gm/dl": "g/dl", "gms/dl": "g/dl", "gm%": "g/dl", "g%": "g/dl",
+    "mg%": "mg/dl", "mg/100ml": "mg/dl",
+    "meq/l": "mmol/l",
+    "iu/l": "u/l", "units/l": "u/l",
+    "mm/hr": "mm/h", "mm/1sthr": "mm/h",
+    "sec": "s", "secs": "s", "seconds": "s",
+    "mins": "min", "minutes": "min",
+}
+
+# g/mol, for converting molar to mass concentration (haemoglobin per haem unit)
+MOLAR_MASSES = {
+    "Hemoglobin": 16114.0,
+    "HGB": 16114.0,
+    "Blood Sugar": 180.16,
+    "Random Blood Sugar": 180.16,
+    "Serum Creatinine": 113.12,
+    "Blood Urea": 60.06,
+    "Total Bilirubin": 584.66,
+    "Conjugated Bilirubin": 584.66,
+}
+
+# A unit printed right after a value: "x10^9/L", "10^3/uL", "%" or a word such as "mmol/L" or "cells/cu mm"
+UNIT_TOKEN_RE = re.compile(
+    r"\s*((?:[x×*]\s*)?10\s*[\^*]\s*\d{1,2}\s*/\s*[a-zµμ]+"
+    r"|%"
+    r"|[a-zµμ][a-zµμ.]*(?:\s*/\s*(?:cu\.?\s*mm|100\s*ml|1st\s*hr|[a-zµμ]+\d?))?)",
+    re.IGNORECASE)
+CUBIC_MM_RE = re.compile(r"cu\.?mm|mm\^?3")
+POWER_RE = re.compile(r"^[x*]?10[\^*](\d+)")
+
+
+def normalize_unit(unit):
+    """Lowercase, spacing-free spelling with synonyms folded ("Lacs/cu mm" -> "lac/ul")."""
+    unit = (unit or "").strip().lower().replace("µ", "u").replace("μ", "u").replace("×", "x")
+    unit = "".join(unit.split())
+    unit = POWER_RE.sub(r"10^\1", CUBIC_MM_RE.sub("ul", unit))
+    return UNIT_SYNONYMS.get(unit, unit)
+
+
+def printed_unit(text, position):
+    """The recognised unit printed at text[position:] (after a value), or None."""
+    match = UNIT_TOKEN_RE.match(text, position)
+    if match and normalize_unit(match.group(1)) in UNIT_SCALES:
+        return match.group(1)
+    return None
+
+
+def significant(value, digits=6):
+    """Rounds away float noise from conversion factors (0.9999999 -> 1.0)."""
+    return float(f"{value:.{digits}g}")
+
+
+class UnitRegistry:
+    """Canonical units and reference ranges of the test catalogue, with conversion factors into them."""
+
+    def __init__(self, catalogue, molar_masses=MOLAR_MASSES):
+        self.catalogue = catalogue
+        self.molar_masses = molar_masses
+        self._factors = {}
+
+    def factor(self, test_name, unit):
+        """Multiplier from unit to the test's canonical unit: 1.0 for no unit, nan if unknown or incompatible."""
+        key = (test_name, unit)
+        if key not in self._factors:
+            self._factors[key] = self._compute_factor(test_name, unit)
+        return self._factors[key]
+
+    def _compute_factor(self, test_name, unit):
+        info = self.catalogue.get(test_name)
+        if info is None:
+            return math.nan
+        source, target = normalize_unit(unit), normalize_unit(info["unit"])
+        if not source or source == target:
+            return 1.0
+        if source not in UNIT_SCALES or target not in UNIT_SCALES:
+            return math.nan
+        (source_dim, source_scale), (target_dim, target_scale) = UNIT_SCALES[source], UNIT_SCALES[target]
+        if source_dim == target_dim:
+            return source_scale / target_scale
+        molar_mass = self.molar_masses.get(test_name)
+        if molar_mass and (source_dim, target_dim) == ("molar", "mass"):
+            return source_scale * molar_mass / target_scale
+        if molar_mass and (source_dim, target_dim) == ("mass", "molar"):
+            return source_scale / molar_mass / target_scale
+        return math.nan
+
+    def factors(self, test_names, units):
+        """Factors for parallel sequences of test names and units, computed once per distinct pair."""
+        distinct = {}
+        codes = np.fromiter((distinct.setdefault(pair, len(distinct)) for pair in zip(test_names, units)),
+                            dtype=np.intp, count=len(test_names))
+        table = np.array([self.factor(name, unit or "") for name, unit in distinct], dtype=np.float64)
+        return table[codes]
+
+    def to_canonical(self, test_names, values, units):
+        """(canonical values, factors) as arrays; values whose unit is unknown are returned unchanged."""
+        factors = self.factors(test_names, units)
+        values = np.asarray(values, dtype=np.float64)
+        return np.where(np.isnan(factors), values, values * factors), factors
+
+    def canonicalize(self, params):
+        """
+        Converts extracted results in place to canonical units, keeping the
+        printed value and unit as original_value / original_unit. range_low
+        and range_high are in the printed unit, or None for the catalogue
+        range. Results already converted are skipped. Returns the number of
+        values whose unit changed.
+        """
+        pending = [param for param in params if "original_unit" not in param]
+        if not pending:
+            return 0
+        names = [param["test_name"] for param in pending]
+        units = [param.get("unit") or "" for param in pending]
+        values, factors = self.to_canonical(names, [param["value"] for param in pending], units)
+        converted = 0
+        for param, factor, value in zip(pending, factors, values):
+            param["original_value"], param["original_unit"] = param["value"], param.get("unit")
+            info = self.catalogue.get(param["test_name"])
+            if info is None or math.isnan(factor):
+                if info is not None and param.get("range_low") is None:
+                    param["range_low"], param["range_high"] = info["normal_range"]
+                continue
+            if factor != 1.0:
+                converted += 1
+                param["value"] = significant(value)
+                for end in ("range_low", "range_high"):
+                    if param.get(end) is not None:
+                        param[end] = significant(param[end] * factor)
+            param["unit"] = info["unit"]
+            if param.get("range_low") is None or param.get("range_high") is None:
+                param["range_low"], param["range_high"] = info["normal_range"]
+        return converted
+
+
+def reprocess_reports(db_file, registry, decrypt_report, encrypt_report, refresh_report, chunk_size=500):
+    """
+    Converts the results of reports saved before canonical units, a chunk at
+    a time with one vectorized conversion per chunk. encrypt_report(report)
+    returns (blob, key_version); refresh_report(report) recomputes statuses
+    and scores. Returns (reports_updated, values_converted).
+    """
+    conn = sqlite3.connect(db_file, timeout=30)
+    last_id, updated, converted = 0, 0, 0
+    while True:
+        rows = conn.execute("SELECT id, report_data, key_version FROM patient_reports WHERE id > ? ORDER BY id LIMIT ?",
+                            (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        pending = []
+        for report_id, blob, key_version in rows:
+            try:
+                report = decrypt_report(blob, key_version)
+            except Exception:
+                continue
+            if any("original_unit" not in test for test in report.get("tests", [])):
+                pending.append((report_id, blob, report))
+
+        converted += registry.canonicalize([test for _, _, report in pending for test in report["tests"]])
+        updates = []
+        for report_id, blob, report in pending:
+            refresh_report(report)
+            updates.append(encrypt_report(report) + (report_id, blob))
+        # Only touch rows that were not rewritten by someone else meanwhile
+        with conn:
+            conn.executemany("UPDATE patient_reports SET report_data = ?, key_version = ? "
+                             "WHERE id = ? AND report_data = ?", updates)
+        updated += len(updates)
+    conn.close()
+    return updated, converted
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] != "reprocess":
+        print(__doc__)
+        return 1
+
+    from Aimodal import (ENCRYPTION_KEY, ENCRYPTION_KEY_VERSION, EXPLANATION_REFS, SHARD_FILES, UNIT_REGISTRY,
+                         decrypt_report, encode_report, refresh_report_scores, setup_database)
+
+    setup_database()
+    started = time.perf_counter()
+    updated, converted = (sum(totals) for totals in zip(*(reprocess_reports(
+        db_file, UNIT_REGISTRY, decrypt_report,
+        lambda report: (encode_report(report, ENCRYPTION_KEY, EXPLANATION_REFS), ENCRYPTION_KEY_VERSION),
+        refresh_report_scores) for db_file in SHARD_FILES)))
+    print(f"Updated {updated} reports ({converted} values converted) in {time.perf_counter() - started:.1f}s")
+    if converted:
+        print("Statuses may have changed: run  python analytics.py rebuild")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
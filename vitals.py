@@ -0,0 +1,213 @@
+"""
+High-frequency vitals ingestion.
+
+Home devices post batches of samples. Each batch is
+  - queued and written to a local SQLite store with one executemany per batch,
+  - folded into minute/hour/day min/max/mean rollups, so chart queries read
+    a handful of rollup rows instead of scanning raw samples.
+
+The queue lives in the worker process that received the samples; the
+stored samples and rollups are shared by all workers. Live views and charts
+read the store, so they see samples posted to any worker once it has
+flushed (within FLUSH_INTERVAL seconds).
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# Metric names match the columns of the vitals table in healthcare_schema.sql
+METRICS = (
+    "heart_rate", "blood_pressure_systolic", "blood_pressure_diastolic", "temperature",
+    "temperature_celsius", "respiratory_rate", "oxygen_saturation", "glucose_level", "weight",
+)
+RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+VITALS_DB_FILE = os.getenv("VITALS_DB_FILE", "vitals.db")
+# Most recent samples a live view returns (about an hour at 1 Hz)
+LIVE_LIMIT = int(os.getenv("VITALS_LIVE_LIMIT", "3600"))
+# Queued samples are written once this many are pending or FLUSH_INTERVAL seconds pass
+FLUSH_BATCH = int(os.getenv("VITALS_FLUSH_BATCH", "5000"))
+FLUSH_INTERVAL = float(os.getenv("VITALS_FLUSH_INTERVAL", "1.0"))
+
+
+def parse_timestamp(value):
+    """Epoch seconds from a number or an ISO-8601 string; now if missing."""
+    if value is None:
+        return time.time()
+    if isinstance(value, bool):
+        raise TypeError("timestamp must be a number or an ISO-8601 string")
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            raise ValueError("timestamp must be finite")
+        return float(value)
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+
+
+def expand_samples(samples):
+    """
+    Yields (metric, ts, value) from either {"metric", "value", "ts"} samples or
+    vitals-table style rows ({"recorded_at", "heart_rate", "oxygen_saturation", ...}).
+    ts is None when the sample's timestamp cannot be parsed.
+    """
+    for sample in samples:
+        try:
+            ts = parse_timestamp(sample.get("ts", sample.get("recorded_at")))
+        except (TypeError, ValueError):
+            ts = None
+        if "metric" in sample:
+            yield sample["metric"], ts, sample.get("value")
+        else:
+            for metric in METRICS:
+                if sample.get(metric) is not None:
+                    yield metric, ts, sample[metric]
+
+
+class VitalsStore:
+    """A write-behind queue over the vitals SQLite store."""
+
+    def __init__(self, db_file=VITALS_DB_FILE, live_limit=LIVE_LIMIT,
+                 flush_batch=FLUSH_BATCH, flush_interval=FLUSH_INTERVAL):
+        self.db_file = db_file
+        self.live_limit = live_limit
+        self.flush_batch = flush_batch
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        self._setup()
+
+        self.stopped = threading.Event()
+        self.flusher = None
+        if flush_interval:
+            self.flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True)
+            self.flusher.start()
+
+    def _setup(self):
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS vital_samples (
+                patient_id TEXT NOT NULL, metric TEXT NOT NULL, ts REAL NOT NULL, value REAL NOT NULL
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_vital_samples_patient ON vital_samples (patient_id, metric, ts)")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS vital_rollups (
+                patient_id TEXT NOT NULL, metric TEXT NOT NULL, resolution TEXT NOT NULL,
+                bucket_start INTEGER NOT NULL, count INTEGER NOT NULL,
+                total REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL,
+                PRIMARY KEY (patient_id, metric, resolution, bucket_start)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.commit()
+
+    def ingest(self, patient_id, samples):
+        """Buffers a batch of samples. Returns (accepted, rejected)."""
+        rows, rejected = [], 0
+        for metric, ts, value in expand_samples(samples):
+            # bool is an int subclass; NaN and infinities would poison every rollup they land in
+            if (metric not in METRICS or ts is None or isinstance(value, bool)
+                    or not isinstance(value, (int, float)) or not math.isfinite(value)):
+                rejected += 1
+                continue
+            rows.append((patient_id, metric, ts, float(value)))
+
+        with self.lock:
+            self.pending.extend(rows)
+            should_flush = len(self.pending) >= self.flush_batch
+
+        if should_flush:
+            self.flush()
+        return len(rows), rejected
+
+    def flush(self):
+        """Writes queued samples and their rollups in one transaction. Returns rows written."""
+        with self.flush_lock:
+            with self.lock:
+                rows, self.pending = self.pending, []
+            if not rows:
+                return 0
+
+            # Aggregate the batch in memory first: one upsert per bucket, not per sample
+            buckets = {}
+            for patient_id, metric, ts, value in rows:
+                for resolution, width in RESOLUTIONS.items():
+                    key = (patient_id, metric, resolution, int(ts // width * width))
+                    bucket = buckets.get(key)
+                    if bucket is None:
+                        buckets[key] = [1, value, value, value]
+                    else:
+                        bucket[0] += 1
+                        bucket[1] += value
+                        if value < bucket[2]:
+                            bucket[2] = value
+                        if value > bucket[3]:
+                            bucket[3] = value
+
+            try:
+                with self.conn:
+                    self.conn.executemany("INSERT INTO vital_samples (patient_id, metric, ts, value) VALUES (?, ?, ?, ?)", rows)
+                    self.conn.executemany('''
+                        INSERT INTO vital_rollups (patient_id, metric, resolution, bucket_start, count, total, min, max)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(patient_id, metric, resolution, bucket_start) DO UPDATE SET
+                            count = count + excluded.count, total = total + excluded.total,
+                            min = MIN(min, excluded.min), max = MAX(max, excluded.max)
+                    ''', [key + tuple(bucket) for key, bucket in buckets.items()])
+            except sqlite3.Error:
+                # Put the batch back so the next flush retries it
+                with self.lock:
+                    self.pending = rows + self.pending
+                raise
+            return len(rows)
+
+    def _flush_loop(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Vitals flush failed, will retry: {e}")
+
+    def live(self, patient_id, metric, seconds=300):
+        """
+        Raw samples from the last `seconds`, oldest first, at most live_limit
+        of them. Read from the store, so samples other workers received show
+        up once they have flushed.
+        """
+        self.flush()
+        with self.flush_lock:
+            rows = self.conn.execute(
+                "SELECT ts, value FROM vital_samples WHERE patient_id = ? AND metric = ? AND ts >= ? "
+                "ORDER BY ts DESC LIMIT ?",
+                (patient_id, metric, time.time() - seconds, self.live_limit)).fetchall()
+        return [{"ts": ts, "value": value} for ts, value in reversed(rows)]
+
+    def series(self, patient_id, metric, resolution="minute", start=None, end=None):
+        """min/max/mean per bucket from the rollups, including samples not yet flushed."""
+        self.flush()
+        query = ("SELECT bucket_start, count, total, min, max FROM vital_rollups "
+                 "WHERE patient_id = ? AND metric = ? AND resolution = ?")
+        params = [patient_id, metric, resolution]
+        if start is not None:
+            query += " AND bucket_start >= ?"
+            params.append(parse_timestamp(start) // RESOLUTIONS[resolution] * RESOLUTIONS[resolution])
+        if end is not None:
+            query += " AND bucket_start <= ?"
+            params.append(parse_timestamp(end))
+        query += " ORDER BY bucket_start"
+        with self.flush_lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [{"bucket_start": bucket_start, "count": count, "mean": round(total / count, 2),
+                 "min": min_value, "max": max_value}
+                for bucket_start, count, total, min_value, max_value in rows]
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush()
+        self.conn.close()